@@ -1,6 +1,5 @@
 import pickle
 import numpy as np
-from PIL import Image
 import os
 
 import torch
@@ -9,28 +8,64 @@ from torch.utils.data.dataset import Dataset
 from torchvision.transforms.functional import resize
 
 from batchgenerators.utilities.file_and_folder_operations import *
-from batchgenerators.transforms.abstract_transforms import Compose, RndTransform
-from batchgenerators.transforms.spatial_transforms import SpatialTransform, MirrorTransform, ResizeTransform
-from batchgenerators.transforms.color_transforms import BrightnessTransform, GammaTransform
-from batchgenerators.transforms.noise_transforms import GaussianNoiseTransform
-from batchgenerators.transforms.utility_transforms import NumpyToTensor
+
+from dataset.manifest import SliceList, load_manifest
+from dataset.transforms import get_transform
+from dataset.elastic_bank import get_field_bank
+from dataset.slice_cache import cached_read, get_slice_cache
+from dataset.slice_sampler import foreground_selection
+from dataset.resized_cache import get_resized_cache
+from dataset.telemetry import get_telemetry, install, timed, timed_transform
+from dataset.transport import source_bits
 
 join = os.path.join
 
 
 class LP_CTA_Dataset(Dataset):
-    def __init__(self, keys, args, mode='train'):
+    def __init__(self, keys, args, mode='train', split=None):
         super().__init__()
         self.patch_size = (args.img_size, args.img_size)
         print(f'patch size: {self.patch_size}')
-        self.files = []
         self.mode = mode
-
-        for f in os.listdir(args.data_dir):
-            if f.split("_frame")[0] in keys:
-                slices = subfiles(join(args.data_dir, f))
-                for sl in slices:
-                    self.files.append(sl)  # Dataset folder
+        # with uint8_transport batches travel as uint8 and are normalized on the training device (dataset/transport.py)
+        self.transport = mode != 'contrast' and getattr(args, 'uint8_transport', False)
+        # with resize_once images are resized once, straight to the encoder input size; train labels go to
+        # patch size, val/test labels keep their native size and batches are grouped by shape
+        self.input_size = None
+        if getattr(args, 'resize_once', False) and mode != 'contrast':
+            self.input_size = (getattr(args, 'encoder_size', 1024),) * 2
+        self.native_labels = self.input_size is not None and mode != 'train'
+        # with batch_aug the train augmentations run per batch in the collate step (dataset/batch_augment.py),
+        # with uint8_transport on the training device
+        self.batch_aug = mode == 'train' and (getattr(args, 'batch_aug', False) or self.transport
+                                              or self.input_size is not None)
+        self.field_bank = get_field_bank(args, self.patch_size) if mode in ('train', 'contrast') else None
+        self.aug = get_transform(mode, self.patch_size, self.batch_aug, self.field_bank, self.input_size)
+        # per-stage timings of the loader workers, reported by the training loop (dataset/telemetry.py),
+        # recorded per loader: split tells the test loader apart from the val loader of the same mode
+        self.telemetry = get_telemetry(args, split or mode, self.aug)
+        if self.telemetry is not None:
+            self.aug = timed_transform(self.aug)
+        # slices come from the cached manifest of data_dir (PNG folders, packed arrays or volumes, see dataset/manifest.py)
+        self.manifest = load_manifest(args.data_dir)
+        self.indices = self.manifest.select(keys)
+        # train slices can be filtered or weighted by their foreground fraction (dataset/slice_sampler.py)
+        self.sample_weights, self.num_samples = None, len(self.indices)
+        if mode == 'train':
+            self.indices, self.sample_weights, self.num_samples = foreground_selection(self.manifest, self.indices, args)
+        self.files = SliceList(self.manifest, self.indices)
+        # 16-bit slices travel as int16 codes instead of uint8 with uint8_transport
+        self.transport_bits = source_bits(self.manifest, self.indices) if self.transport else 8
+        # decoded slices shared by the workers of all loaders on this data_dir (dataset/slice_cache.py)
+        self.slice_cache = None
+        # images already resized to the encoder input size, on disk (dataset/resized_cache.py)
+        self.resized_cache = None
+        if self.input_size is not None:
+            self.resized_cache = get_resized_cache(args, self.manifest, self.input_size[0], self.load_slice)
+        if self.resized_cache is None:
+            self.slice_cache = get_slice_cache(args, self.manifest, self.load_slice)
+        # the per-sample augmentations write into their input, so cached views are copied first
+        self.in_place_aug = mode == 'contrast' or (mode == 'train' and not self.batch_aug)
 
         print(f'dataset length: {len(self.files)}') 
 
@@ -38,15 +73,37 @@ class LP_CTA_Dataset(Dataset):
         return len(self.files)
 
     def __getitem__(self, index):
-        img = Image.open(self.files[index])
-        label = Image.open(self.files[index].replace('imgs', 'annotations'))   
-        label = np.asarray(label)/255
+        install(self.telemetry)
+        if self.resized_cache is not None:
+            img, label = self.resized_cache.read(self.indices[index], self.load_slice, self.load_label)
+            return self.process(img, label)
+        with cached_read(self.slice_cache, self.indices[index], self.load_slice) as (img, label):
+            return self.process(img, label)
+
+    def load_slice(self, i):
+        """Image of manifest slice i as float32 [C, H, W] in [0, 1] (C = 1 if grayscale), and its label."""
+        img, label = self.manifest.read(i)
+        with timed('normalize'):
+            return self.normalize(img, label)
+
+    def normalize(self, img, label):
+        """Decoded image and label arrays as load_slice returns them."""
+        img = np.asarray(img).astype(np.float32)
+        # single-channel slices stay [1, H, W]; the model broadcasts them to RGB in front of the encoder
+        img = img[None] if img.ndim == 2 else img.transpose([2, 0, 1])
+        img = (img - img.min()) / (img.max() - img.min())
+        return img, np.asarray(label)
+
+    def load_label(self, i):
+        return np.asarray(self.manifest.read_label(i))
+
+    def process(self, img, label):
+        if self.in_place_aug and not img.flags.writeable:
+            img = img.copy()
+        label = label/255
         # scribble = Image.open(self.files[index].replace('imgs/', 'scribbles/'))
         # scribble = np.asarray(scribble)
 
-        img = np.asarray(img).astype(np.float32).transpose([2, 0, 1])
-        # img = np.asarray(img).astype(np.float32)
-        img = (img - img.min()) / (img.max() - img.min())
         # print(img.shape, label.shape)
         # 绘制label
         # import matplotlib.pyplot as plt
@@ -64,59 +121,16 @@ class LP_CTA_Dataset(Dataset):
     def transform_contrast(self, img):
         # the image and label should be [batch, c, x, y, z], this is the adapatation for using batchgenerators :)
         data_dict = {'data': img[None]}
-        tr_transforms = [  # CenterCropTransform(crop_size=target_size),
-            BrightnessTransform(mu=1, sigma=1, p_per_sample=0.5),
-            GammaTransform(p_per_sample=0.5),
-            GaussianNoiseTransform(p_per_sample=0.5),
-            ResizeTransform(target_size=self.patch_size, order=1),  # resize
-            MirrorTransform(axes=(1,)),
-            SpatialTransform(patch_size=self.patch_size, random_crop=False,
-                             patch_center_dist_from_border=self.patch_size[0] // 2,
-                             do_elastic_deform=True, alpha=(100., 350.), sigma=(40., 60.),
-                             do_rotation=True, p_rot_per_sample=0.5,
-                             angle_x=(-0.1, 0.1), angle_y=(0, 1e-8), angle_z=(0, 1e-8),
-                             scale=(0.5, 1.9), p_scale_per_sample=0.5,
-                             border_mode_data="nearest", border_mode_seg="nearest"),
-        ]
-
-        train_transform = Compose(tr_transforms)
-        data_dict = train_transform(**data_dict)
+        data_dict = self.aug(**data_dict)
         img1 = data_dict.get('data')[0]
-        data_dict = train_transform(**data_dict)
+        data_dict = self.aug(**data_dict)
         img2 = data_dict.get('data')[0]
         return img1, img2
 
     def transform(self, img, label):
         # normalize to [0, 1]
         data_dict = {'data': img[None], 'seg': label[None, None]}
-        if self.mode == 'train':
-            aug_list = [  # CenterCropTransform(crop_size=target_size),
-                BrightnessTransform(mu=1, sigma=1, p_per_sample=0.5),
-                GammaTransform(p_per_sample=0.5),
-                GaussianNoiseTransform(p_per_sample=0.5),
-                ResizeTransform(target_size=self.patch_size, order=1),  # resize
-                MirrorTransform(axes=(1,)),
-                SpatialTransform(patch_size=self.patch_size, random_crop=False,
-                                 patch_center_dist_from_border=self.patch_size[0] // 2,
-                                 do_elastic_deform=True, alpha=(100., 350.), sigma=(40., 60.),
-                                 do_rotation=True, p_rot_per_sample=0.5,
-                                 angle_x=(-0.1, 0.1), angle_y=(0, 1e-8), angle_z=(0, 1e-8),
-                                 scale=(0.5, 1.9), p_scale_per_sample=0.5,
-                                 border_mode_data="nearest", border_mode_seg="nearest"),
-                NumpyToTensor(),
-            ]
-
-            aug = Compose(aug_list)
-        else:
-            aug_list = [
-                ResizeTransform(target_size=self.patch_size, order=1),
-                NumpyToTensor(),
-            ]
-            aug = Compose(aug_list)
-        # print('data_shape',data_dict.get('data').shape)
-        # print('seg_shape',data_dict.get('seg').shape)
-        # print(aug)
-        data_dict = aug(**data_dict)
+        data_dict = self.aug(**data_dict)
         img = data_dict.get('data')[0]
         label = data_dict.get('seg')[0]
         return img, label
@@ -9,11 +9,10 @@ from torch.utils.data.dataset import Dataset
 from torchvision.transforms.functional import resize
 
 from batchgenerators.utilities.file_and_folder_operations import *
-from batchgenerators.transforms.abstract_transforms import Compose, RndTransform
-from batchgenerators.transforms.spatial_transforms import SpatialTransform, MirrorTransform, ResizeTransform
-from batchgenerators.transforms.color_transforms import BrightnessTransform, GammaTransform
-from batchgenerators.transforms.noise_transforms import GaussianNoiseTransform
-from batchgenerators.transforms.utility_transforms import NumpyToTensor
+
+from dataset.manifest import SliceList, load_manifest
+from dataset.transforms import get_transform
+from dataset.elastic_bank import get_field_bank
 
 join = os.path.join
 
@@ -22,14 +21,12 @@ class SynapseDataset(Dataset):
     def __init__(self, keys, args, mode='train'):
         super().__init__()
         self.patch_size = (args.img_size, args.img_size)
-        self.files = []
         self.mode = mode
-
-        for key in keys:
-            key = key.split(".")[0]
-            slices = subfiles(join(args.data_dir, key))
-            for sl in slices:
-                self.files.append(sl)
+        self.field_bank = get_field_bank(args, self.patch_size) if mode == 'train' else None
+        self.aug = get_transform(mode, self.patch_size, field_bank=self.field_bank)
+        self.manifest = load_manifest(args.data_dir)
+        self.indices = self.manifest.select([key.split(".")[0] for key in keys])
+        self.files = SliceList(self.manifest, self.indices)
 
         print(f'dataset length: {len(self.files)}')
 
@@ -37,44 +34,18 @@ class SynapseDataset(Dataset):
         return len(self.files)
 
     def __getitem__(self, index):
-        img = Image.open(self.files[index])
-        label = Image.open(self.files[index].replace('imgs/', 'annotations/'))
-        label = np.asarray(label)
+        img, label = self.manifest.read(self.indices[index])
 
         img, label = self.transform(img, label)
         return img, label, self.files[index]
 
     def transform(self, img, label):
         # normalize to [0, 1]
-        img = np.asarray(img).astype(np.float32).transpose([2, 0, 1])
+        img = np.asarray(img).astype(np.float32)
+        img = img[None] if img.ndim == 2 else img.transpose([2, 0, 1])
         img = (img - img.min()) / (img.max() - img.min())
         data_dict = {'data': img[None], 'seg': label[None, None]}
-        if self.mode == 'train':
-            aug_list = [  # CenterCropTransform(crop_size=target_size),
-                BrightnessTransform(mu=1, sigma=1, p_per_sample=0.5),
-                GammaTransform(p_per_sample=0.5),
-                GaussianNoiseTransform(p_per_sample=0.5),
-                ResizeTransform(target_size=self.patch_size, order=1),  # resize
-                MirrorTransform(axes=(1,)),
-                SpatialTransform(patch_size=self.patch_size, random_crop=False,
-                                 patch_center_dist_from_border=self.patch_size[0] // 2,
-                                 do_elastic_deform=True, alpha=(100., 350.), sigma=(40., 60.),
-                                 do_rotation=True, p_rot_per_sample=0.5,
-                                 angle_x=(-0.1, 0.1), angle_y=(0, 1e-8), angle_z=(0, 1e-8),
-                                 scale=(0.5, 1.9), p_scale_per_sample=0.5,
-                                 border_mode_data="nearest", border_mode_seg="nearest"),
-                NumpyToTensor(),
-            ]
-
-            aug = Compose(aug_list)
-        else:
-            aug_list = [
-                ResizeTransform(target_size=self.patch_size, order=1),
-                NumpyToTensor(),
-            ]
-            aug = Compose(aug_list)
-
-        data_dict = aug(**data_dict)
+        data_dict = self.aug(**data_dict)
         img = data_dict.get('data')[0]
         label = data_dict.get('seg')[0]
         return img, label
@@ -0,0 +1,26 @@
+import numpy as np
+
+from dataset.ACDC import AcdcDataset
+from dataset.manifest import load_manifest
+from dataset.volume_store import VolumeStore, set_cache_dir
+
+
+class VolumeDataset(AcdcDataset):
+    """
+    AcdcDataset (same train/val/contrast transforms, slice cache and sampling) over the slices of
+    .nii / .nii.gz / .nrrd volumes, without the PNG conversion step. Intensities keep their stored
+    precision up to the per-slice min-max normalization, and labels are used as stored.
+    Patient keys follow the manifest rule, i.e. the folder name up to "_frame", with raw ACDC names
+    normalized to the converter's patient_001 form (dataset/volume_store.py::folder_name).
+    """
+    def __init__(self, keys, args, mode='train', split=None):
+        if getattr(args, 'volume_cache', None):
+            set_cache_dir(args.data_dir, args.volume_cache)
+        manifest = load_manifest(args.data_dir)
+        assert isinstance(manifest.store, VolumeStore), '%s holds no .nii/.nrrd volumes' % args.data_dir
+        selected = np.isin(manifest.keys, np.asarray(keys, dtype=str))
+        if not selected.any():
+            raise ValueError('none of the patient keys %s is in %s, whose volumes have the keys %s'
+                             % (sorted(keys)[:5], args.data_dir, manifest.patient_keys()[:5]))
+        manifest.store.prepare(manifest.folders[selected].tolist())
+        super().__init__(keys, args, mode, split)
@@ -1,3 +1,5 @@
 from .Synapse import SynapseDataset
 from .ACDC import AcdcDataset
-from .utils import *
\ No newline at end of file
+from .utils import *
+from .embedding_cache import generate_embedding_dataset, generate_embedding_test_loader, \
+    generate_embedding_volume_loader
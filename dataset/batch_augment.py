@@ -0,0 +1,174 @@
+import torch
+import torch.nn.functional as F
+from torch.utils.data._utils.collate import default_collate
+
+
+def gaussian_matrices(sigma, size):
+    """
+    [B, size, size] matrices G with G @ x = scipy.ndimage.gaussian_filter1d(x, sigma, mode="constant"):
+    normalised gaussians truncated at 4 sigma, and rows that run off the edge see the zero padding.
+    With sigma in the order of the patch size the kernels span the whole field, and one batched
+    matmul per axis is much cheaper than a (grouped) convolution with several hundred taps.
+    """
+    radius = (4 * sigma + 0.5).floor()
+    x = torch.arange(-int(radius.max()), int(radius.max()) + 1, device=sigma.device, dtype=sigma.dtype)
+    kernels = torch.exp(-0.5 * (x[None] / sigma[:, None]) ** 2) * (x[None].abs() <= radius[:, None])
+    norm = kernels.sum(1).view(-1, 1, 1)
+    offset = torch.arange(size, device=sigma.device, dtype=sigma.dtype)
+    offset = offset[None, :] - offset[:, None]
+    return torch.exp(-0.5 * (offset[None] / sigma.view(-1, 1, 1)) ** 2) \
+        * (offset[None].abs() <= radius.view(-1, 1, 1)) / norm
+
+
+class BatchAugmentation(object):
+    """
+    The train augmentations of dataset/transforms.py::get_augmentation_list applied to whole batches
+    img [B, C, H, W] / label [B, 1, H, W] with vectorized torch ops. Every sample draws its own
+    parameters, with the same distributions as the batchgenerators transforms:
+        brightness  p=0.5, per channel additive N(1, 1)
+        gamma       p=0.5, gamma from (0.5, 1) or (1, 2) with equal probability, on the min-max range
+        noise       p=0.5, gaussian with std U(0, 0.1)
+        mirror      p=0.5, along the last axis
+        spatial     elastic deformation (alpha U(100, 350), sigma U(40, 60)), then rotation
+                    (p=0.5, U(-0.1, 0.1) rad) and scale (p=0.5, (0.5, 1) or (1, 1.9)) about the centre
+    The elastic fields of the batch are smoothed with batched separable matmuls, and images
+    and labels are resampled with a single grid_sample each (bicubic / nearest, border padding).
+    The inputs must already be resized to patch_size; batchgenerators resized after the intensity
+    augmentations, here they run on the resized batch. Bicubic grid_sample is a cubic convolution
+    and not the spline of scipy's map_coordinates, so values differ slightly from the per-sample path.
+    """
+    def __init__(self, patch_size,
+                 p_brightness=0.5, brightness=(1., 1.),
+                 p_gamma=0.5, gamma_range=(0.5, 2.),
+                 p_noise=0.5, noise_variance=(0., 0.1),
+                 p_mirror=0.5,
+                 alpha=(100., 350.), sigma=(40., 60.),
+                 p_rotation=0.5, angle=(-0.1, 0.1),
+                 p_scale=0.5, scale=(0.5, 1.9), field_bank=None):
+        self.patch_size = tuple(patch_size)
+        self.p_brightness = p_brightness
+        self.brightness = brightness
+        self.p_gamma = p_gamma
+        self.gamma_range = gamma_range
+        self.p_noise = p_noise
+        self.noise_variance = noise_variance
+        self.p_mirror = p_mirror
+        self.alpha = alpha
+        self.sigma = sigma
+        self.p_rotation = p_rotation
+        self.angle = angle
+        self.p_scale = p_scale
+        self.scale = scale
+        # precomputed elastic fields (dataset/elastic_bank.py) instead of smoothing new ones per batch
+        self.field_bank = field_bank
+
+    @staticmethod
+    def _uniform(b, low, high, device):
+        return torch.rand(b, device=device) * (high - low) + low
+
+    @staticmethod
+    def _coin(b, p, device):
+        return torch.rand(b, device=device) < p
+
+    def _below_or_above_one(self, b, value_range, device):
+        # batchgenerators draws gamma / scale from [low, 1) or [1, high] with probability 0.5 each
+        below = self._uniform(b, value_range[0], 1., device)
+        above = self._uniform(b, max(value_range[0], 1.), value_range[1], device)
+        return torch.where(self._coin(b, 0.5, device), below, above)
+
+    def intensity(self, img):
+        b, c = img.shape[:2]
+        device = img.device
+        mu, sd = self.brightness
+        shift = torch.randn(b, c, 1, 1, device=device) * sd + mu
+        img = img + self._coin(b, self.p_brightness, device).view(b, 1, 1, 1) * shift
+
+        gamma = self._below_or_above_one(b, self.gamma_range, device).view(b, 1, 1, 1)
+        flat = img.reshape(b, -1)
+        minm = flat.min(1)[0].view(b, 1, 1, 1)
+        rnge = flat.max(1)[0].view(b, 1, 1, 1) - minm
+        gamma_img = ((img - minm) / (rnge + 1e-7)).pow(gamma) * rnge + minm
+        img = torch.where(self._coin(b, self.p_gamma, device).view(b, 1, 1, 1), gamma_img, img)
+
+        std = self._uniform(b, self.noise_variance[0], self.noise_variance[1], device)
+        std = std * self._coin(b, self.p_noise, device)
+        return img + torch.randn_like(img) * std.view(b, 1, 1, 1)
+
+    def elastic_offsets(self, b, device):
+        """Smoothed uniform(-1, 1) displacement fields [B, 2, H, W] in pixels, scaled by alpha."""
+        h, w = self.patch_size
+        alpha = self._uniform(b, self.alpha[0], self.alpha[1], device)
+        if self.field_bank is not None:
+            return self.field_bank.sample_batch(alpha)
+        sigma = self._uniform(b, self.sigma[0], self.sigma[1], device)
+        noise = torch.rand(b, 2, h, w, device=device) * 2 - 1
+
+        # one sigma per sample, shared by both axes of its field
+        rows = gaussian_matrices(sigma, h)[:, None]
+        cols = gaussian_matrices(sigma, w)[:, None]
+        noise = rows @ noise @ cols.transpose(-1, -2)
+        return noise * alpha.view(b, 1, 1, 1)
+
+    def sampling_grid(self, b, device):
+        h, w = self.patch_size
+        ys = torch.arange(h, device=device, dtype=torch.float32) - (h - 1) / 2.
+        xs = torch.arange(w, device=device, dtype=torch.float32) - (w - 1) / 2.
+        coords = torch.stack(torch.meshgrid(ys, xs, indexing='ij'))[None] + self.elastic_offsets(b, device)
+
+        angle = self._uniform(b, self.angle[0], self.angle[1], device)
+        angle = angle * self._coin(b, self.p_rotation, device)
+        cos, sin = angle.cos().view(b, 1, 1), angle.sin().view(b, 1, 1)
+        # rotate_coords_2d: coords^T . [[cos, -sin], [sin, cos]]
+        coords = torch.stack([coords[:, 0] * cos + coords[:, 1] * sin,
+                              -coords[:, 0] * sin + coords[:, 1] * cos], 1)
+
+        scale = self._below_or_above_one(b, self.scale, device)
+        scale = torch.where(self._coin(b, self.p_scale, device), scale, torch.ones_like(scale))
+        coords = coords * scale.view(b, 1, 1, 1)
+
+        # pixel coordinates about the centre -> [-1, 1] with align_corners=True, ordered (x, y)
+        grid = torch.stack([coords[:, 1] / ((w - 1) / 2.), coords[:, 0] / ((h - 1) / 2.)], -1)
+        return grid
+
+    def spatial(self, img, label=None, img_size=None):
+        b = img.shape[0]
+        device = img.device
+        mirror = self._coin(b, self.p_mirror, device).view(b, 1, 1, 1)
+        img = torch.where(mirror, img.flip(-1), img)
+        if label is not None:
+            label = torch.where(mirror, label.flip(-1), label)
+
+        grid = self.sampling_grid(b, device)
+        if label is not None:
+            label = F.grid_sample(label.float(), grid, mode='nearest', padding_mode='border',
+                                  align_corners=True)
+        if img_size is not None and (img_size, img_size) != self.patch_size:
+            # sample the image straight at img_size instead of warping it and resizing it afterwards
+            grid = F.interpolate(grid.permute(0, 3, 1, 2), (img_size, img_size), mode='bilinear',
+                                 align_corners=False).permute(0, 2, 3, 1)
+        img = F.grid_sample(img, grid, mode='bicubic', padding_mode='border', align_corners=True)
+        return img, label
+
+    def __call__(self, img, label=None, img_size=None):
+        """
+        Augmented (img, label); with img_size the image comes out at img_size x img_size, the label at patch size.
+        The image may already be larger than patch size (resize_once), the warp is sampled from it directly.
+        """
+        ref = img if label is None else label
+        assert tuple(ref.shape[-2:]) == self.patch_size, \
+            'batch augmentation expects inputs resized to %s, got %s' % (self.patch_size, tuple(ref.shape[-2:]))
+        with torch.no_grad():
+            img = self.intensity(img.float())
+            return self.spatial(img, label, img_size)
+
+
+class BatchAugmentCollate(object):
+    """collate_fn that stacks the samples and augments the batch, so it runs once per batch in the workers."""
+    def __init__(self, patch_size, field_bank=None, img_size=None):
+        self.augmentation = BatchAugmentation(patch_size, field_bank=field_bank)
+        self.img_size = img_size
+
+    def __call__(self, batch):
+        img, label = default_collate(batch)
+        return self.augmentation(img, label, img_size=self.img_size)
+
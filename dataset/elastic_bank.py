@@ -0,0 +1,160 @@
+import numpy as np
+import torch
+
+from batchgenerators.transforms.spatial_transforms import SpatialTransform
+from batchgenerators.augmentations.crop_and_pad_augmentations import center_crop as center_crop_aug, \
+    random_crop as random_crop_aug
+from batchgenerators.augmentations.utils import create_zero_centered_coordinate_mesh, interpolate_img, \
+    rotate_coords_2d, scale_coords
+
+from dataset.batch_augment import gaussian_matrices
+
+_banks = {}
+
+
+class ElasticFieldBank(object):
+    """
+    Seeded bank of smoothed displacement fields for one patch size, stored as a shared-memory tensor
+        fields  [N, 2, H, W]  gaussian_filter(uniform(-1, 1), sigma, mode="constant") per axis
+        sigmas  [N]           sigma of every field, drawn from U(sigma)
+    i.e. the fields batchgenerators' elastic_deform_coordinates draws, before the multiplication
+    with alpha. A draw picks a field and one of its flips / transposes / sign changes (each an
+    equally likely outcome of the same i.i.d. noise process) and scales it by a fresh alpha, so
+    alpha keeps its distribution and sigma is sampled from the N values in the bank.
+
+    Building is one batched matmul per axis; afterwards an elastic deformation costs an index
+    and a multiplication instead of two large gaussian filters per sample. The tensor lives in
+    shared memory, so DataLoader workers map the bank instead of copying it.
+    """
+    def __init__(self, patch_size, num_fields=256, sigma=(40., 60.), seed=0, chunk_size=16):
+        self.patch_size = tuple(patch_size)
+        self.sigma = sigma
+        self.seed = seed
+        h, w = self.patch_size
+        generator = torch.Generator().manual_seed(seed)
+        sigmas = torch.rand(num_fields, generator=generator) * (sigma[1] - sigma[0]) + sigma[0]
+        fields = torch.empty(num_fields, 2, h, w)
+        for start in range(0, num_fields, chunk_size):
+            s = sigmas[start:start + chunk_size]
+            noise = torch.rand(len(s), 2, h, w, generator=generator) * 2 - 1
+            fields[start:start + len(s)] = gaussian_matrices(s, h)[:, None] @ noise \
+                @ gaussian_matrices(s, w)[:, None].transpose(-1, -2)
+        self.fields = fields.share_memory_()
+        self.sigmas = sigmas
+
+    def __len__(self):
+        return len(self.fields)
+
+    def sample(self, alpha):
+        """One displacement field [2, H, W] as a numpy array, scaled by alpha."""
+        field = self.fields[np.random.randint(len(self))].numpy()
+        if np.random.uniform() < 0.5:
+            field = field[:, ::-1]
+        if np.random.uniform() < 0.5:
+            field = field[:, :, ::-1]
+        if field.shape[1] == field.shape[2] and np.random.uniform() < 0.5:
+            field = field.transpose(0, 2, 1)
+        sign = np.where(np.random.uniform(size=(2, 1, 1)) < 0.5, -alpha, alpha)
+        return field * sign
+
+    def sample_batch(self, alpha):
+        """Displacement fields [B, 2, H, W] for a batch, scaled by alpha [B]; drawn with torch's RNG."""
+        b = len(alpha)
+        fields = self.fields[torch.randint(len(self), (b,))].to(alpha.device)
+        coin = lambda: (torch.rand(b, device=alpha.device) < 0.5).view(b, 1, 1, 1)
+        fields = torch.where(coin(), fields.flip(-2), fields)
+        fields = torch.where(coin(), fields.flip(-1), fields)
+        if fields.shape[-1] == fields.shape[-2]:
+            fields = torch.where(coin(), fields.transpose(-1, -2), fields)
+        sign = torch.where(torch.rand(b, 2, 1, 1, device=alpha.device) < 0.5, -1., 1.)
+        return fields * sign * alpha.view(b, 1, 1, 1)
+
+
+def get_field_bank(args, patch_size, sigma=(40., 60.)):
+    """The bank selected by args.elastic_bank / args.elastic_bank_seed, built once per process; None if off."""
+    num_fields = getattr(args, 'elastic_bank', 0)
+    if not num_fields:
+        return None
+    key = (tuple(patch_size), num_fields, tuple(sigma), getattr(args, 'elastic_bank_seed', 0))
+    if key not in _banks:
+        print('building elastic field bank of %d fields for patch size %s' % (num_fields, tuple(patch_size)))
+        _banks[key] = ElasticFieldBank(patch_size, num_fields, sigma, key[3])
+    return _banks[key]
+
+
+class BankSpatialTransform(SpatialTransform):
+    """
+    2D SpatialTransform that takes its elastic deformation from an ElasticFieldBank instead of
+    smoothing a fresh field per sample. Rotation, scaling, cropping and interpolation follow
+    batchgenerators' augment_spatial; the bank's sigma range replaces the sigma argument.
+    """
+    def __init__(self, field_bank, patch_size, **kwargs):
+        assert tuple(patch_size) == field_bank.patch_size, \
+            'field bank of patch size %s used for %s' % (field_bank.patch_size, tuple(patch_size))
+        super().__init__(patch_size, **kwargs)
+        self.field_bank = field_bank
+
+    def __call__(self, **data_dict):
+        data = data_dict.get(self.data_key)
+        seg = data_dict.get(self.label_key)
+        patch_size = self.patch_size
+        dist = self.patch_center_dist_from_border
+        if not isinstance(dist, (list, tuple, np.ndarray)):
+            dist = 2 * [dist]
+
+        data_result = np.zeros((data.shape[0], data.shape[1]) + tuple(patch_size), dtype=np.float32)
+        seg_result = None
+        if seg is not None:
+            seg_result = np.zeros((seg.shape[0], seg.shape[1]) + tuple(patch_size), dtype=np.float32)
+
+        for sample_id in range(data.shape[0]):
+            coords = create_zero_centered_coordinate_mesh(patch_size)
+            modified_coords = False
+
+            if self.do_elastic_deform and np.random.uniform() < self.p_el_per_sample:
+                coords = coords + self.field_bank.sample(np.random.uniform(self.alpha[0], self.alpha[1]))
+                modified_coords = True
+
+            if self.do_rotation and np.random.uniform() < self.p_rot_per_sample:
+                if np.random.uniform() <= self.p_rot_per_axis:
+                    coords = rotate_coords_2d(coords, np.random.uniform(self.angle_x[0], self.angle_x[1]))
+                modified_coords = True
+
+            if self.do_scale and np.random.uniform() < self.p_scale_per_sample:
+                if np.random.random() < 0.5 and self.scale[0] < 1:
+                    sc = np.random.uniform(self.scale[0], 1)
+                else:
+                    sc = np.random.uniform(max(self.scale[0], 1), self.scale[1])
+                coords = scale_coords(coords, sc)
+                modified_coords = True
+
+            if modified_coords:
+                for d in range(2):
+                    if self.random_crop:
+                        coords[d] += np.random.uniform(dist[d], data.shape[d + 2] - dist[d])
+                    else:
+                        coords[d] += data.shape[d + 2] / 2. - 0.5
+                for channel_id in range(data.shape[1]):
+                    data_result[sample_id, channel_id] = interpolate_img(
+                        data[sample_id, channel_id], coords, self.order_data, self.border_mode_data,
+                        cval=self.border_cval_data)
+                if seg is not None:
+                    for channel_id in range(seg.shape[1]):
+                        seg_result[sample_id, channel_id] = interpolate_img(
+                            seg[sample_id, channel_id], coords, self.order_seg, self.border_mode_seg,
+                            cval=self.border_cval_seg, is_seg=True, seg_tiebreak=self.seg_tiebreak)
+            else:
+                s = None if seg is None else seg[sample_id:sample_id + 1]
+                if self.random_crop:
+                    margin = [dist[d] - patch_size[d] // 2 for d in range(2)]
+                    d, s = random_crop_aug(data[sample_id:sample_id + 1], s, patch_size, margin)
+                else:
+                    d, s = center_crop_aug(data[sample_id:sample_id + 1], patch_size, s)
+                data_result[sample_id] = d[0]
+                if seg is not None:
+                    seg_result[sample_id] = s[0]
+
+        data_dict[self.data_key] = data_result
+        if seg is not None:
+            data_dict[self.label_key] = seg_result
+        return data_dict
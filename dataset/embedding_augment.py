@@ -0,0 +1,113 @@
+import torch
+import torch.nn.functional as F
+
+
+class EmbeddingAugmentation(object):
+    """
+    Augmentations of cached image embeddings emb [B, 256, 64, 64] and their labels [B, 1, H, W],
+    for decoder-only training (dataset/embedding_cache.py), where the image pipeline only runs
+    when the cache is built. Both cover the same field of view, so every spatial op is applied to
+    both in normalized coordinates: the embedding is resampled bilinearly and the label, at its
+    own resolution, with nearest neighbours. Every sample draws its own parameters:
+        flip        p=0.5, along the last axis
+        rot90       p=0.5, by 90, 180 or 270 degrees
+        affine      p=0.5, rotation U(-angle, angle) rad, scale U(scale) and shift U(-shift, shift)
+                    (fraction of the field), border padding
+        dropout     zeroes whole channels with probability feature_dropout, the rest are rescaled
+        mixup       with mixup_alpha > 0, the batch is blended with a permutation of itself by
+                    lam ~ Beta(alpha, alpha); labels cannot be blended, see mixup_loss
+    The encoder adds an absolute position embedding, so a flipped or rotated embedding is not
+    exactly the embedding of the flipped image; the decoder sees both during training and the
+    cached views (--cache_views) keep the real image-space augmentations.
+    """
+    def __init__(self, p_flip=0.5, p_rot90=0.5,
+                 p_affine=0.5, angle=(-0.1, 0.1), scale=(0.9, 1.1), shift=0.05,
+                 feature_dropout=0.1, mixup_alpha=0.):
+        self.p_flip = p_flip
+        self.p_rot90 = p_rot90
+        self.p_affine = p_affine
+        self.angle = angle
+        self.scale = scale
+        self.shift = shift
+        self.feature_dropout = feature_dropout
+        self.mixup_alpha = mixup_alpha
+
+    @staticmethod
+    def _uniform(b, low, high, device):
+        return torch.rand(b, device=device) * (high - low) + low
+
+    @staticmethod
+    def _coin(b, p, device):
+        return torch.rand(b, device=device) < p
+
+    def flip_rot90(self, emb, label):
+        b, device = emb.shape[0], emb.device
+        flip = self._coin(b, self.p_flip, device).view(b, 1, 1, 1)
+        emb = torch.where(flip, emb.flip(-1), emb)
+        label = torch.where(flip, label.flip(-1), label)
+
+        k = torch.randint(1, 4, (b,), device=device) * self._coin(b, self.p_rot90, device)
+        if emb.shape[-1] == emb.shape[-2] and label.shape[-1] == label.shape[-2]:
+            emb, label = emb.clone(), label.clone()
+            for turns in range(1, 4):
+                sel = k == turns
+                if sel.any():
+                    emb[sel] = torch.rot90(emb[sel], turns, (-2, -1))
+                    label[sel] = torch.rot90(label[sel], turns, (-2, -1))
+        return emb, label
+
+    def affine(self, emb, label):
+        b, device = emb.shape[0], emb.device
+        apply = self._coin(b, self.p_affine, device)
+        angle = self._uniform(b, self.angle[0], self.angle[1], device) * apply
+        scale = torch.where(apply, self._uniform(b, self.scale[0], self.scale[1], device), torch.ones(b, device=device))
+        shift = (torch.rand(b, 2, device=device) * 2 - 1) * self.shift * 2 * apply[:, None]
+        cos, sin = angle.cos() * scale, angle.sin() * scale
+        theta = torch.stack([torch.stack([cos, -sin, shift[:, 0]], 1),
+                             torch.stack([sin, cos, shift[:, 1]], 1)], 1)
+        # align_corners=False: [-1, 1] spans the same field for the 64x64 embedding and the label
+        grid = F.affine_grid(theta, list(emb.shape), align_corners=False)
+        emb = F.grid_sample(emb, grid, mode='bilinear', padding_mode='border', align_corners=False)
+        grid = F.affine_grid(theta, list(label.shape), align_corners=False)
+        label = F.grid_sample(label.float(), grid, mode='nearest', padding_mode='border',
+                              align_corners=False).to(label.dtype)
+        return emb, label
+
+    def dropout(self, emb):
+        if self.feature_dropout <= 0:
+            return emb
+        keep = (torch.rand(emb.shape[0], emb.shape[1], 1, 1, device=emb.device) >= self.feature_dropout)
+        return emb * keep / (1 - self.feature_dropout)
+
+    def mixup(self, emb):
+        """Returns the blended batch and (permutation, lam), or None without mixup."""
+        if self.mixup_alpha <= 0 or emb.shape[0] < 2:
+            return emb, None
+        lam = float(torch.distributions.Beta(self.mixup_alpha, self.mixup_alpha).sample())
+        perm = torch.randperm(emb.shape[0], device=emb.device)
+        return lam * emb + (1 - lam) * emb[perm], (perm, lam)
+
+    def __call__(self, emb, label):
+        with torch.no_grad():
+            emb, label = self.flip_rot90(emb, label)
+            emb, label = self.affine(emb, label)
+            emb = self.dropout(emb)
+            emb, mix = self.mixup(emb)
+        return emb, label, mix
+
+
+def mixup_loss(criterion, label, mix):
+    """criterion(label) for an unmixed batch, else the lam-weighted sum over both label sets."""
+    if mix is None:
+        return criterion(label)
+    perm, lam = mix
+    return lam * criterion(label) + (1 - lam) * criterion(label[perm])
+
+
+def get_embedding_augmentation(dataset, args):
+    """The EmbeddingAugmentation of a train EmbeddingCacheDataset if args.embedding_aug is set, else None."""
+    if not getattr(args, 'embedding_aug', False) or getattr(dataset, 'mode', None) != 'train' \
+            or not hasattr(dataset, 'cache'):
+        return None
+    return EmbeddingAugmentation(feature_dropout=getattr(args, 'feature_dropout', 0.1),
+                                 mixup_alpha=getattr(args, 'mixup_alpha', 0.))
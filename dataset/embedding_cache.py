@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import hashlib
+import numpy as np
+
+import torch
+from torch.utils.data.dataset import Dataset
+
+from dataset.transport import get_collate_fn, get_device_preprocess
+from dataset.utils import build_datasets, generate_loaders, rank_keys
+from dataset.volume_stream import VolumeStream
+from dataset.thread_loader import get_loader_class
+
+join = os.path.join
+
+
+def checkpoint_fingerprint(checkpoint, chunk_size=1 << 20):
+    """
+    Cheap identity of a SAM checkpoint: sha1 over the file size and its first and last MB.
+    Hashing the full 2.5GB vit_h file on every start-up would cost more than it saves.
+    """
+    size = os.path.getsize(checkpoint)
+    h = hashlib.sha1(str(size).encode())
+    with open(checkpoint, 'rb') as f:
+        h.update(f.read(chunk_size))
+        f.seek(max(size - chunk_size, 0))
+        h.update(f.read(chunk_size))
+    return h.hexdigest()[:16]
+
+
+class EmbeddingCache(object):
+    """
+    On-disk store of frozen image encoder outputs. Every slice of a dataset owns `views` rows
+    (row = view * num_slices + slice index) in two memory-mapped .npy files:
+        embeddings.npy  [views * num_slices, 256, G, G]    float16, G = encoder img_size / 16
+        labels.npy      [views * num_slices, 1, H, W]       uint8
+    With partial encoder fine-tuning (AutoSamSeg.embedding_block) the embeddings are the
+    [embed_dim, G, G] input of the first trained block instead. index.json records the slice paths
+    and patient keys in row order. It is written last, so an interrupted build is detected and redone.
+    With in_memory the embeddings are read into RAM instead of memory-mapped.
+    """
+    def __init__(self, cache_dir, in_memory=False):
+        self.cache_dir = cache_dir
+        with open(join(cache_dir, 'index.json'), 'r') as f:
+            index = json.load(f)
+        self.files = index['files']
+        self.keys = index['keys']
+        self.views = index['views']
+        self.embeddings = np.load(join(cache_dir, 'embeddings.npy'), mmap_mode=None if in_memory else 'r')
+        self.labels = np.load(join(cache_dir, 'labels.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.files)
+
+    def row(self, index, view=0):
+        return view * len(self.files) + index
+
+    @staticmethod
+    def is_complete(cache_dir):
+        return os.path.isfile(join(cache_dir, 'index.json'))
+
+    @staticmethod
+    def wait(cache_dir, poll=10):
+        """Block until another process has completed the cache, without a collective op that can time out."""
+        waited = 0
+        while not EmbeddingCache.is_complete(cache_dir):
+            if waited % 600 == 0:
+                print('waiting for the embedding cache %s' % cache_dir)
+            time.sleep(poll)
+            waited += poll
+
+
+def get_cache_dir(root, fingerprint, dataset, views):
+    # key the cache by encoder checkpoint and by the exact slice list / augmentation count
+    h = hashlib.sha1(json.dumps({'files': list(dataset.files), 'views': views, 'mode': dataset.mode,
+                                 'batch_aug': getattr(dataset, 'batch_aug', False),
+                                 'patch_size': list(dataset.patch_size)}).encode())
+    return join(root, fingerprint, dataset.mode + '_' + h.hexdigest()[:16])
+
+
+def build_embedding_cache(model, dataset, cache_dir, views, args):
+    """Run the image encoder of `model` once per slice and view, and store the result."""
+    if EmbeddingCache.is_complete(cache_dir):
+        return EmbeddingCache(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    device = next(model.parameters()).device
+    preprocess = get_device_preprocess(dataset, model.image_encoder.img_size)
+    num_slices = len(dataset)
+    loader = get_loader_class(args)(
+        dataset, batch_size=args.batch_size, shuffle=False,
+        num_workers=args.workers, pin_memory=True, drop_last=False,
+        collate_fn=get_collate_fn(dataset))
+    embeddings = None
+    labels = None
+
+    model.eval()
+    with torch.no_grad():
+        for view in range(views):
+            start = view * num_slices
+            for img, label in loader:
+                img = img.to(device, non_blocking=True)
+                if preprocess is not None:
+                    img, label = preprocess(img, label.to(device))
+                    label = label.cpu()
+                emb = model.encode(img.float(), getattr(model, 'embedding_block', None))
+                if embeddings is None:
+                    print('caching %.1f GB of embeddings in %s'
+                          % (views * num_slices * emb[0].numel() * 2 / 2 ** 30, cache_dir))
+                    embeddings = np.lib.format.open_memmap(
+                        join(cache_dir, 'embeddings.npy'), mode='w+', dtype=np.float16,
+                        shape=(views * num_slices,) + tuple(emb.shape[1:]))
+                    labels = np.lib.format.open_memmap(
+                        join(cache_dir, 'labels.npy'), mode='w+', dtype=np.uint8,
+                        shape=(views * num_slices,) + tuple(label.shape[1:]))
+                end = start + emb.shape[0]
+                embeddings[start:end] = emb.half().cpu().numpy()
+                labels[start:end] = label.numpy().astype(np.uint8)
+                start = end
+            print('cached view %d/%d of %s' % (view + 1, views, cache_dir))
+    embeddings.flush()
+    labels.flush()
+    del embeddings, labels
+
+    keys = [os.path.basename(os.path.dirname(f)).split("_frame")[0] for f in dataset.files]
+    # renamed into place, so that waiting ranks never read a partial index
+    tmp = join(cache_dir, 'index.json.%d.tmp' % os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump({'files': list(dataset.files), 'keys': keys, 'views': views}, f)
+    os.replace(tmp, join(cache_dir, 'index.json'))
+    return EmbeddingCache(cache_dir)
+
+
+class EmbeddingCacheDataset(Dataset):
+    """
+    Serves (image embedding, label) pairs from an EmbeddingCache. In train mode one of the cached
+    augmented views of a slice is drawn at random, so every epoch still sees different augmentations.
+    """
+    def __init__(self, cache, mode='train', keys=None):
+        super().__init__()
+        self.cache = cache
+        self.mode = mode
+        if keys is None:
+            self.indices = list(range(len(cache)))
+        else:
+            self.indices = [i for i, k in enumerate(cache.keys) if k in keys]
+        print(f'cached dataset length: {len(self.indices)}')
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        index = self.indices[index]
+        view = np.random.randint(self.cache.views) if self.mode == 'train' else 0
+        row = self.cache.row(index, view)
+        emb = np.array(self.cache.embeddings[row], dtype=np.float32)
+        label = np.array(self.cache.labels[row])
+        return emb, label
+
+
+def generate_embedding_dataset(model, args):
+    """
+    Counterpart of generate_dataset for decoder-only training: the image encoder runs once per
+    slice (args.cache_views augmented views for train, one exact view for val/test) and the loaders
+    return cached embeddings instead of images. With model.embedding_block set, only the frozen
+    encoder blocks before it are cached and the remaining blocks run in every step.
+    Under distributed training the caches are built by global rank 0 alone, so args.embedding_cache
+    has to be on a filesystem shared by all nodes; the other ranks poll for the finished index
+    instead of waiting in a barrier, which a long vit_h build could run past the process group timeout.
+    """
+    if getattr(args, 'resize_once', False):
+        # the cache stores labels at patch size in fixed-shape arrays
+        raise NotImplementedError("--embedding_cache does not support --resize_once")
+    if getattr(args, 'shard_dir', None):
+        raise NotImplementedError("--embedding_cache does not support --shard_dir")
+    model = getattr(model, 'module', model)
+    train_ds, val_ds, test_ds = build_datasets(args)
+    fingerprint = checkpoint_fingerprint(args.checkpoint)
+    if model.image_encoder.img_size != 1024:
+        fingerprint += '_%d' % model.image_encoder.img_size
+    if model.image_encoder.token_skip_threshold is not None:
+        fingerprint += '_skip%g' % model.image_encoder.token_skip_threshold
+    if getattr(model, 'embedding_block', None) is not None:
+        # partial fine-tuning: the input of the first trained encoder block is cached
+        fingerprint += '_block%d' % model.embedding_block
+
+    caches = []
+    for ds, views in ((train_ds, args.cache_views), (val_ds, 1), (test_ds, 1)):
+        cache_dir = get_cache_dir(args.embedding_cache, fingerprint, ds, views)
+        if not args.distributed or args.rank == 0:
+            build_embedding_cache(model, ds, cache_dir, views, args)
+        else:
+            EmbeddingCache.wait(cache_dir)
+        caches.append(cache_dir)
+
+    args.test_embedding_cache = caches[2]
+    in_memory = getattr(args, 'cache_in_memory', False)
+    sample_weights, num_samples = train_ds.sample_weights, train_ds.num_samples
+    train_ds = EmbeddingCacheDataset(EmbeddingCache(caches[0], in_memory), mode='train')
+    # cache rows follow the slice order of the image dataset, so its foreground weights carry over
+    train_ds.sample_weights, train_ds.num_samples = sample_weights, num_samples
+    val_ds = EmbeddingCacheDataset(EmbeddingCache(caches[1], in_memory), mode='val')
+    test_ds = EmbeddingCacheDataset(EmbeddingCache(caches[2], in_memory), mode='val')
+    return generate_loaders(train_ds, val_ds, test_ds, args)
+
+
+def generate_embedding_test_loader(key, args):
+    cache = EmbeddingCache(args.test_embedding_cache, getattr(args, 'cache_in_memory', False))
+    test_ds = EmbeddingCacheDataset(cache, mode='val', keys=[key])
+    if args.distributed:
+        test_sampler = torch.utils.data.distributed.DistributedSampler(test_ds)
+    else:
+        test_sampler = None
+
+    return get_loader_class(args, test=True)(
+        test_ds, batch_size=args.batch_size, shuffle=False,
+        num_workers=args.workers, pin_memory=True, sampler=test_sampler, drop_last=False
+    )
+
+
+def generate_embedding_volume_loader(args):
+    """VolumeStream over the cached test embeddings, the counterpart of generate_volume_test_loader."""
+    cache = EmbeddingCache(args.test_embedding_cache, getattr(args, 'cache_in_memory', False))
+    # cache rows are in patient order, so the rows of this rank's patients stay contiguous per patient
+    keys = sorted(set(cache.keys), key=cache.keys.index)
+    test_ds = EmbeddingCacheDataset(cache, mode='val', keys=set(rank_keys(keys, args)))
+    return VolumeStream(test_ds, [cache.keys[i] for i in test_ds.indices], args,
+                        loader_class=get_loader_class(args, test=True))
@@ -0,0 +1,208 @@
+import os
+import numpy as np
+from PIL import Image
+
+from dataset.packed import PackedVolumeStore, is_packed, label_path, read_slice
+from dataset.volume_store import VolumeStore, is_volume_dir
+from dataset.telemetry import timed
+
+join = os.path.join
+
+MANIFEST_VERSION = 3
+
+_manifests = {}
+
+
+class SliceManifest(object):
+    """
+    Index of all slices under a data_dir, held as flat numpy arrays:
+        folders         [F]     folder names (one patient, or one patient frame for ACDC)
+        keys            [F]     patient key of every folder, f.split("_frame")[0]
+        folder_offsets  [F + 1] first slice of every folder in the slice arrays
+        names           [N]     slice file names, sorted within their folder
+        shapes          [N, 2]  slice height and width
+        classes         [N, 32] packed bits, bit v is set if label value v occurs in the slice
+        fg_fraction     [N]     fraction of label pixels that are foreground (> 0)
+    Datasets keep an int64 index array into it instead of a Python list of paths, which keeps
+    DataLoader workers from touching (and copying on write) millions of string objects.
+
+    The manifest is stored next to data_dir as <data_dir>_manifest.npz and rebuilt when the
+    modification time of data_dir, of any folder in it or of its annotations changes. Within a
+    process it is built or loaded once per data_dir, however many datasets are constructed.
+    """
+    def __init__(self, data_dir, arrays):
+        self.data_dir = data_dir
+        self.folders = arrays['folders']
+        self.keys = arrays['keys']
+        self.folder_offsets = arrays['folder_offsets']
+        self.names = arrays['names']
+        self.shapes = arrays['shapes']
+        self.classes = arrays['classes']
+        self.fg_fraction = arrays['fg_fraction']
+        self.mtimes = arrays['mtimes']
+        self.folder_of_slice = np.repeat(np.arange(len(self.folders)), np.diff(self.folder_offsets))
+        self.store = open_store(data_dir)
+
+    def __len__(self):
+        return len(self.names)
+
+    def select(self, keys):
+        """Indices of all slices of the given patient keys, folder by folder."""
+        folders = np.nonzero(np.isin(self.keys, np.asarray(keys, dtype=str)))[0]
+        if len(folders) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([np.arange(self.folder_offsets[f], self.folder_offsets[f + 1])
+                               for f in folders]).astype(np.int64)
+
+    def patient_keys(self):
+        return sorted(set(self.keys.tolist()))
+
+    def folder(self, i):
+        return str(self.folders[self.folder_of_slice[i]])
+
+    def key(self, i):
+        return str(self.keys[self.folder_of_slice[i]])
+
+    def path(self, i):
+        return join(self.data_dir, self.folder(i), self.names[i].decode())
+
+    def class_presence(self, i):
+        return np.unpackbits(self.classes[i], axis=-1).astype(bool)
+
+    def read(self, i):
+        """Image and label arrays of slice i."""
+        if self.store is not None:
+            f = self.folder_of_slice[i]
+            with timed('open'):
+                return self.store.read_slice(str(self.folders[f]), int(i - self.folder_offsets[f]))
+        return read_slice(self.path(i))
+
+    def read_label(self, i):
+        """Label array of slice i, without decoding the image PNG."""
+        if self.store is not None:
+            return self.read(i)[1]
+        return np.asarray(Image.open(label_path(self.path(i))))
+
+
+class SliceList(object):
+    """Read-only sequence of slice paths for a subset of a manifest, built on access."""
+    def __init__(self, manifest, indices):
+        self.manifest = manifest
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        return self.manifest.path(self.indices[index])
+
+    def __iter__(self):
+        for i in self.indices:
+            yield self.manifest.path(i)
+
+
+def _manifest_file(data_dir):
+    return os.path.normpath(data_dir) + '_manifest.npz'
+
+
+def open_store(data_dir):
+    """Reader of a packed or volume data_dir; None for PNG slice folders, which are read with PIL."""
+    if is_packed(data_dir):
+        return PackedVolumeStore(data_dir)
+    if is_volume_dir(data_dir):
+        return VolumeStore(data_dir)
+    return None
+
+
+def _mtimes(data_dir):
+    if is_packed(data_dir):
+        return np.array([os.path.getmtime(join(data_dir, 'index.pkl'))])
+    if is_volume_dir(data_dir):
+        return np.array([os.path.getmtime(data_dir)] + [os.path.getmtime(p) for p in VolumeStore(data_dir).files()])
+    folders = sorted(f for f in os.listdir(data_dir) if os.path.isdir(join(data_dir, f)))
+    label_dir = label_path(os.path.normpath(data_dir))
+    mtimes = [os.path.getmtime(data_dir)]
+    for f in folders:
+        mtimes.append(os.path.getmtime(join(data_dir, f)))
+        if os.path.isdir(join(label_dir, f)):
+            mtimes.append(os.path.getmtime(join(label_dir, f)))
+    return np.array(mtimes)
+
+
+def _label_stats(label):
+    present = np.zeros(256, dtype=bool)
+    present[np.unique(label).astype(np.int64).clip(0, 255)] = True
+    return np.packbits(present), np.count_nonzero(label) / max(label.size, 1)
+
+
+def build_manifest(data_dir):
+    folders, names, shapes, classes, fg_fraction, offsets = [], [], [], [], [], [0]
+    store = open_store(data_dir)
+    if store is not None:
+        for folder in store.folders():
+            for i, name in enumerate(store.slice_names(folder)):
+                label = store.read_slice(folder, i)[1]
+                names.append(name)
+                shapes.append(label.shape[:2])
+                present, fg = _label_stats(label)
+                classes.append(present)
+                fg_fraction.append(fg)
+            folders.append(folder)
+            offsets.append(len(names))
+    else:
+        for folder in sorted(os.listdir(data_dir)):
+            if not os.path.isdir(join(data_dir, folder)):
+                continue
+            for name in sorted(os.listdir(join(data_dir, folder))):
+                path = join(data_dir, folder, name)
+                if not os.path.isfile(path):
+                    continue
+                label = np.asarray(Image.open(label_path(path)))
+                names.append(name)
+                shapes.append(label.shape[:2])
+                present, fg = _label_stats(label)
+                classes.append(present)
+                fg_fraction.append(fg)
+            folders.append(folder)
+            offsets.append(len(names))
+
+    return {
+        'version': np.array(MANIFEST_VERSION),
+        'folders': np.array(folders, dtype=str),
+        'keys': np.array([f.split("_frame")[0] for f in folders], dtype=str),
+        'folder_offsets': np.array(offsets, dtype=np.int64),
+        'names': np.array(names, dtype=bytes),
+        'shapes': np.array(shapes, dtype=np.int32).reshape(-1, 2),
+        'classes': np.array(classes, dtype=np.uint8).reshape(-1, 32),
+        'fg_fraction': np.array(fg_fraction, dtype=np.float32),
+    }
+
+
+def load_manifest(data_dir, rebuild=False):
+    """
+    Manifest of data_dir, from memory, from disk if still valid, or freshly built. rebuild=True forces
+    the latter, for writers that may have rewritten slices in place (which leaves folder mtimes alone).
+    """
+    if data_dir in _manifests and not rebuild:
+        return _manifests[data_dir]
+
+    mtimes = _mtimes(data_dir)
+
+    manifest_file = _manifest_file(data_dir)
+    arrays = None
+    if os.path.isfile(manifest_file) and not rebuild:
+        with np.load(manifest_file) as f:
+            if int(f['version']) == MANIFEST_VERSION and np.array_equal(f['mtimes'], mtimes):
+                arrays = dict(f)
+    if arrays is None:
+        print('building slice manifest of', data_dir)
+        arrays = build_manifest(data_dir)
+        arrays['mtimes'] = mtimes
+        try:
+            np.savez(manifest_file, **arrays)
+        except OSError:
+            print('could not write', manifest_file, '- keeping the manifest in memory')
+
+    manifest = SliceManifest(data_dir, arrays)
+    _manifests[data_dir] = manifest
+    return manifest
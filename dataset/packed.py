@@ -0,0 +1,97 @@
+import os
+import pickle
+import numpy as np
+from PIL import Image
+
+from dataset.telemetry import timed
+
+join = os.path.join
+
+INDEX_FILE = 'index.pkl'
+
+
+def is_packed(data_dir):
+    return data_dir is not None and os.path.isfile(join(data_dir, INDEX_FILE))
+
+
+class PackedVolumeStore(object):
+    """
+    Reader for the packed layout written by dataset/prepare_dataset/convert_to_imgs.py::pack_imgs_to_volumes.
+    Every folder of imgs/ (one patient, or one patient frame for ACDC) is stored as two flat arrays,
+        <folder>_img.npy    all image slices, raveled and concatenated (uint8 or int16)
+        <folder>_label.npy  all label slices, raveled and concatenated (uint8)
+    and index.pkl holds, per folder, the slice names, their shapes and their offsets into both arrays.
+
+    Slices are addressed with the same paths the PNG layout uses (<data_dir>/<folder>/<name>.png), so the
+    datasets can swap one layout for the other. The arrays are opened with np.memmap lazily, i.e. in each
+    DataLoader worker, and a slice read is a reshape of a view without any decoding.
+    """
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        with open(join(data_dir, INDEX_FILE), 'rb') as f:
+            self.index = pickle.load(f)
+        self._arrays = {}
+
+    def folders(self):
+        return list(self.index.keys())
+
+    def slice_names(self, folder):
+        return list(self.index[folder]['names'])
+
+    def subfiles(self, folder):
+        return [join(self.data_dir, folder, name) for name in self.index[folder]['names']]
+
+    def _open(self, folder):
+        if folder not in self._arrays:
+            self._arrays[folder] = (np.load(join(self.data_dir, folder + '_img.npy'), mmap_mode='r'),
+                                    np.load(join(self.data_dir, folder + '_label.npy'), mmap_mode='r'))
+        return self._arrays[folder]
+
+    def read_slice(self, folder, i):
+        """Image and label of the i-th slice of folder, as views into the memory-mapped arrays."""
+        entry = self.index[folder]
+        images, labels = self._open(folder)
+        img_shape = entry['img_shapes'][i]
+        label_shape = entry['label_shapes'][i]
+        img_offset = entry['img_offsets'][i]
+        label_offset = entry['label_offsets'][i]
+        img = images[img_offset:img_offset + int(np.prod(img_shape))].reshape(img_shape)
+        label = labels[label_offset:label_offset + int(np.prod(label_shape))].reshape(label_shape)
+        return img, label
+
+    def read(self, path):
+        folder = os.path.basename(os.path.dirname(path))
+        return self.read_slice(folder, self.index[folder]['names'].index(os.path.basename(path)))
+
+    def __getstate__(self):
+        # memmaps are reopened in every worker instead of being pickled
+        state = self.__dict__.copy()
+        state['_arrays'] = {}
+        return state
+
+
+def label_path(path):
+    """
+    Label path of an image slice (or folder) of the PNG layout: the last path component named imgs becomes
+    annotations, so that e.g. /data/Synapse_imgs/imgs/case/0.png keeps Synapse_imgs. Paths without such a
+    component fall back to replacing the last occurrence of imgs.
+    """
+    parts = path.split('/')
+    for i in range(len(parts) - 1, -1, -1):
+        if parts[i] == 'imgs':
+            parts[i] = 'annotations'
+            return '/'.join(parts)
+    head, sep, tail = path.rpartition('imgs')
+    return head + 'annotations' + tail if sep else path
+
+
+def read_slice(path, store=None):
+    """Image and label arrays of one slice, from the packed store or from the imgs/annotations PNGs."""
+    if store is not None:
+        with timed('open'):
+            return store.read(path)
+    with timed('open'):
+        img = Image.open(path)
+        label = Image.open(label_path(path))
+    with timed('decode'):
+        return np.asarray(img), np.asarray(label)
@@ -0,0 +1,106 @@
+import queue
+import threading
+
+import torch
+
+
+class _Failure(object):
+    def __init__(self, error):
+        self.error = error
+
+
+_END = object()
+
+
+class DevicePrefetcher(object):
+    """
+    Iterates a loader with the next batches staged while the caller computes on the current one.
+
+    A background thread takes batches from the loader and, for the first two items (img, label):
+    copies them to device (pinning them first if the loader did not) on a side CUDA stream, runs
+    preprocess (e.g. the DevicePreprocess of the uint8 transport) and casts img to float and label to
+    long. Up to depth staged batches wait in a queue, so with depth=2 the copy of batch N + 1 runs
+    while the model works on batch N. Further items of a batch, such as the segments of a
+    VolumeStream, are passed through. The consumer's stream waits on an event recorded after the
+    staging, so no synchronization of the whole device is needed.
+
+    With device=None (CPU-only hosts) the thread does the same minus the copy, so the casts and
+    device preprocessing overlap the model step; torch ops release the GIL.
+    """
+    def __init__(self, loader, device=None, preprocess=None, depth=2):
+        self.loader = loader
+        self.dataset = getattr(loader, 'dataset', None)
+        if isinstance(device, int):
+            device = torch.device('cuda', device)
+        self.device = device
+        self.cuda = device is not None and torch.device(device).type == 'cuda'
+        self.preprocess = preprocess
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _convert(self, img, label):
+        with torch.no_grad():
+            if self.preprocess is not None:
+                img, label = self.preprocess(img, label)
+            return img.float(), label.long()
+
+    def _stage(self, batch, stream):
+        img, label, rest = batch[0], batch[1], tuple(batch[2:])
+        if not self.cuda:
+            if self.device is not None:
+                img, label = img.to(self.device), label.to(self.device)
+            return self._convert(img, label) + rest, None
+        with torch.cuda.stream(stream):
+            if not img.is_pinned():
+                img, label = img.pin_memory(), label.pin_memory()
+            img = img.to(self.device, non_blocking=True)
+            label = label.to(self.device, non_blocking=True)
+            img, label = self._convert(img, label)
+            event = torch.cuda.Event()
+            event.record(stream)
+        return (img, label) + rest, event
+
+    def _put(self, q, stop, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, q, stop):
+        stream = torch.cuda.Stream(self.device) if self.cuda else None
+        try:
+            for batch in self.loader:
+                if not self._put(q, stop, self._stage(batch, stream)):
+                    return
+        except Exception as e:
+            self._put(q, stop, _Failure(e))
+        self._put(q, stop, _END)
+
+    def __iter__(self):
+        q = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(q, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = q.get()
+                if item is _END:
+                    return
+                if isinstance(item, _Failure):
+                    raise item.error
+                batch, event = item
+                if event is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(event)
+                    # the tensors were allocated on the side stream and are now used on this one
+                    for t in batch[:2]:
+                        t.record_stream(current)
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
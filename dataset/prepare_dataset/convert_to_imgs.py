@@ -1,10 +1,17 @@
 import numpy as np
 import os
+import json
+import pickle
 import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from PIL import Image
 from medpy.io import load
 import SimpleITK as sitk
 import nrrd
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from dataset.manifest import load_manifest
 
 join = os.path.join
 
@@ -13,256 +20,303 @@ def read_nii(path):
     return sitk.GetArrayFromImage(sitk.ReadImage(path))
 
 
-def convert_volume_to_imgs(data_dir, output_dir):
-    img_dir = join(output_dir, 'imgs')
-    label_dir = join(output_dir, 'annotations')
-
-    files_list = os.listdir(data_dir)
-    for f in files_list:
-        f = f.split(".")[0]
-
-        target_img_dir = join(img_dir, f)
-        target_label_dir = join(label_dir, f)
-        if not os.path.exists(target_img_dir):
-            os.makedirs(join(target_img_dir))
-            os.makedirs(join(target_label_dir))
-            print('Created' + target_img_dir + '...')
-
-        data = np.load(os.path.join(data_dir, f + ".npy"))
-
-        image = data[:, 0]
-        label = data[:, 1]
-
-        for i in range(image.shape[0]):
-            img_array = (image[i] - image.min()) / (image.max() - image.min())
-            img_array = np.clip(img_array * 127.5, 0, 255).astype('uint8')
-            label_array = label[i].astype('uint8')
-            if i < 10:
-                save_files = f + "_00" + str(i) + ".png"
-            elif 10 <= i < 100:
-                save_files = f + "_0" + str(i) + ".png"
+def quantize(img_array, scale, bits=8):
+    '''
+    Image normalized to [0, 1], times scale (out of 255), as uint8; bits=16 stores it as uint16 with the
+    same relative scale, which keeps 257x more of the CT/MR dynamic range.
+    '''
+    if bits == 16:
+        return np.clip(img_array * scale * 257, 0, 65535).astype('uint16')
+    return np.clip(img_array * scale, 0, 255).astype('uint8')
+
+
+def save_img(img_array, path, rgb=False, size=None):
+    '''
+    Save one image slice. Grayscale slices are stored as a single channel 8 or 16 bit PNG (following
+    the dtype of img_array); the datasets broadcast them to RGB only when they reach the SAM encoder.
+    rgb=True writes the old triplicated 3-channel PNGs.
+    '''
+    im = Image.fromarray(img_array)
+    if rgb:
+        assert img_array.dtype == np.uint8, '16 bit slices cannot be stored as RGB'
+        im = im.convert('RGB')
+    if size is not None:
+        im = im.resize(size)
+    im.save(path)
+
+
+def index_slices(img_dir, slice_threshold=0.05, rebuild=True):
+    '''
+    Build the slice manifest of a converted imgs/ folder (dataset/manifest.py) right away, with the
+    per-slice foreground fraction that --slice_sampling reads, so that training starts from it.
+    '''
+    try:
+        manifest = load_manifest(img_dir, rebuild)
+    except FileNotFoundError as e:
+        print('could not index %s (%s), run check_difference_imgs_annotations first' % (img_dir, e))
+        return
+    print('indexed %d slices of %s, %d with foreground fraction below %.3f'
+          % (len(manifest), img_dir, int((manifest.fg_fraction < slice_threshold).sum()), slice_threshold))
+
+
+def slice_file(prefix, i):
+    return prefix + "_%03d.png" % i
+
+
+def normalize_volume(image):
+    '''Min-max normalize a whole volume (or a single frame) to [0, 1] in one vectorized pass.'''
+    image = np.asarray(image, dtype=np.float32)
+    lo, hi = image.min(), image.max()
+    if hi == lo:
+        return np.zeros_like(image)
+    return (image - lo) / (hi - lo)
+
+
+def pair_folder(img_folder, label_folder):
+    '''
+    Delete the PNGs of img_folder without a label in label_folder and vice versa. Returns the names
+    of the paired slices and the deleted paths.
+    '''
+    imgs = set(os.listdir(img_folder)) if os.path.isdir(img_folder) else set()
+    labels = set(os.listdir(label_folder)) if os.path.isdir(label_folder) else set()
+    deleted = []
+    for folder, names in ((img_folder, imgs - labels), (label_folder, labels - imgs)):
+        for name in sorted(names):
+            if name.endswith('.png'):
+                os.remove(join(folder, name))
+                deleted.append(join(folder, name))
+    return sorted(n for n in imgs & labels if n.endswith('.png')), deleted
+
+
+def write_volume(image, label, output_dir, folder, prefix, scale, bits, rgb, skip_empty=False, size=None):
+    '''
+    Write the slices of a normalized volume [D, H, W] and of its label volume as PNGs under
+    output_dir/imgs/folder and output_dir/annotations/folder; the volume is quantized in one call.
+    '''
+    target_img_dir = join(output_dir, 'imgs', folder)
+    target_label_dir = join(output_dir, 'annotations', folder)
+    os.makedirs(target_img_dir, exist_ok=True)
+    os.makedirs(target_label_dir, exist_ok=True)
+
+    image = quantize(image, scale, bits)
+    label = label.astype('uint8')
+    for i in range(image.shape[0]):
+        if skip_empty and not label[i].any():
+            continue
+        save_files = slice_file(prefix, i)
+        save_img(image[i], join(target_img_dir, save_files), rgb, size=size)
+        lb = Image.fromarray(label[i])
+        if size is not None:
+            lb = lb.resize(size)
+        lb.save(join(target_label_dir, save_files))
+
+
+def _finish(output_dir, folders):
+    '''Pairing check of the folders a task wrote; returns ({folder: paired names}, deleted paths).'''
+    produced, deleted = {}, []
+    for folder in folders:
+        names, removed = pair_folder(join(output_dir, 'imgs', folder), join(output_dir, 'annotations', folder))
+        produced[folder] = names
+        deleted += removed
+    return produced, deleted
+
+
+def _convert_volume_patient(path, output_dir, f, bits, rgb):
+    data = np.load(path)
+    write_volume(normalize_volume(data[:, 0]), data[:, 1], output_dir, f, f, 127.5, bits, rgb)
+    return _finish(output_dir, [f])
+
+
+def _convert_npz_patient(path, output_dir, f, bits, rgb):
+    data = np.load(path)["data"]
+    label = data[4]
+    label[label < 0] = 0
+    write_volume(normalize_volume(data[0]), label, output_dir, f, f, 127.5, bits, rgb,
+                 skip_empty=True, size=(256, 256))
+    return _finish(output_dir, [f])
+
+
+def _convert_nii_patient(path, label_path, output_dir, f, bits, rgb):
+    label = read_nii(label_path)
+    label[label < 0] = 0
+    write_volume(normalize_volume(read_nii(path)), label, output_dir, f, f, 127.5, bits, rgb, skip_empty=True)
+    return _finish(output_dir, [f])
+
+
+def _convert_acdc_patient(patient_dir, output_dir, frames, bits, rgb):
+    folders = []
+    for f in frames:
+        modified_f = f.replace('patient', 'patient_').replace('frame', 'frame_')
+        frame_and_after = 'frame' + modified_f.split('frame', 1)[-1].lstrip('0')
+        image = normalize_volume(read_nii(join(patient_dir, f + ".nii.gz")))
+        label = read_nii(join(patient_dir, f + "_gt.nii.gz"))
+        write_volume(image, label, output_dir, modified_f, frame_and_after, 255, bits, rgb)   # 映射到0到255
+        folders.append(modified_f)
+    return _finish(output_dir, folders)
+
+
+def _convert_nrrd_patient(patient_dir, output_dir, ppl, bits, rgb):
+    patient_name = 'patient_%03d' % int(ppl)
+    target_img_dir = join(output_dir, 'imgs', ppl)
+    target_label_dir = join(output_dir, 'annotations', ppl)
+    os.makedirs(target_img_dir, exist_ok=True)
+    os.makedirs(target_label_dir, exist_ok=True)
+    for folder in os.listdir(patient_dir):   # ['原图nrrd文件', '标注文件'] 但是名字不太统一
+        for f in os.listdir(join(patient_dir, folder)):
+            if f.split(".")[-1] != 'nrrd':  # 所有nrrd结尾的文件
+                continue
+            f = f.split(".")[0]
+            save_files = patient_name + '_frame_%03d.png' % int(f.split("_")[-1])
+            if "Segmentation" in f:
+                # 处理annotations(label)文件
+                label, header = nrrd.read(join(patient_dir, folder, f + ".seg.nrrd"))    # Data Shape: (1120, 1120, 1)
+                label_array = label[:, :, 0].transpose(1, 0).astype('uint8') * 255
+                Image.fromarray(label_array).save(join(target_label_dir, save_files))
             else:
-                save_files = f + "_" + str(i) + ".png"
-
-            im = Image.fromarray(img_array)
-            new_p = im.convert('RGB')
-            new_p.save(join(target_img_dir, save_files))
-
-            lb = Image.fromarray(label_array)
-            lb.save(join(target_label_dir, save_files))
-
-        print("finishing saving", f)
-
-
-def convert_npz_to_imgs(data_dir, output_dir):
-    img_dir = join(output_dir, 'imgs')
-    label_dir = join(output_dir, 'annotations')
-
-    files_list = os.listdir(data_dir)
-    for f in files_list:
+                # 处理imgs文件
+                image, header = nrrd.read(join(patient_dir, folder, f + ".nrrd"))  # Data Shape: (3, 1120, 1120, 1)
+                if len(image.shape) == 4:
+                    image = image[:, :, :, 0].transpose(2, 1, 0)  # Data Shape: (1120, 1120, 3)
+                else:
+                    image = image[:, :, 0]
+                    image[image == 32767] = 2168
+                    image = image.transpose(1, 0)
+                img_array = normalize_volume(image)
+                # true colour (3 channel) frames stay 8 bit RGB, grayscale ones follow bits / rgb
+                color = img_array.ndim == 3
+                img_array = quantize(img_array, 255, 8 if color else bits)   # 映射到0到255
+                save_img(img_array, join(target_img_dir, save_files), rgb or color)
+    return _finish(output_dir, [ppl])
+
+
+def _up_to_date(entry, inputs, output_dir):
+    '''A patient is skipped if it was converted before and all files it produced are newer than its inputs.'''
+    if entry is None or sorted(entry['inputs']) != sorted(inputs):
+        return False
+    outputs = [join(output_dir, sub, folder, name) for folder, names in entry['folders'].items()
+               for name in names for sub in ('imgs', 'annotations')]
+    if not all(os.path.isfile(o) for o in outputs):
+        return False
+    newest_input = max([os.path.getmtime(p) for p in inputs] + [0])
+    oldest_output = min([os.path.getmtime(o) for o in outputs] + [entry['time']])
+    return newest_input < oldest_output
+
+
+def run_conversion(output_dir, tasks, workers=None):
+    '''
+    Convert one patient per task on a process pool. tasks are (key, inputs, fn, kwargs), and fn(**kwargs)
+    writes the slices of the patient and returns ({folder: paired slice names}, deleted unpaired paths).
+
+    What each patient produced is recorded in output_dir/conversion.json, rewritten after every task,
+    and patients whose outputs are all newer than their input files are skipped on the next run.
+    Unpaired slices are removed and listed in deleted_files.txt (as check_difference_imgs_annotations
+    does), and the slice manifest of output_dir/imgs is built at the end.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    record_file = join(output_dir, 'conversion.json')
+    record = {}
+    if os.path.isfile(record_file):
+        with open(record_file, 'r') as f:
+            record = json.load(f)
+
+    todo = [t for t in tasks if not _up_to_date(record.get(t[0]), t[1], output_dir)]
+    print('converting %d of %d patients, %d up to date' % (len(todo), len(tasks), len(tasks) - len(todo)))
+    deleted_files_list = []
+    with ProcessPoolExecutor(workers) as pool:
+        futures = {pool.submit(fn, **kwargs): (key, inputs) for key, inputs, fn, kwargs in todo}
+        for future in as_completed(futures):
+            key, inputs = futures[future]
+            folders, deleted = future.result()
+            record[key] = {'inputs': inputs, 'folders': folders, 'time': time.time()}
+            deleted_files_list += deleted
+            with open(record_file + '.tmp', 'w') as f:
+                json.dump(record, f)
+            os.replace(record_file + '.tmp', record_file)
+            print("finishing saving", key)
+
+    if deleted_files_list:
+        txt_file_path = join(output_dir, 'deleted_files.txt')
+        with open(txt_file_path, 'w') as file:
+            for file_path in deleted_files_list:
+                file.write(f"{file_path}\n")
+        print(f"Deleted {len(deleted_files_list)} unpaired slices, paths saved to: {txt_file_path}")
+    index_slices(join(output_dir, 'imgs'), rebuild=len(todo) > 0)
+
+
+def convert_volume_to_imgs(data_dir, output_dir, bits=8, rgb=False, workers=None):
+    tasks = []
+    for f in sorted(os.listdir(data_dir)):
         f = f.split(".")[0]
+        path = join(data_dir, f + ".npy")
+        tasks.append((f, [path], _convert_volume_patient,
+                      dict(path=path, output_dir=output_dir, f=f, bits=bits, rgb=rgb)))
+    run_conversion(output_dir, tasks, workers)
 
-        target_img_dir = join(img_dir, f)
-        target_label_dir = join(label_dir, f)
-        if not os.path.exists(target_img_dir):
-            os.makedirs(join(target_img_dir))
-            os.makedirs(join(target_label_dir))
-            print('Created' + target_img_dir + '...')
-
-        data = np.load(os.path.join(data_dir, f + ".npz"))["data"]
-        print(data.shape)
-
-        image = data[0]
-        label = data[4]
-        label[label < 0] = 0
-
-        for i in range(image.shape[0]):
-            img_array = (image[i] - image.min()) / (image.max() - image.min())
-            img_array = np.clip(img_array * 127.5, 0, 255).astype('uint8')
-            label_array = label[i].astype('uint8')
-
-            if np.sum(label_array) == 0: continue
-            if i < 10:
-                save_files = f + "_00" + str(i) + ".png"
-            elif 10 <= i < 100:
-                save_files = f + "_0" + str(i) + ".png"
-            else:
-                save_files = f + "_" + str(i) + ".png"
-
-            im = Image.fromarray(img_array)
-            new_p = im.convert('RGB')
-            new_p = new_p.resize((256, 256))
-            new_p.save(join(target_img_dir, save_files))
-
-            lb = Image.fromarray(label_array)
-            lb = lb.resize((256, 256))
-            lb.save(join(target_label_dir, save_files))
-
-        print("finishing saving", f)
 
+def convert_npz_to_imgs(data_dir, output_dir, bits=8, rgb=False, workers=None):
+    tasks = []
+    for f in sorted(os.listdir(data_dir)):
+        f = f.split(".")[0]
+        path = join(data_dir, f + ".npz")
+        tasks.append((f, [path], _convert_npz_patient,
+                      dict(path=path, output_dir=output_dir, f=f, bits=bits, rgb=rgb)))
+    run_conversion(output_dir, tasks, workers)
 
-def convert_nii_to_imgs(data_dir, output_dir):
-    img_dir = join(output_dir, 'imgs')
-    label_dir = join(output_dir, 'annotations')
 
+def convert_nii_to_imgs(data_dir, output_dir, bits=8, rgb=False, workers=None):
     files_list = sorted(os.listdir(data_dir))
     src_label_dir = data_dir.replace("imagesTr", "labelsTr")
     label_list = sorted(os.listdir(src_label_dir))
+    tasks = []
     for f, label_f in zip(files_list, label_list):
         f = f.split(".")[0]
+        path, label_path = join(data_dir, f + ".nii.gz"), join(src_label_dir, label_f)
+        tasks.append((f, [path, label_path], _convert_nii_patient,
+                      dict(path=path, label_path=label_path, output_dir=output_dir, f=f, bits=bits, rgb=rgb)))
+    run_conversion(output_dir, tasks, workers)
 
-        target_img_dir = join(img_dir, f)
-        target_label_dir = join(label_dir, f)
-        if not os.path.exists(target_img_dir):
-            os.makedirs(join(target_img_dir))
-            os.makedirs(join(target_label_dir))
-            print('Created' + target_img_dir + '...')
-
-        image = read_nii(join(data_dir, f + ".nii.gz"))
-        label = read_nii(join(src_label_dir, label_f))
-        label[label < 0] = 0
-
-        for i in range(image.shape[0]):
-            img_array = (image[i] - image.min()) / (image.max() - image.min())
-            img_array = np.clip(img_array * 127.5, 0, 255).astype('uint8')
-            label_array = label[i].astype('uint8')
-            if np.sum(label_array) == 0: continue
-            if i < 10:
-                save_files = f + "_00" + str(i) + ".png"
-            elif 10 <= i < 100:
-                save_files = f + "_0" + str(i) + ".png"
-            else:
-                save_files = f + "_" + str(i) + ".png"
-
-            im = Image.fromarray(img_array)
-            new_p = im.convert('RGB')
-            new_p.save(join(target_img_dir, save_files))
 
-            lb = Image.fromarray(label_array)
-            lb.save(join(target_label_dir, save_files))
-
-        print("finishing saving", f)
-
-
-def convert_acdc_to_imgs(data_dir, output_dir):
+def convert_acdc_to_imgs(data_dir, output_dir, bits=8, rgb=False, workers=None):
     '''Mancy 修改，可以直接操作acdc原始数据库'''
-    img_dir = join(output_dir, 'imgs')
-    label_dir = join(output_dir, 'annotations')
-
-    patient_list = os.listdir(data_dir)
-    patient_list = patient_list[:2]
-    for ppl in patient_list:
-        print(ppl)
-        files_list = os.listdir(join(data_dir, ppl))
-        for f in files_list:
-            f = f.split(".")[0]
-            if ("frame" in f) and ("gt" not in f):
-                modified_f = f.replace('patient', 'patient_').replace('frame', 'frame_')
-                frame_and_after = 'frame'+ modified_f.split('frame', 1)[-1].lstrip('0')
-                target_img_dir = join(img_dir, modified_f)
-                target_label_dir = join(label_dir, modified_f)
-                if not os.path.exists(target_img_dir):
-                    os.makedirs(join(target_img_dir))
-                    os.makedirs(join(target_label_dir))
-                    print('Created' + target_img_dir + '...')
-
-                # data = np.load(os.path.join(data_dir, ppl, f + ".npy"))
-                image = read_nii(join(data_dir, ppl, f + ".nii.gz"))
-                label = read_nii(join(data_dir, ppl, f + "_gt.nii.gz"))
-                print(image.shape)
-                for i in range(image.shape[0]):
-                    img_array = (image[i] - image.min()) / (image.max() - image.min())
-                    img_array = np.clip(img_array * 255, 0, 255).astype('uint8')   # 映射到0到255
-                    print(img_array.shape)
-                    label_array = label[i].astype('uint8')
-                    # print(np.unique(img_array))
-                    # print(np.unique(label_array))
-                    if i < 10:
-                        save_files = frame_and_after + "_00" + str(i) + ".png"
-                    elif 10 <= i < 100:
-                        save_files = frame_and_after + "_0" + str(i) + ".png"
-                    else:
-                        save_files = frame_and_after + "_" + str(i) + ".png"
-
-                    im = Image.fromarray(img_array)
-                    new_p = im.convert('RGB')
-                    new_p.save(join(target_img_dir, save_files))
-
-                    lb = Image.fromarray(label_array)
-                    lb.save(join(target_label_dir, save_files))
-
-                print("finishing saving", f)
-
-def convert_nrrd_to_imgs(data_dir, output_dir):
+    tasks = []
+    for ppl in sorted(os.listdir(data_dir)):
+        patient_dir = join(data_dir, ppl)
+        if not os.path.isdir(patient_dir):
+            continue
+        frames = sorted(f.split(".")[0] for f in os.listdir(patient_dir) if ("frame" in f) and ("gt" not in f))
+        inputs = [join(patient_dir, f + suffix) for f in frames for suffix in (".nii.gz", "_gt.nii.gz")]
+        tasks.append((ppl, inputs, _convert_acdc_patient,
+                      dict(patient_dir=patient_dir, output_dir=output_dir, frames=frames, bits=bits, rgb=rgb)))
+    run_conversion(output_dir, tasks, workers)
+
+
+def convert_nrrd_to_imgs(data_dir, output_dir, bits=8, rgb=False, workers=None):
     '''(适用于李萍老师的CTA数据集）load nrrd files and convert to png images'''
-    img_dir = join(output_dir, 'imgs')
-    label_dir = join(output_dir, 'annotations')
     patient_list = os.listdir(data_dir)
     patient_list.sort(key=lambda x: int(x)) # 按照序数排列
-    # patient_list = patient_list[12:14]  # debug
+    tasks = []
     for ppl in patient_list:
-        print(ppl)
-        if int(ppl) < 10:
-            patient_name = 'patient'+ "_00" + ppl
-        elif 10 <= int(ppl) < 100:
-            patient_name = 'patient' + "_0" + ppl 
-        else:
-            patient_name = 'patient' + "_" + ppl 
-        subfolders_list = os.listdir(join(data_dir, ppl))   # ['原图nrrd文件', '标注文件'] 但是名字不太统一
-        target_img_dir = join(img_dir, ppl)
-        target_label_dir = join(label_dir, ppl)
-        if not os.path.exists(target_img_dir):
-            os.makedirs(join(target_img_dir))
-            os.makedirs(join(target_label_dir))
-            print('Created' + target_img_dir + '...')
-            print('Created' + target_label_dir + '...')
-        for folder in subfolders_list:
-            files_list = os.listdir(join(data_dir, ppl, folder))
-            for f in files_list:
-                if f.split(".")[-1] == 'nrrd':  # 所有nrrd结尾的文件
-                    f = f.split(".")[0]
-                    if "Segmentation" in f:
-                        '''处理annotations(label)文件'''
-                        # data = np.load(os.path.join(data_dir, ppl, f + ".npy"))
-                        label,header = nrrd.read(join(data_dir, ppl, folder, f + ".seg.nrrd"))    # Data Shape: (1120, 1120, 1)
-                        label_array = label[:,:,0].transpose(1,0).astype('uint8')*255
-                            # print(np.unique(img_array))
-                        # print(np.unique(label_array))
-                        frame = f.split("_")[-1]
-                        if int(frame) < 10:
-                            frame_name = 'frame' + "_00" + frame
-                        elif 10 <= int(frame) < 100:
-                            frame_name = 'frame' + "_0" + frame
-                        else:
-                            frame_name = 'frame' + "_" + frame
-                        save_files = patient_name +'_'+ frame_name + ".png"
-                        lb = Image.fromarray(label_array)
-                        lb.save(join(target_label_dir, save_files))
-                    else:
-                        '''处理imgs文件'''
-                        image,header = nrrd.read(join(data_dir, ppl, folder, f + ".nrrd"))  # Data Shape: (3, 1120, 1120, 1)
-                        if len(image.shape) == 4:
-                            image = image[:,:,:,0].transpose(2, 1, 0)  # Data Shape: (1120, 1120, 3)
-                        else:
-                            image = image[:,:,0]
-                            image[image == 32767] = 2168
-                            image = image.transpose(1,0).astype(np.float64)
-                        img_array = (image - image.min()) / (image.max() - image.min())
-                        img_array = np.clip(img_array * 255, 0, 255).astype('uint8')   # 映射到0到255
-                        # print(np.unique(img_array))
-                        frame = f.split("_")[-1]
-                        if int(frame) < 10:
-                            frame_name = 'frame' + "_00" + frame
-                        elif 10 <= int(frame) < 100:
-                            frame_name = 'frame' + "_0" + frame
-                        else:
-                            frame_name = 'frame' + "_" + frame
-                        save_files = patient_name + '_'+frame_name + ".png"
-                        im = Image.fromarray(img_array)
-                        new_p = im.convert('RGB')
-                        new_p.save(join(target_img_dir, save_files))
-                    
-                    print("finishing saving", f)
+        patient_dir = join(data_dir, ppl)
+        inputs = [join(patient_dir, folder, f) for folder in sorted(os.listdir(patient_dir))
+                  for f in sorted(os.listdir(join(patient_dir, folder))) if f.split(".")[-1] == 'nrrd']
+        tasks.append((ppl, inputs, _convert_nrrd_patient,
+                      dict(patient_dir=patient_dir, output_dir=output_dir, ppl=ppl, bits=bits, rgb=rgb)))
+    run_conversion(output_dir, tasks, workers)
+
+
+def rgb_imgs_to_single_channel(root_folder):
+    '''Rewrite the triplicated grayscale RGB PNGs under root_folder/imgs as single channel PNGs, in place.'''
+    imgs_folder = join(root_folder, 'imgs')
+    for folder in sorted(os.listdir(imgs_folder)):
+        if not os.path.isdir(join(imgs_folder, folder)):
+            continue
+        for name in sorted(os.listdir(join(imgs_folder, folder))):
+            path = join(imgs_folder, folder, name)
+            img_array = np.asarray(Image.open(path))
+            if img_array.ndim == 3 and (img_array == img_array[..., :1]).all():
+                save_img(img_array[..., 0], path)
+        print("finishing converting", folder)
+
 
 def check_difference_imgs_annotations(root_folder):
     # 用于保存删除文件路径的列表
@@ -275,30 +329,11 @@ def check_difference_imgs_annotations(root_folder):
     annotations_subfolders = [subfolder for subfolder in os.listdir(annotations_folder) if os.path.isdir(os.path.join(annotations_folder, subfolder))]
 
     for subfolder in imgs_subfolders:
-        imgs_subfolder_path = os.path.join(imgs_folder, subfolder)
-        annotations_subfolder_path = os.path.join(annotations_folder, subfolder)
-
-        imgs_files = set(os.listdir(imgs_subfolder_path))
-        annotations_files = set(os.listdir(annotations_subfolder_path))
-
-        # 找出imgs和annotations文件夹中不共有的图片
-        unique_imgs = imgs_files.difference(annotations_files)
-        unique_annotations = annotations_files.difference(imgs_files)
-
-        # 删除不共有的图片，并记录文件路径
-        for filename in unique_imgs:
-            if filename.endswith('.png'):
-                file_path = os.path.join(imgs_subfolder_path, filename)
-                os.remove(file_path)
-                deleted_files_list.append(file_path)
-                print(f"Deleted: {file_path}")
-
-        for filename in unique_annotations:
-            if filename.endswith('.png'):
-                file_path = os.path.join(annotations_subfolder_path, filename)
-                os.remove(file_path)
-                deleted_files_list.append(file_path)
-                print(f"Deleted: {file_path}")
+        # 删除imgs和annotations文件夹中不共有的图片，并记录文件路径
+        _, deleted = pair_folder(os.path.join(imgs_folder, subfolder), os.path.join(annotations_folder, subfolder))
+        for file_path in deleted:
+            print(f"Deleted: {file_path}")
+        deleted_files_list += deleted
 
     # 将删除文件路径列表保存到txt文件
     txt_file_path = os.path.join(root_folder,'deleted_files.txt')
@@ -309,6 +344,51 @@ def check_difference_imgs_annotations(root_folder):
     print(f"Deleted files paths saved to: {txt_file_path}")
 
 
+def pack_imgs_to_volumes(root_folder, packed_dir=None):
+    '''
+    Pack the imgs/ and annotations/ PNG folders of root_folder into one image array and one label array
+    per folder, plus an offset index (index.pkl), as read by dataset/packed.py::PackedVolumeStore.
+    Pass the packed folder as --data_dir to use it instead of imgs/.
+    '''
+    imgs_folder = join(root_folder, 'imgs')
+    annotations_folder = join(root_folder, 'annotations')
+    if packed_dir is None:
+        packed_dir = join(root_folder, 'packed')
+    if not os.path.exists(packed_dir):
+        os.makedirs(packed_dir)
+
+    index = {}
+    for folder in sorted(os.listdir(imgs_folder)):
+        if not os.path.isdir(join(imgs_folder, folder)):
+            continue
+        names = sorted([f for f in os.listdir(join(imgs_folder, folder)) if f.endswith('.png')])
+        if len(names) == 0:
+            continue
+        images = [np.asarray(Image.open(join(imgs_folder, folder, n))) for n in names]
+        labels = [np.asarray(Image.open(join(annotations_folder, folder, n))) for n in names]
+        entry = {
+            'names': names,
+            'img_shapes': [im.shape for im in images],
+            'label_shapes': [lb.shape for lb in labels],
+            'img_offsets': np.cumsum([0] + [im.size for im in images[:-1]]).astype(np.int64),
+            'label_offsets': np.cumsum([0] + [lb.size for lb in labels[:-1]]).astype(np.int64),
+        }
+        # 16 bit PNGs keep their dynamic range, everything else is stored as uint8
+        img_dtype = np.result_type(*[im.dtype for im in images])
+        np.save(join(packed_dir, folder + '_img.npy'),
+                np.concatenate([im.astype(img_dtype).ravel() for im in images]))
+        np.save(join(packed_dir, folder + '_label.npy'),
+                np.concatenate([lb.astype('uint8').ravel() for lb in labels]))
+        index[folder] = entry
+        print("finishing packing", folder)
+
+    # the index is written last so that readers never see a half-written store
+    with open(join(packed_dir, 'index.pkl'), 'wb') as f:
+        pickle.dump(index, f)
+    print("packed %d folders to %s" % (len(index), packed_dir))
+    index_slices(packed_dir)
+
+
 def convert_scribbles_to_imgs(data_dir, output_dir):
     file_list = os.listdir(data_dir)
     for f in file_list:
@@ -1,9 +1,13 @@
 import pickle
 
 import os
+import sys
 import random
 import numpy as np
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from dataset.manifest import load_manifest
+
 
 def subfiles(folder, join=True, prefix=None, suffix=None, sort=True):
     if join:
@@ -94,7 +98,8 @@ def create_folds(output_dir, image_dir, fold_num=5):
 
 
 def create_acdc_folds(output_dir, image_dir, fold_num=5):
-    ppl_files = os.listdir(image_dir)
+    # patient keys as the datasets match them, e.g. patient_001 for patient_001_frame_01 and _frame_12
+    ppl_files = load_manifest(image_dir).patient_keys()
     trainset_size = len(ppl_files) * 70 // 100
     valset_size = len(ppl_files) * 15 // 100
     testset_size = len(ppl_files) * 15 // 100
@@ -0,0 +1,83 @@
+import argparse
+import io
+import json
+import os
+import pickle
+import sys
+import tarfile
+import time
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from dataset.manifest import load_manifest
+from dataset.shards import SHARD_INDEX, encode_record, shard_name
+
+join = os.path.join
+
+
+def write_shard(path, records):
+    '''Write records (name, img, label, key) to the tar file path, via a temporary file.'''
+    with tarfile.open(path + '.tmp', 'w') as tar:
+        for record in records:
+            for member_name, data in encode_record(*record):
+                info = tarfile.TarInfo(member_name)
+                info.size = len(data)
+                info.mtime = time.time()
+                tar.addfile(info, io.BytesIO(data))
+    os.replace(path + '.tmp', path)
+
+
+def write_shards(data_dir, output_dir, keys=None, shard_size=1000, seed=None):
+    '''
+    Pack the slices of data_dir (PNG folders, packed arrays or volumes, anything dataset/manifest.py
+    reads) into tar shards of shard_size (image, label, key) records each, for dataset/shards.py::ShardDataset.
+    keys restricts the shards to those patients, e.g. the train split of a fold. With a seed the slices
+    are shuffled across patients before sharding, which the bounded shuffle buffer of the reader cannot do;
+    without one they stay in patient order. Images and labels are stored as decoded (no normalization).
+    The index (shards.json, the per-key record counts of every shard) is written last.
+    '''
+    manifest = load_manifest(data_dir)
+    indices = manifest.select(keys) if keys is not None else np.arange(len(manifest))
+    if seed is not None:
+        indices = np.random.RandomState(seed).permutation(indices)
+    os.makedirs(output_dir, exist_ok=True)
+
+    shards = []
+    for s, start in enumerate(range(0, len(indices), shard_size)):
+        chunk = indices[start:start + shard_size]
+        records, counts = [], {}
+        for n, i in enumerate(chunk):
+            img, label = manifest.read(i)
+            key = manifest.key(i)
+            records.append(('%09d' % (start + n), np.asarray(img), np.asarray(label), key))
+            counts[key] = counts.get(key, 0) + 1
+        write_shard(join(output_dir, shard_name(s)), records)
+        shards.append({'name': shard_name(s), 'count': len(chunk), 'keys': counts})
+        print("finishing shard %s, %d records" % (shard_name(s), len(chunk)))
+
+    with open(join(output_dir, SHARD_INDEX + '.tmp'), 'w') as f:
+        json.dump({'data_dir': data_dir, 'shard_size': shard_size, 'seed': seed, 'shards': shards}, f)
+    os.replace(join(output_dir, SHARD_INDEX + '.tmp'), join(output_dir, SHARD_INDEX))
+    print("wrote %d records in %d shards to %s" % (len(indices), len(shards), output_dir))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, required=True)
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--src_dir', type=str, default=None, help='folder of splits.pkl; all slices if not given')
+    parser.add_argument('--fold', type=int, default=0)
+    parser.add_argument('--split', type=str, default='train', choices=['train', 'val', 'test'])
+    parser.add_argument('--tr_size', type=int, default=None, help='only the first tr_size train patients')
+    parser.add_argument('--shard_size', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0, help='shuffle seed, -1 keeps patient order')
+    args = parser.parse_args()
+
+    keys = None
+    if args.src_dir is not None:
+        with open(join(args.src_dir, "splits.pkl"), "rb") as f:
+            keys = pickle.load(f)[args.fold][args.split]
+        if args.split == 'train' and args.tr_size is not None:
+            keys = keys[0:args.tr_size]
+    write_shards(args.data_dir, args.output_dir, keys, args.shard_size, None if args.seed < 0 else args.seed)
@@ -0,0 +1,89 @@
+import hashlib
+import os
+
+import numpy as np
+
+from batchgenerators.augmentations.utils import resize_multichannel_image
+
+join = os.path.join
+
+_resized = {}
+
+
+class ResizedSliceCache(object):
+    """
+    Images of a manifest already resized to the encoder input size, kept on disk for resize_once:
+        <cache_dir>/<data_dir name>_<size>_<signature>.npy        float16 [N, C, size, size]
+        <cache_dir>/<data_dir name>_<size>_<signature>_done.npy   uint8 [N], 1 once slice i is stored
+    The signature hashes the slice names and mtimes of the manifest, so a rebuilt manifest gets a new
+    file. Both arrays are memory-mapped and filled lazily by the DataLoader workers: the first read of
+    a slice decodes, normalizes and resizes it and writes it back, every later epoch reads the
+    resized image straight from the page cache. Labels are not cached; they keep their native size.
+    """
+    def __init__(self, manifest, size, channels, cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+        signature = hashlib.sha1(manifest.names.tobytes() + manifest.mtimes.tobytes()).hexdigest()[:12]
+        name = '%s_%d_%s' % (os.path.basename(os.path.normpath(manifest.data_dir)), size, signature)
+        self.size = size
+        self.data_file = join(cache_dir, name + '.npy')
+        self.done_file = join(cache_dir, name + '_done.npy')
+        self._create(self.data_file, np.float16, (len(manifest), channels, size, size))
+        self._create(self.done_file, np.uint8, (len(manifest),))
+        self._arrays = None
+
+    @staticmethod
+    def _create(path, dtype, shape):
+        # built under a temporary name and hard-linked into place, which fails if another process (e.g.
+        # another DDP rank) created the file first; a file in use by other workers is never truncated
+        if os.path.isfile(path):
+            return
+        tmp = path + '.%d.tmp' % os.getpid()
+        np.lib.format.open_memmap(tmp, mode='w+', dtype=dtype, shape=shape)
+        try:
+            os.link(tmp, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp)
+
+    def _open(self):
+        if self._arrays is None:
+            self._arrays = (np.load(self.data_file, mmap_mode='r+'), np.load(self.done_file, mmap_mode='r+'))
+        return self._arrays
+
+    def read(self, i, load, load_label):
+        """
+        (img, label) of manifest slice i, img float32 [C, size, size]. load(i) gives the decoded,
+        normalized slice on a miss; load_label(i) reads the label alone on a hit.
+        """
+        data, done = self._open()
+        if done[i]:
+            return data[i].astype(np.float32), load_label(i)
+        img, label = load(i)
+        if tuple(img.shape[1:]) != (self.size, self.size):
+            img = resize_multichannel_image(img, (self.size, self.size), 1)
+        data[i] = img
+        done[i] = 1
+        return np.asarray(img, dtype=np.float32), label
+
+    def __getstate__(self):
+        # memmaps are reopened in every worker instead of being pickled
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+
+def get_resized_cache(args, manifest, size, load):
+    """
+    The ResizedSliceCache of args.data_dir at size under args.resized_cache, shared by every dataset on
+    that manifest in this process; None if off. load(0) is called once to find the channel count.
+    """
+    cache_dir = getattr(args, 'resized_cache', None)
+    if not cache_dir or len(manifest) == 0:
+        return None
+    key = (manifest.data_dir, size, cache_dir)
+    if key not in _resized:
+        channels = load(0)[0].shape[0]
+        _resized[key] = ResizedSliceCache(manifest, size, channels, cache_dir)
+        print('resized cache of %s: %s' % (manifest.data_dir, _resized[key].data_file))
+    return _resized[key]
@@ -0,0 +1,208 @@
+import io
+import json
+import os
+import tarfile
+
+import numpy as np
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, get_worker_info
+
+from dataset.telemetry import install, timed
+
+join = os.path.join
+
+SHARD_INDEX = 'shards.json'
+
+
+def shard_name(i):
+    return 'shard-%06d.tar' % i
+
+
+def encode_record(name, img, label, key):
+    """tar members of one record: <name>.img.npy, <name>.label.npy and <name>.key.txt."""
+    members = []
+    for suffix, arr in (('.img.npy', img), ('.label.npy', label)):
+        buf = io.BytesIO()
+        np.save(buf, np.ascontiguousarray(arr))
+        members.append((name + suffix, buf.getvalue()))
+    members.append((name + '.key.txt', key.encode()))
+    return members
+
+
+def iter_records(path):
+    """(img, label, key) of every record of a shard, read front to back as a stream."""
+    record, current = {}, None
+    with tarfile.open(path, 'r|') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            name, field = member.name.split('.', 1)
+            if name != current and record:
+                yield record['img.npy'], record['label.npy'], record['key.txt']
+                record = {}
+            current = name
+            with timed('open'):
+                data = tar.extractfile(member).read()
+            with timed('decode'):
+                record[field] = data.decode() if field == 'key.txt' else np.load(io.BytesIO(data))
+    if record:
+        yield record['img.npy'], record['label.npy'], record['key.txt']
+
+
+def load_shard_index(shard_dir):
+    with open(join(shard_dir, SHARD_INDEX), 'r') as f:
+        return json.load(f)
+
+
+class ShardDataset(IterableDataset):
+    """
+    Train slices streamed from tar shards (dataset/prepare_dataset/write_shards.py) instead of read
+    one file at a time, for cohorts that live on a shared filesystem. Every rank and DataLoader worker
+    reads its own shards front to back:
+        - the shards holding any of the keys are permuted per epoch (seed + epoch under distributed
+          training, the loader's base seed otherwise), identically on every rank and worker
+        - rank r takes every world_size-th shard of that order, and the shards left over after the
+          last full round are split between all ranks by record stride (rank r takes their records
+          j with j % world_size == r)
+        - worker w of a rank takes every num_workers-th shard of the rank's share; with fewer shards
+          than workers, a shard is split between the n workers sharing it by record stride the same way
+        - every worker reads each of its records once; records of other keys are skipped, and the
+          records are mixed in a shuffle buffer of shuffle_buffer records
+    Ranks are padded to the same number of records, len(self), by workers cycling through their own
+    records again, so that distributed ranks see the same number of batches.
+
+    base is the map-style dataset of the same keys (e.g. AcdcDataset in train mode). Its normalize()
+    and process() turn the stored arrays into samples, so transforms, batch augmentation and the
+    uint8 transport behave as with base. Slice sampling weights do not apply to the stream.
+    """
+    def __init__(self, shard_dir, keys, base, shuffle_buffer=1000, seed=0):
+        super().__init__()
+        self.shard_dir = shard_dir
+        self.keys = set(str(k) for k in keys)
+        self.base = base
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        # attributes read by dataset/transport.py::get_collate_fn and get_device_preprocess
+        for name in ('mode', 'patch_size', 'transport', 'transport_bits', 'batch_aug', 'field_bank', 'input_size',
+                     'native_labels', 'telemetry'):
+            setattr(self, name, getattr(base, name, None))
+        self.sample_weights = None
+
+        index = load_shard_index(shard_dir)
+        self.shards, self.counts = [], {}
+        for shard in index['shards']:
+            n = sum(c for k, c in shard['keys'].items() if k in self.keys)
+            if n:
+                self.shards.append(shard['name'])
+                self.counts[shard['name']] = n
+        assert self.shards, 'no shard in %s holds any of the keys %s' % (shard_dir, sorted(self.keys))
+        self.num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        self.rank = dist.get_rank() if self.num_replicas > 1 else 0
+        self.num_records = int(sum(self.counts.values()))
+        assert self.num_records >= self.num_replicas, '%d records cannot be split over %d ranks' \
+            % (self.num_records, self.num_replicas)
+        print('streaming %d records from %d shards of %s, %d per rank'
+              % (self.num_records, len(self.shards), shard_dir, len(self)))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        if self.num_replicas == 1:
+            return self.num_records
+        return max(self.part_records(parts) for parts in self.rank_split(self.seed + self.epoch))
+
+    def _worker(self):
+        """(worker id, number of workers, seed shared by all workers of this rank and epoch)."""
+        info = get_worker_info()
+        if info is None:
+            worker_id, num_workers, base_seed = 0, 1, int(torch.empty((), dtype=torch.int64).random_().item())
+        else:
+            worker_id, num_workers, base_seed = info.id, info.num_workers, info.seed - info.id
+        if self.num_replicas > 1:
+            base_seed = self.seed + self.epoch
+        return worker_id, num_workers, base_seed % 2 ** 32
+
+    def rank_split(self, base_seed):
+        """Parts (shard, stride, offset) of every rank: whole shards in rounds, then the rest by stride."""
+        order = [(self.shards[i], 1, 0) for i in np.random.RandomState(base_seed).permutation(len(self.shards))]
+        whole = len(order) // self.num_replicas * self.num_replicas
+        ranks = self.split(order[:whole], self.num_replicas) if whole else [[] for _ in range(self.num_replicas)]
+        for r, parts in enumerate(ranks):
+            parts.extend((shard, self.num_replicas, r) for shard, _, _ in order[whole:])
+        return ranks
+
+    @staticmethod
+    def split(parts, n):
+        """
+        parts divided between n readers: every n-th part each if there are enough, otherwise part k is
+        shared by the readers i with i % len(parts) == k, which take every m-th of its records.
+        """
+        if len(parts) >= n:
+            return [parts[i::n] for i in range(n)]
+        out = []
+        for i in range(n):
+            shard, stride, offset = parts[i % len(parts)]
+            m = len(range(i % len(parts), n, len(parts)))
+            # the (i // len(parts))-th of m readers takes records offset + stride * q with q % m == i // len(parts)
+            out.append([(shard, stride * m, offset + stride * (i // len(parts)))])
+        return out
+
+    def part_records(self, parts):
+        return sum(len(range(offset, self.counts[shard], stride)) for shard, stride, offset in parts)
+
+    def assignment(self, worker_id, num_workers, base_seed):
+        """Parts (shard, stride, offset) and record quota of one worker of this rank."""
+        ranks = self.rank_split(base_seed)
+        target = max(self.part_records(parts) for parts in ranks)
+        workers = self.split(ranks[self.rank], num_workers)
+        records = [self.part_records(parts) for parts in workers]
+        # pad the rank to target by cycling the workers that hold records
+        holders = [w for w in range(num_workers) if records[w]]
+        extra = target - sum(records)
+        quota = records[worker_id]
+        if worker_id in holders:
+            k = holders.index(worker_id)
+            quota += extra // len(holders) + (k < extra % len(holders))
+        return workers[worker_id], quota
+
+    def records(self, parts, quota):
+        emitted = 0
+        while emitted < quota:
+            for shard, stride, offset in parts:
+                j = -1
+                for img, label, key in iter_records(join(self.shard_dir, shard)):
+                    if key not in self.keys:
+                        continue
+                    j += 1
+                    if j % stride != offset:
+                        continue
+                    yield img, label
+                    emitted += 1
+                    if emitted == quota:
+                        return
+
+    def sample(self, img, label):
+        with timed('normalize'):
+            img, label = self.base.normalize(img, label)
+        return self.base.process(img, label)
+
+    def __iter__(self):
+        install(self.telemetry)
+        worker_id, num_workers, base_seed = self._worker()
+        parts, quota = self.assignment(worker_id, num_workers, base_seed)
+        rng = np.random.RandomState((base_seed + 7919 * (self.rank * num_workers + worker_id + 1)) % 2 ** 32)
+        buffer = []
+        for record in self.records(parts, quota):
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(record)
+                continue
+            j = rng.randint(len(buffer))
+            out, buffer[j] = buffer[j], record
+            yield self.sample(*out)
+        rng.shuffle(buffer)
+        for record in buffer:
+            yield self.sample(*record)
@@ -0,0 +1,138 @@
+import multiprocessing
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+_caches = {}
+
+
+class SharedSliceCache(object):
+    """
+    Decoded and normalized slices of one manifest, kept in shared memory across DataLoader workers.
+
+    The cache is created in the main process before the loaders start their workers, and all its
+    state lives in shared-memory tensors:
+        data        [S, slot_bytes] uint8   slot contents: image (float32 [C, H, W]) then label
+        shapes      [S, 5]                  C, H, W of the image and H, W of the label in the slot
+        owner       [S]                     manifest index held by the slot, -1 if empty
+        last_used   [S]                     clock value of the last access, for LRU eviction
+        pins        [S]                     readers currently holding a view of the slot
+        slot_of     [N]                     slot of every manifest slice, -1 if not cached
+    S = byte budget // slot_bytes, and slot_bytes fits the largest slice of the manifest. The first
+    worker to miss a slice decodes it and stores it in an empty or the least recently used unpinned
+    slot; every other worker then reads it as a read-only numpy view without copying or decoding.
+    """
+    def __init__(self, manifest, budget_bytes, channels, label_dtype):
+        self.label_dtype = np.dtype(label_dtype)
+        hw = int(np.prod(manifest.shapes, axis=1).max()) if len(manifest) else 0
+        self.slot_bytes = hw * (channels * 4 + self.label_dtype.itemsize)
+        self.num_slots = int(min(len(manifest), budget_bytes // max(self.slot_bytes, 1)))
+
+        self.data = torch.zeros(self.num_slots, self.slot_bytes, dtype=torch.uint8).share_memory_()
+        self.shapes = torch.zeros(self.num_slots, 5, dtype=torch.int64).share_memory_()
+        self.owner = torch.full((self.num_slots,), -1, dtype=torch.int64).share_memory_()
+        self.last_used = torch.full((self.num_slots,), -1, dtype=torch.int64).share_memory_()
+        self.pins = torch.zeros(self.num_slots, dtype=torch.int64).share_memory_()
+        self.slot_of = torch.full((len(manifest),), -1, dtype=torch.int64).share_memory_()
+        # clock, hits, misses
+        self.counters = torch.zeros(3, dtype=torch.int64).share_memory_()
+        self.lock = multiprocessing.Lock()
+
+    def _tick(self, slot):
+        self.counters[0] += 1
+        self.last_used[slot] = self.counters[0]
+
+    def _views(self, slot):
+        c, h, w, lh, lw = self.shapes[slot].tolist()
+        buf = self.data[slot].numpy()
+        img_bytes = c * h * w * 4
+        img = buf[:img_bytes].view(np.float32).reshape(c, h, w)
+        label = buf[img_bytes:img_bytes + lh * lw * self.label_dtype.itemsize].view(self.label_dtype).reshape(lh, lw)
+        img.flags.writeable = False
+        label.flags.writeable = False
+        return img, label
+
+    def acquire(self, i):
+        """Pinned read-only views of slice i, or None on a miss."""
+        with self.lock:
+            slot = int(self.slot_of[i])
+            if slot < 0:
+                self.counters[2] += 1
+                return None
+            self.pins[slot] += 1
+            self._tick(slot)
+            self.counters[1] += 1
+        return slot, self._views(slot)
+
+    def release(self, slot):
+        with self.lock:
+            self.pins[slot] -= 1
+
+    def put(self, i, img, label):
+        """Store slice i unless another worker already did, or every slot is pinned."""
+        img = np.ascontiguousarray(img, dtype=np.float32)
+        label = np.ascontiguousarray(label, dtype=self.label_dtype)
+        if img.nbytes + label.nbytes > self.slot_bytes:
+            return
+        with self.lock:
+            if self.slot_of[i] >= 0:
+                return
+            free = torch.nonzero(self.pins == 0)[:, 0]
+            if len(free) == 0:
+                return
+            slot = int(free[torch.argmin(self.last_used[free])])
+            if self.owner[slot] >= 0:
+                self.slot_of[self.owner[slot]] = -1
+            buf = self.data[slot].numpy()
+            buf[:img.nbytes] = img.reshape(-1).view(np.uint8)
+            buf[img.nbytes:img.nbytes + label.nbytes] = label.reshape(-1).view(np.uint8)
+            self.shapes[slot] = torch.tensor(img.shape + label.shape)
+            self.owner[slot] = i
+            self.slot_of[i] = slot
+            self._tick(slot)
+
+    def stats(self):
+        hits, misses = int(self.counters[1]), int(self.counters[2])
+        return {'hits': hits, 'misses': misses, 'cached': int((self.owner >= 0).sum()), 'slots': self.num_slots}
+
+
+@contextmanager
+def cached_read(cache, i, load):
+    """
+    (img, label) of manifest slice i: views into the shared cache while the block runs, or
+    load(i) on a miss (which then fills the cache). The views are read-only; callers that
+    augment in place must copy them.
+    """
+    if cache is None:
+        yield load(i)
+        return
+    hit = cache.acquire(i)
+    if hit is None:
+        img, label = load(i)
+        cache.put(i, img, label)
+        yield img, label
+        return
+    slot, views = hit
+    try:
+        yield views
+    finally:
+        cache.release(slot)
+
+
+def get_slice_cache(args, manifest, load):
+    """
+    The cache of args.data_dir with a budget of args.slice_cache_mb, shared by every dataset built
+    on that manifest in this process (train/val/test); None if off. load(i) decodes one slice and
+    is called once here to find the channel count and label dtype.
+    """
+    budget_mb = getattr(args, 'slice_cache_mb', 0)
+    if not budget_mb or len(manifest) == 0:
+        return None
+    key = (manifest.data_dir, budget_mb)
+    if key not in _caches:
+        img, label = load(0)
+        cache = SharedSliceCache(manifest, budget_mb * 2 ** 20, img.shape[0], np.asarray(label).dtype)
+        print('slice cache of %s: %d slots of %.2f MB' % (manifest.data_dir, cache.num_slots, cache.slot_bytes / 2 ** 20))
+        _caches[key] = cache if cache.num_slots > 0 else None
+    return _caches[key]
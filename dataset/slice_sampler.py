@@ -0,0 +1,124 @@
+import math
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+def foreground_selection(manifest, indices, args):
+    """
+    Apply args.slice_sampling to the train slices `indices` of a manifest, using the foreground
+    fraction and class presence stored in it. Returns (indices, weights, num_samples):
+        'all'     every slice, uniform weights (the default)
+        'drop'    slices with fg_fraction < args.slice_threshold are removed
+        'weight'  they are kept with weight args.low_fg_weight, and an epoch draws as many slices
+                  as 'drop' would keep
+    With args.rare_class_ratio R > 1, a slice containing foreground class c is weighted by
+    freq(most common class) / freq(c), capped at R, where freq counts the slices a class occurs in.
+    weights is None when the result is uniform, and a plain shuffle is enough.
+    """
+    mode = getattr(args, 'slice_sampling', 'all')
+    ratio = getattr(args, 'rare_class_ratio', 1.)
+    if mode == 'all' and ratio <= 1:
+        return indices, None, len(indices)
+
+    low = manifest.fg_fraction[indices] < args.slice_threshold
+    if mode != 'all':
+        print('slice sampling %s: %d of %d train slices below foreground fraction %.3f'
+              % (mode, int(low.sum()), len(indices), args.slice_threshold))
+    if mode == 'drop':
+        indices, low = indices[~low], low[~low]
+    weights = np.ones(len(indices))
+    num_samples = len(indices)
+    if mode == 'weight':
+        weights[low] = getattr(args, 'low_fg_weight', 0.1)
+        num_samples -= int(low.sum())
+
+    if ratio > 1:
+        present = manifest.class_presence(indices)[:, 1:]
+        freq = present.sum(0)
+        common = freq.max()
+        boost = np.where(freq > 0, common / np.maximum(freq, 1), 1.).clip(1., ratio)
+        weights *= np.where(present.any(1), (present * boost).max(1), 1.)
+        rare = np.nonzero((freq > 0) & (boost > 1))[0] + 1
+        print('oversampling classes %s by %s' % (rare.tolist(), np.round(boost[rare - 1], 2).tolist()))
+    if (weights == 1).all():
+        weights = None
+    return indices, weights, max(num_samples, 1)
+
+
+class WeightedSliceSampler(Sampler):
+    """
+    Draws num_samples slice positions with replacement, proportional to weights, from torch's global
+    RNG. Under distributed training every rank draws the same sequence (seeded by seed and the epoch
+    given to set_epoch) and keeps every num_replicas-th entry, like DistributedSampler.
+    """
+    def __init__(self, weights, num_samples, num_replicas=1, rank=0, seed=0):
+        self.weights = torch.as_tensor(weights, dtype=torch.double)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.num_samples = int(math.ceil(num_samples / num_replicas))
+        self.total_size = self.num_samples * num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        generator = None
+        if self.num_replicas > 1:
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        draws = torch.multinomial(self.weights, self.total_size, replacement=True, generator=generator)
+        return iter(draws[self.rank:self.total_size:self.num_replicas].tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+class ShapeBatchSampler(Sampler):
+    """
+    Batch sampler for datasets whose items keep their native size (the labels with resize_once):
+    every batch holds positions whose slices share a shape, given by shapes [N, 2].
+    Without shuffle the positions are batched in order and a batch ends early where the shape changes,
+    so the order VolumeStream relies on is kept. With shuffle the positions of every shape are shuffled
+    and batched, and the batches are shuffled. Under distributed training every rank takes every
+    num_replicas-th batch, padded by repeating batches like DistributedSampler, and set_epoch reseeds.
+    """
+    def __init__(self, shapes, batch_size, shuffle=False, num_replicas=1, rank=0, seed=0):
+        shapes = np.asarray(shapes).reshape(len(shapes), -1)
+        _, self.groups = np.unique(shapes, axis=0, return_inverse=True)
+        self.groups = self.groups.reshape(-1)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.num_batches = len(self.batches())
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self):
+        if not self.shuffle:
+            cuts = np.nonzero(self.groups[1:] != self.groups[:-1])[0] + 1
+            runs = np.split(np.arange(len(self.groups)), cuts)
+            return [run[i:i + self.batch_size].tolist() for run in runs for i in range(0, len(run), self.batch_size)]
+        rng = np.random.default_rng(self.seed + self.epoch if self.num_replicas > 1 else None)
+        batches = []
+        for g in range(self.groups.max() + 1 if len(self.groups) else 0):
+            positions = rng.permutation(np.nonzero(self.groups == g)[0])
+            batches += [positions[i:i + self.batch_size].tolist() for i in range(0, len(positions), self.batch_size)]
+        return [batches[i] for i in rng.permutation(len(batches))]
+
+    def __iter__(self):
+        batches = self.batches()
+        if self.num_replicas > 1:
+            total = int(math.ceil(len(batches) / self.num_replicas)) * self.num_replicas
+            batches = (batches * (total // max(len(batches), 1) + 1))[:total]
+            batches = batches[self.rank:total:self.num_replicas]
+        return iter(batches)
+
+    def __len__(self):
+        return int(math.ceil(self.num_batches / self.num_replicas))
@@ -0,0 +1,196 @@
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+from torch.utils.data import get_worker_info
+from torch.utils.data._utils.collate import default_collate
+
+from batchgenerators.transforms.abstract_transforms import AbstractTransform, Compose
+
+# stages timed inside the datasets; the transforms of the dataset pipeline are added by class name
+READ_STAGES = ['open', 'decode', 'normalize', 'collate']
+NUM_BINS = 32
+
+_telemetry = {}
+_local = threading.local()
+
+
+class LoaderTelemetry(object):
+    """
+    Per-stage timing of one dataset's loader, shared by its DataLoader workers (or loader threads)
+    and the trainer. Every worker writes only its own row of the shared-memory tensors
+        counts  [slots, stages, NUM_BINS]  histogram of durations, bin b holds [2^(b-1), 2^b) microseconds
+        total   [slots, stages]            summed seconds
+    where slot 0 is the main process / thread and slot k + 1 DataLoader worker or loader thread k.
+    produced [slots] counts the batches collated so far; with the batches the trainer took (step())
+    it gives the number of batches waiting in the loader queues.
+
+    On the trainer side step() records the time spent waiting for each batch and flags a step as
+    data-starved when that wait is more than starve_ratio of the step. export() writes per-stage
+    mean / p50 / p95 to TensorBoard and everything, per worker, to a JSON summary.
+    """
+    def __init__(self, name, stages, num_workers, starve_ratio=0.2):
+        self.name = name
+        self.stages = list(stages)
+        self.slots = num_workers + 1
+        self.starve_ratio = starve_ratio
+        self.counts = torch.zeros(self.slots, len(self.stages), NUM_BINS, dtype=torch.int64).share_memory_()
+        self.total = torch.zeros(self.slots, len(self.stages), dtype=torch.float64).share_memory_()
+        self.produced = torch.zeros(self.slots, dtype=torch.int64).share_memory_()
+        self.consumed = 0
+        self.waits, self.depths, self.starved = [], [], []
+
+    def slot(self):
+        info = get_worker_info()
+        if info is not None:
+            return min(info.id + 1, self.slots - 1)
+        # threads of dataset/thread_loader.py are named loader_<k>
+        match = re.search(r'loader_(\d+)$', threading.current_thread().name)
+        return min(int(match.group(1)) + 1, self.slots - 1) if match else 0
+
+    def add(self, stage, seconds):
+        if stage not in self.stages:
+            return
+        s = self.stages.index(stage)
+        slot = self.slot()
+        b = min(int(seconds * 1e6).bit_length(), NUM_BINS - 1)
+        self.counts[slot, s, b] += 1
+        self.total[slot, s] += seconds
+
+    def step(self, wait, step_time, writer=None, global_step=None):
+        """Trainer side: wait for the batch and the whole step (wait included), in seconds."""
+        self.consumed += 1
+        depth = int(self.produced.sum()) - self.consumed
+        starved = wait > self.starve_ratio * max(step_time, 1e-9)
+        self.waits.append(wait)
+        self.depths.append(depth)
+        if starved:
+            self.starved.append(len(self.waits) - 1)
+        if writer is not None:
+            writer.add_scalar('telemetry/%s/wait_ms' % self.name, wait * 1000, global_step=global_step)
+            writer.add_scalar('telemetry/%s/queue_depth' % self.name, depth, global_step=global_step)
+            writer.add_scalar('telemetry/%s/starved' % self.name, int(starved), global_step=global_step)
+        return starved
+
+    @staticmethod
+    def _stats(counts, total):
+        n = int(counts.sum())
+        if n == 0:
+            return None
+        cdf = np.cumsum(counts) / n
+        upper = lambda q: (2 ** int(np.searchsorted(cdf, q))) / 1e3   # upper edge of the bin, ms
+        return {'count': n, 'mean_ms': float(total) / n * 1e3, 'p50_ms': upper(0.5), 'p95_ms': upper(0.95)}
+
+    def summary(self):
+        counts, total = self.counts.numpy(), self.total.numpy()
+        stages = {}
+        for s, stage in enumerate(self.stages):
+            stats = self._stats(counts[:, s].sum(0), total[:, s].sum())
+            if stats is None:
+                continue
+            stats['workers'] = {str(w): self._stats(counts[w, s], total[w, s]) for w in range(self.slots)
+                                if counts[w, s].sum()}
+            stages[stage] = stats
+        waits = np.array(self.waits)
+        return {
+            'loader': self.name,
+            'stages': stages,
+            'steps': len(waits),
+            'wait_ms': {'mean': float(waits.mean() * 1e3), 'p95': float(np.percentile(waits, 95) * 1e3),
+                        'total_s': float(waits.sum())} if len(waits) else None,
+            'queue_depth': {'mean': float(np.mean(self.depths)), 'min': int(np.min(self.depths))} if self.depths else None,
+            'starved_steps': len(self.starved),
+            'starved_at': self.starved[-100:],
+        }
+
+    def export(self, writer=None, epoch=None, json_path=None):
+        """Write the summary so far to TensorBoard (per-stage scalars) and to json_path; returns it."""
+        summary = self.summary()
+        if writer is not None:
+            for stage, stats in summary['stages'].items():
+                for key in ('mean_ms', 'p95_ms'):
+                    writer.add_scalar('telemetry/%s/%s_%s' % (self.name, stage, key), stats[key], global_step=epoch)
+            writer.add_scalar('telemetry/%s/starved_steps' % self.name, summary['starved_steps'], global_step=epoch)
+        if json_path is not None:
+            with open(json_path, 'w') as f:
+                json.dump(summary, f, indent=1)
+        if summary['steps']:
+            print('data loading [%s]: %d of %d steps data-starved, mean wait %.1f ms, slowest stage %s'
+                  % (self.name, summary['starved_steps'], summary['steps'], summary['wait_ms']['mean'],
+                     max(summary['stages'], key=lambda s: summary['stages'][s]['mean_ms'] * summary['stages'][s]['count'])
+                     if summary['stages'] else '-'))
+        return summary
+
+
+def install(telemetry):
+    """Make telemetry the recorder of timed() calls in this thread (called per item by the datasets)."""
+    _local.telemetry = telemetry
+
+
+@contextmanager
+def timed(stage):
+    """Time the block as stage of the installed recorder; a no-op without one."""
+    telemetry = getattr(_local, 'telemetry', None)
+    if telemetry is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        telemetry.add(stage, time.perf_counter() - start)
+
+
+class TimedCompose(AbstractTransform):
+    """Compose that times every transform as a stage named after its class."""
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def __call__(self, **data_dict):
+        for t in self.transforms:
+            with timed(type(t).__name__):
+                data_dict = t(**data_dict)
+        return data_dict
+
+
+class TimedCollate(object):
+    """collate_fn wrapper that times the collate step and counts the batches produced."""
+    def __init__(self, collate_fn, telemetry):
+        self.collate_fn = collate_fn if collate_fn is not None else default_collate
+        self.telemetry = telemetry
+
+    def __call__(self, batch):
+        install(self.telemetry)
+        with timed('collate'):
+            out = self.collate_fn(batch)
+        self.telemetry.produced[self.telemetry.slot()] += 1
+        return out
+
+
+def get_telemetry(args, name, aug):
+    """
+    The LoaderTelemetry of the name ('train', 'val', ...) loader if args.telemetry is set, else None.
+    aug is the transform pipeline of the dataset; a Compose is timed transform by transform.
+    """
+    if not getattr(args, 'telemetry', False):
+        return None
+    stages = READ_STAGES + [type(t).__name__ for t in getattr(aug, 'transforms', [])]
+    if name not in _telemetry:
+        _telemetry[name] = LoaderTelemetry(name, stages, args.workers, getattr(args, 'starve_ratio', 0.2))
+    return _telemetry[name]
+
+
+def telemetry_path(args, name):
+    """<save_dir>/telemetry_<name>.json, with the rank in the name under distributed training."""
+    if getattr(args, 'distributed', False):
+        name = '%s_rank%d' % (name, args.rank)
+    return os.path.join(args.save_dir, 'telemetry_%s.json' % name)
+
+
+def timed_transform(aug):
+    return TimedCompose(aug.transforms) if isinstance(aug, Compose) else aug
@@ -0,0 +1,122 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from torch.utils.data import BatchSampler, IterableDataset, RandomSampler, SequentialSampler
+from torch.utils.data._utils.collate import default_collate
+
+
+class ThreadDataLoader(object):
+    """
+    In-process alternative to torch.utils.data.DataLoader, taking the same arguments as it is used in
+    this repo. Batches are loaded by num_workers threads that share the dataset, its manifest and its
+    caches, instead of worker processes that each import torch and hold their own copy. PIL decoding,
+    the numpy / scipy augmentations and torch ops release the GIL for most of their time.
+
+    At most num_workers * prefetch_factor batches are in flight, and batches are returned in sampler
+    order. Map-style datasets load one batch per task; an IterableDataset (dataset/shards.py) is read
+    by one background thread, as a DataLoader with a single worker would. pin_memory and
+    persistent_workers are accepted and ignored: the batches stay in the process, and
+    dataset/prefetch.py::DevicePrefetcher pins them on the way to the GPU.
+    """
+    def __init__(self, dataset, batch_size=1, shuffle=False, sampler=None, batch_sampler=None,
+                 num_workers=0, collate_fn=None, pin_memory=False, drop_last=False,
+                 prefetch_factor=2, persistent_workers=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.num_workers = max(num_workers, 1)
+        self.collate_fn = collate_fn if collate_fn is not None else default_collate
+        self.prefetch = self.num_workers * prefetch_factor
+        self.iterable = isinstance(dataset, IterableDataset)
+        if batch_sampler is None and not self.iterable:
+            if sampler is None:
+                sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+            batch_sampler = BatchSampler(sampler, batch_size, drop_last)
+        self.sampler = sampler
+        self.batch_sampler = batch_sampler
+        self.drop_last = drop_last
+
+    def __len__(self):
+        if self.iterable:
+            n = len(self.dataset)
+            return n // self.batch_size if self.drop_last else -(-n // self.batch_size)
+        return len(self.batch_sampler)
+
+    def _load(self, indices):
+        return self.collate_fn([self.dataset[i] for i in indices])
+
+    def __iter__(self):
+        if self.iterable:
+            return self._iter_stream()
+        return self._iter_batches()
+
+    def _iter_batches(self):
+        with ThreadPoolExecutor(self.num_workers, thread_name_prefix='loader') as pool:
+            pending = deque()
+            batches = iter(self.batch_sampler)
+            for indices in batches:
+                pending.append(pool.submit(self._load, indices))
+                if len(pending) >= self.prefetch:
+                    break
+            while pending:
+                batch = pending.popleft().result()
+                for indices in batches:
+                    pending.append(pool.submit(self._load, indices))
+                    break
+                yield batch
+
+    def _iter_stream(self):
+        q = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        end = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            samples = []
+            try:
+                for sample in self.dataset:
+                    samples.append(sample)
+                    if len(samples) == self.batch_size:
+                        batch, samples = self.collate_fn(samples), []
+                        if not put(batch):
+                            return
+                if samples and not self.drop_last and not put(self.collate_fn(samples)):
+                    return
+                put(end)
+            except Exception as e:
+                put(e)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = q.get()
+                if item is end:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+
+def get_loader_class(args, test=False):
+    """
+    DataLoader or ThreadDataLoader, as chosen by args.loader ('process' or 'thread'), or for the
+    test loaders by args.test_loader if given.
+    """
+    backend = getattr(args, 'loader', 'process')
+    if test and getattr(args, 'test_loader', None):
+        backend = args.test_loader
+    return ThreadDataLoader if backend == 'thread' else torch.utils.data.DataLoader
@@ -0,0 +1,101 @@
+import numpy as np
+
+from batchgenerators.transforms.abstract_transforms import AbstractTransform, Compose
+from batchgenerators.transforms.spatial_transforms import SpatialTransform, MirrorTransform, ResizeTransform
+from batchgenerators.transforms.color_transforms import BrightnessTransform, GammaTransform
+from batchgenerators.transforms.noise_transforms import GaussianNoiseTransform
+from batchgenerators.transforms.utility_transforms import NumpyToTensor
+from batchgenerators.augmentations.utils import resize_multichannel_image, resize_segmentation
+
+from dataset.elastic_bank import BankSpatialTransform
+
+
+# The batchgenerators pipelines shared by the datasets. They are built once per dataset instead of
+# once per __getitem__; the transforms keep no per-call state, so one Compose serves every sample.
+
+def get_augmentation_list(patch_size, field_bank=None):
+    spatial_kwargs = dict(patch_size=patch_size, random_crop=False,
+                          patch_center_dist_from_border=patch_size[0] // 2,
+                          do_elastic_deform=True, alpha=(100., 350.), sigma=(40., 60.),
+                          do_rotation=True, p_rot_per_sample=0.5,
+                          angle_x=(-0.1, 0.1), angle_y=(0, 1e-8), angle_z=(0, 1e-8),
+                          scale=(0.5, 1.9), p_scale_per_sample=0.5,
+                          border_mode_data="nearest", border_mode_seg="nearest")
+    if field_bank is not None:
+        # elastic fields drawn from a precomputed bank (dataset/elastic_bank.py)
+        spatial = BankSpatialTransform(field_bank, **spatial_kwargs)
+    else:
+        spatial = SpatialTransform(**spatial_kwargs)
+    return [  # CenterCropTransform(crop_size=target_size),
+        BrightnessTransform(mu=1, sigma=1, p_per_sample=0.5),
+        GammaTransform(p_per_sample=0.5),
+        GaussianNoiseTransform(p_per_sample=0.5),
+        ResizeTransform(target_size=patch_size, order=1),  # resize
+        MirrorTransform(axes=(1,)),
+        spatial,
+    ]
+
+
+def get_train_transform(patch_size, field_bank=None):
+    return Compose(get_augmentation_list(patch_size, field_bank) + [NumpyToTensor()])
+
+
+def get_val_transform(patch_size):
+    return Compose([
+        ResizeTransform(target_size=patch_size, order=1),
+        NumpyToTensor(),
+    ])
+
+
+class SplitResizeTransform(AbstractTransform):
+    """
+    Resize 'data' to data_size (linear) and 'seg' to seg_size (nearest) independently; seg_size=None
+    leaves the labels at their native size. Inputs already at their target size are passed through.
+    """
+    def __init__(self, data_size, seg_size=None, data_key="data", label_key="seg"):
+        self.data_size = tuple(data_size)
+        self.seg_size = None if seg_size is None else tuple(seg_size)
+        self.data_key = data_key
+        self.label_key = label_key
+
+    def __call__(self, **data_dict):
+        data = data_dict.get(self.data_key)
+        if tuple(data.shape[2:]) != self.data_size:
+            data_dict[self.data_key] = np.stack([resize_multichannel_image(d, self.data_size, 1) for d in data])
+        elif not data.flags.writeable:
+            # views of decoded or cached slices, which the torch conversion may not share
+            data_dict[self.data_key] = data.copy()
+        seg = data_dict.get(self.label_key)
+        if seg is not None and self.seg_size is not None and tuple(seg.shape[2:]) != self.seg_size:
+            data_dict[self.label_key] = np.stack([
+                np.stack([resize_segmentation(c, self.seg_size, 0) for c in s]) for s in seg])
+        elif seg is not None and not seg.flags.writeable:
+            data_dict[self.label_key] = seg.copy()
+        return data_dict
+
+
+def get_resize_once_transform(input_size, label_size=None):
+    return Compose([
+        SplitResizeTransform(input_size, label_size),
+        NumpyToTensor(),
+    ])
+
+
+def get_contrast_transform(patch_size, field_bank=None):
+    return Compose(get_augmentation_list(patch_size, field_bank))
+
+
+def get_transform(mode, patch_size, batch_aug=False, field_bank=None, input_size=None):
+    """
+    Per-sample pipeline of a dataset in the given mode. With batch_aug the train samples are only
+    resized, and the augmentations run on whole batches in the collate step (dataset/batch_augment.py).
+    With input_size (resize_once) images are resized once, straight to the encoder input size; train
+    labels go to patch_size, val/test labels keep their native size.
+    """
+    if mode == 'contrast':
+        return get_contrast_transform(patch_size, field_bank)
+    if input_size is not None:
+        return get_resize_once_transform(input_size, patch_size if mode == 'train' else None)
+    if mode == 'train' and not batch_aug:
+        return get_train_transform(patch_size, field_bank)
+    return get_val_transform(patch_size)
@@ -0,0 +1,104 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import get_worker_info
+
+from dataset.batch_augment import BatchAugmentation, BatchAugmentCollate
+from dataset.telemetry import TimedCollate
+
+
+def source_bits(manifest, indices):
+    """Precision of the stored slices: 16 if they hold more than 8 bits (16-bit PNGs, int16 packs, volumes), else 8."""
+    if len(indices) == 0:
+        return 8
+    return 8 if np.asarray(manifest.read(indices[0])[0]).dtype.itemsize == 1 else 16
+
+
+class Uint8Collate(object):
+    """
+    Worker side of the uint8 transport. The float images in [0, 1] and the labels of a batch are
+    quantized into one uint8 buffer [B, C + 1, H, W] (image channels, then the label). In a loader
+    worker every batch gets a new buffer in shared memory, written in place, so handing it to the
+    trainer costs a file handle and no further copy.
+    The loader yields two views of it, (img [B, C, H, W], label [B, 1, H, W]), at a quarter of the
+    float32 size through IPC, pin memory and the host-to-device copy. Labels of another size than
+    the images (resize_once) get a second buffer of their own.
+
+    With bits=16, for slices stored at more than 8 bits, the buffer is int16 instead and holds the
+    image as round(x * 65535) - 32768, which keeps 16 bits at half the float32 size.
+    """
+    def __init__(self, bits=8):
+        self.bits = bits
+        self.dtype = torch.int16 if bits == 16 else torch.uint8
+
+    def _buffer(self, *shape):
+        out = torch.empty(*shape, dtype=self.dtype)
+        return out.share_memory_() if get_worker_info() is not None else out
+
+    def __call__(self, batch):
+        img, label = batch[0]
+        b, c = len(batch), img.shape[0]
+        h, w = img.shape[-2:]
+        lh, lw = label.shape[-2:]
+        if (lh, lw) == (h, w):
+            out = self._buffer(b, c + 1, h, w)
+            img_out, label_out = out[:, :c], out[:, c:]
+        else:
+            img_out, label_out = self._buffer(b, c, h, w), self._buffer(b, 1, lh, lw)
+        for i, (img, label) in enumerate(batch):
+            if self.bits == 16:
+                img_out[i] = torch.as_tensor(img).double().mul(65535).round_().clamp_(0, 65535).sub_(32768)
+            else:
+                img_out[i] = torch.as_tensor(img).mul(255).round_().clamp_(0, 255)
+            label_out[i] = torch.as_tensor(label).view(1, lh, lw)
+        return img_out, label_out
+
+
+class DevicePreprocess(object):
+    """
+    Consumer side of the uint8 transport, run on the training device: the uint8 (or int16) codes are
+    scaled back to [0, 1], train batches get the BatchAugmentation the workers skipped, and images are
+    brought to the encoder resolution img_size. With augmentation the warp samples the patch-size
+    image directly at img_size, so the augmentation and the resize to the encoder are a single
+    resampling. Labels stay at patch size.
+    """
+    def __init__(self, img_size, augmentation=None):
+        self.img_size = img_size
+        self.augmentation = augmentation
+
+    def __call__(self, img, label):
+        with torch.no_grad():
+            if img.dtype == torch.int16:
+                img = img.float().add_(32768).mul_(1 / 65535.)
+            else:
+                img = img.float().mul_(1 / 255.)
+            label = label.float()
+            if self.augmentation is not None:
+                return self.augmentation(img, label, img_size=self.img_size)
+            if tuple(img.shape[-2:]) != (self.img_size, self.img_size):
+                # resize_once batches arrive at the encoder size already
+                img = F.interpolate(img, (self.img_size, self.img_size), mode="bilinear", align_corners=False)
+            return img, label
+
+
+def get_collate_fn(dataset):
+    collate_fn = None
+    if getattr(dataset, 'transport', False):
+        collate_fn = Uint8Collate(getattr(dataset, 'transport_bits', 8))
+    elif getattr(dataset, 'batch_aug', False):
+        input_size = getattr(dataset, 'input_size', None)
+        collate_fn = BatchAugmentCollate(dataset.patch_size, getattr(dataset, 'field_bank', None),
+                                         None if input_size is None else input_size[0])
+    if getattr(dataset, 'telemetry', None) is not None:
+        collate_fn = TimedCollate(collate_fn, dataset.telemetry)
+    return collate_fn
+
+
+def get_device_preprocess(dataset, img_size):
+    """DevicePreprocess for the batches of a dataset with uint8 transport, None otherwise."""
+    if not getattr(dataset, 'transport', False):
+        return None
+    augmentation = None
+    if dataset.batch_aug:
+        augmentation = BatchAugmentation(dataset.patch_size, field_bank=dataset.field_bank)
+    return DevicePreprocess(img_size, augmentation)
@@ -3,11 +3,26 @@ import pickle
 from dataset.Synapse import SynapseDataset
 from dataset.ACDC import AcdcDataset
 from dataset.LP_CTA import LP_CTA_Dataset
+from dataset.Volume import VolumeDataset
+from dataset.transport import get_collate_fn
+from dataset.volume_stream import VolumeStream
+from dataset.shards import ShardDataset
+from dataset.thread_loader import get_loader_class
+from dataset.slice_sampler import ShapeBatchSampler, WeightedSliceSampler
 # from dataset.SliceLoader import SliceDataset
 import torch
+import torch.distributed as dist
+
+# --dataset names that read .nii / .nii.gz / .nrrd volumes directly (dataset/Volume.py); raw LP_CTA is not one
+VOLUME_DATASETS = ('volume', 'nifti')
 
 
 def generate_dataset(args):
+    train_ds, val_ds, test_ds = build_datasets(args)
+    return generate_loaders(train_ds, val_ds, test_ds, args)
+
+
+def build_datasets(args):
     split_dir = os.path.join(args.src_dir, "splits.pkl")
     with open(split_dir, "rb") as f:
         splits = pickle.load(f)
@@ -27,7 +42,7 @@ def generate_dataset(args):
         args.img_size = 224
         train_ds = AcdcDataset(keys=tr_keys, mode='train', args=args)
         val_ds = AcdcDataset(keys=val_keys, mode='val', args=args)
-        test_ds = AcdcDataset(keys=test_keys, mode='val', args=args)
+        test_ds = AcdcDataset(keys=test_keys, mode='val', args=args, split='test')
     elif args.dataset == 'arcade' or args.dataset == 'ARCADE':
         args.img_size = 224
         # TODO: add arcade dataset
@@ -35,11 +50,24 @@ def generate_dataset(args):
         args.img_size = 224
         train_ds = LP_CTA_Dataset(keys=tr_keys, mode='train', args=args)
         val_ds = LP_CTA_Dataset(keys=val_keys, mode='val', args=args)
-        test_ds = LP_CTA_Dataset(keys=test_keys, mode='val', args=args)
-        
+        test_ds = LP_CTA_Dataset(keys=test_keys, mode='val', args=args, split='test')
+    elif args.dataset in VOLUME_DATASETS:
+        args.img_size = 224
+        train_ds = VolumeDataset(keys=tr_keys, mode='train', args=args)
+        val_ds = VolumeDataset(keys=val_keys, mode='val', args=args)
+        test_ds = VolumeDataset(keys=test_keys, mode='val', args=args, split='test')
     else:
         raise NotImplementedError("dataset is not supported:", args.dataset)
 
+    if getattr(args, 'shard_dir', None):
+        # train slices are streamed from tar shards (dataset/shards.py); val/test still read data_dir
+        train_ds = ShardDataset(args.shard_dir, tr_keys, train_ds, getattr(args, 'shuffle_buffer', 1000),
+                                getattr(args, 'seed', None) or 0)
+
+    return train_ds, val_ds, test_ds
+
+
+def generate_loaders(train_ds, val_ds, test_ds, args):
     if args.distributed:
         train_sampler = torch.utils.data.distributed.DistributedSampler(train_ds)
         val_sampler = torch.utils.data.distributed.DistributedSampler(val_ds)
@@ -48,31 +76,72 @@ def generate_dataset(args):
         train_sampler = None
         val_sampler = None
         test_sampler = None
-
-    train_loader = torch.utils.data.DataLoader(
-        train_ds, batch_size=args.batch_size, shuffle=(train_sampler is None),
-        num_workers=args.workers, pin_memory=True, sampler=train_sampler, drop_last=False)
-    val_loader = torch.utils.data.DataLoader(
+    # worker processes or in-process threads (dataset/thread_loader.py)
+    loader_class = get_loader_class(args)
+    if getattr(train_ds, 'sample_weights', None) is not None:
+        if args.distributed:
+            train_sampler = WeightedSliceSampler(train_ds.sample_weights, train_ds.num_samples,
+                                                 dist.get_world_size(), dist.get_rank())
+        else:
+            train_sampler = WeightedSliceSampler(train_ds.sample_weights, train_ds.num_samples)
+
+    if isinstance(train_ds, ShardDataset):
+        # the stream splits its shards across ranks and workers itself, and takes set_epoch like a sampler
+        train_sampler = train_ds
+        train_loader = loader_class(
+            train_ds, batch_size=args.batch_size, num_workers=args.workers, pin_memory=True,
+            drop_last=False, collate_fn=get_collate_fn(train_ds))
+    else:
+        train_loader = loader_class(
+            train_ds, batch_size=args.batch_size, shuffle=(train_sampler is None),
+            num_workers=args.workers, pin_memory=True, sampler=train_sampler, drop_last=False,
+            collate_fn=get_collate_fn(train_ds))
+    if getattr(val_ds, 'native_labels', False):
+        # native-size labels only batch with labels of the same shape
+        val_sampler = shape_batch_sampler(val_ds, args, shuffle=True)
+        test_sampler = shape_batch_sampler(test_ds, args, shuffle=True)
+        val_loader = loader_class(
+            val_ds, batch_sampler=val_sampler, num_workers=args.workers, pin_memory=True,
+            collate_fn=get_collate_fn(val_ds))
+        test_loader = loader_class(
+            test_ds, batch_sampler=test_sampler, num_workers=args.workers, pin_memory=True,
+            collate_fn=get_collate_fn(test_ds))
+        return train_loader, train_sampler, val_loader, val_sampler, test_loader, test_sampler
+
+    val_loader = loader_class(
         val_ds, batch_size=args.batch_size, shuffle=(val_sampler is None),
-        num_workers=args.workers, pin_memory=True, sampler=val_sampler, drop_last=False
+        num_workers=args.workers, pin_memory=True, sampler=val_sampler, drop_last=False,
+        collate_fn=get_collate_fn(val_ds)
     )
 
-    test_loader = torch.utils.data.DataLoader(
+    test_loader = loader_class(
         test_ds, batch_size=args.batch_size, shuffle=(test_sampler is None),
-        num_workers=args.workers, pin_memory=True, sampler=test_sampler, drop_last=False
+        num_workers=args.workers, pin_memory=True, sampler=test_sampler, drop_last=False,
+        collate_fn=get_collate_fn(test_ds)
     )
 
     return train_loader, train_sampler, val_loader, val_sampler, test_loader, test_sampler
 
 
+def shape_batch_sampler(ds, args, shuffle=False):
+    """ShapeBatchSampler over the slice shapes of a dataset, split across ranks under distributed training."""
+    shapes = ds.manifest.shapes[ds.indices]
+    if args.distributed:
+        return ShapeBatchSampler(shapes, args.batch_size, shuffle, dist.get_world_size(), dist.get_rank())
+    return ShapeBatchSampler(shapes, args.batch_size, shuffle)
+
+
 def generate_test_loader(key, args):
     key = [key]
     if args.dataset == 'acdc' or args.dataset == 'ACDC':
         args.img_size = 224
-        test_ds = AcdcDataset(keys=key, mode='val', args=args)
+        test_ds = AcdcDataset(keys=key, mode='val', args=args, split='test')
     elif args.dataset == 'LP_CTA':
         args.img_size = 224
-        test_ds = LP_CTA_Dataset(keys=key, mode='val', args=args)
+        test_ds = LP_CTA_Dataset(keys=key, mode='val', args=args, split='test')
+    elif args.dataset in VOLUME_DATASETS:
+        args.img_size = 224
+        test_ds = VolumeDataset(keys=key, mode='val', args=args, split='test')
     else:
         raise NotImplementedError("dataset is not supported:", args.dataset)
 
@@ -81,14 +150,59 @@ def generate_test_loader(key, args):
     else:
         test_sampler = None
 
-    test_loader = torch.utils.data.DataLoader(
+    if getattr(test_ds, 'native_labels', False):
+        return get_loader_class(args, test=True)(
+            test_ds, batch_sampler=shape_batch_sampler(test_ds, args), num_workers=args.workers,
+            pin_memory=True, collate_fn=get_collate_fn(test_ds))
+
+    test_loader = get_loader_class(args, test=True)(
         test_ds, batch_size=args.batch_size, shuffle=False,
-        num_workers=args.workers, pin_memory=True, sampler=test_sampler, drop_last=False
+        num_workers=args.workers, pin_memory=True, sampler=test_sampler, drop_last=False,
+        collate_fn=get_collate_fn(test_ds)
     )
 
     return test_loader
 
 
+def rank_keys(keys, args):
+    """The share of the patient keys of this rank under distributed training (every world_size-th), all otherwise."""
+    if not args.distributed:
+        return keys
+    return keys[dist.get_rank()::dist.get_world_size()]
+
+
+def generate_volume_test_loader(args):
+    """
+    VolumeStream over the test patients of args.fold: one loader (and one set of workers) for the
+    whole test split instead of generate_test_loader per patient. Under distributed training every
+    rank streams its own share of the patients (rank_keys), whole volumes each.
+    """
+    split_dir = os.path.join(args.src_dir, "splits.pkl")
+    with open(split_dir, "rb") as f:
+        splits = pickle.load(f)
+    test_keys = rank_keys(splits[args.fold]['test'], args)
+
+    if args.dataset == 'acdc' or args.dataset == 'ACDC':
+        args.img_size = 224
+        test_ds = AcdcDataset(keys=test_keys, mode='val', args=args, split='test')
+    elif args.dataset == 'LP_CTA':
+        args.img_size = 224
+        test_ds = LP_CTA_Dataset(keys=test_keys, mode='val', args=args, split='test')
+    elif args.dataset in VOLUME_DATASETS:
+        args.img_size = 224
+        test_ds = VolumeDataset(keys=test_keys, mode='val', args=args, split='test')
+    else:
+        raise NotImplementedError("dataset is not supported:", args.dataset)
+
+    slice_keys = test_ds.manifest.keys[test_ds.manifest.folder_of_slice[test_ds.indices]]
+    batch_sampler = None
+    if getattr(test_ds, 'native_labels', False):
+        # in order, like the default loader
+        batch_sampler = ShapeBatchSampler(test_ds.manifest.shapes[test_ds.indices], args.batch_size)
+    return VolumeStream(test_ds, slice_keys, args, collate_fn=get_collate_fn(test_ds), batch_sampler=batch_sampler,
+                        loader_class=get_loader_class(args, test=True))
+
+
 def generate_contrast_dataset(args):
     split_dir = os.path.join(args.src_dir, "splits.pkl")
     with open(split_dir, "rb") as f:
@@ -110,6 +224,10 @@ def generate_contrast_dataset(args):
         args.img_size = 224
         train_ds = LP_CTA_Dataset(keys=tr_keys, mode='contrast', args=args)
         val_ds = LP_CTA_Dataset(keys=val_keys, mode='contrast', args=args)
+    elif args.dataset in VOLUME_DATASETS:
+        args.img_size = 224
+        train_ds = VolumeDataset(keys=tr_keys, mode='contrast', args=args)
+        val_ds = VolumeDataset(keys=val_keys, mode='contrast', args=args)
     else:
         raise NotImplementedError("dataset is not supported:", args.dataset)
 
@@ -120,10 +238,11 @@ def generate_contrast_dataset(args):
         train_sampler = None
         val_sampler = None
 
-    train_loader = torch.utils.data.DataLoader(
+    loader_class = get_loader_class(args)
+    train_loader = loader_class(
         train_ds, batch_size=args.batch_size, shuffle=(train_sampler is None),
         num_workers=args.workers, pin_memory=True, sampler=train_sampler, drop_last=False)
-    val_loader = torch.utils.data.DataLoader(
+    val_loader = loader_class(
         val_ds, batch_size=args.batch_size, shuffle=(val_sampler is None),
         num_workers=args.workers, pin_memory=True, sampler=val_sampler, drop_last=False
     )
@@ -0,0 +1,184 @@
+import os
+import re
+import gzip
+import shutil
+from collections import Counter
+import numpy as np
+import nibabel as nib
+import nrrd
+
+join = os.path.join
+
+VOLUME_SUFFIXES = ('.nii.gz', '.nii', '.seg.nrrd', '.nrrd')
+LABEL_MARKERS = ('_gt', '.seg', '-label')
+ACDC_NAME = re.compile(r'patient\d+_frame\d+')
+
+_cache_root = {}
+
+
+def volume_suffix(name):
+    for suffix in VOLUME_SUFFIXES:
+        if name.endswith(suffix):
+            return suffix
+    return None
+
+
+def is_volume_dir(data_dir):
+    """True if data_dir (searched recursively) holds .nii / .nii.gz / .nrrd files rather than PNG slices."""
+    if data_dir is None or not os.path.isdir(data_dir):
+        return False
+    for root, dirs, files in os.walk(data_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if volume_suffix(name):
+                return True
+            if name.endswith('.png'):
+                return False
+    return False
+
+
+def folder_name(stem):
+    """Manifest folder of a volume: raw ACDC names as the PNG converter writes them (patient_001_frame_01)."""
+    if ACDC_NAME.fullmatch(stem):
+        return stem.replace('patient', 'patient_').replace('frame', 'frame_')
+    return stem
+
+
+def set_cache_dir(data_dir, cache_dir):
+    """Decompress the volumes of data_dir into cache_dir instead of <data_dir>_volume_cache."""
+    _cache_root[os.path.normpath(data_dir)] = cache_dir
+
+
+class VolumeStore(object):
+    """
+    Slice reader for a folder of 3D volumes, the third layout of dataset/manifest.py next to PNG slices
+    and packed arrays. Every image volume under data_dir (searched recursively) is one manifest folder,
+    named after the file without its suffix (raw ACDC frames renamed as by the PNG converter, so that
+    patient001_frame01 has the patient key patient_001 of splits.pkl). Files of the same name in
+    different folders are named after their path relative to data_dir instead (1/img/CTA_1.nrrd ->
+    1_img_CTA_1). The label volume of an image is found next to it as
+        <name>_gt.nii[.gz]          (ACDC)
+        <name>.seg.nrrd             (3D Slicer segmentations)
+        ../labelsTr/<name>.nii.gz   (nnU-Net / MSD layout, images in imagesTr, optional _0000 suffix)
+    and an image without one is an error rather than an unlabeled (all background) volume. ACDC's 4D
+    cine volumes (<patient>_4d.nii.gz) are not indexed, and any other volume that is not 3D is rejected
+    when it is opened. Slice i of a volume is array[..., i].T, which is the slice the PNG converters
+    write for it (they go through SimpleITK's z, y, x order).
+
+    Raw LP_CTA patients are not supported: their labels sit in a sibling folder, their colour frames
+    are 4D, and the converter's intensity fix and label rescaling are not applied here. Convert them
+    with dataset/prepare_dataset/convert_to_imgs.py instead.
+
+    Uncompressed .nii files are memory-mapped in place. .nii.gz files are decompressed once into the
+    cache folder and memory-mapped from there, and .nrrd files are stored there as .npy. The memmaps
+    are opened lazily in every DataLoader worker, like PackedVolumeStore.
+    """
+    def __init__(self, data_dir, cache_dir=None):
+        self.data_dir = data_dir
+        if cache_dir is None:
+            cache_dir = _cache_root.get(os.path.normpath(data_dir), os.path.normpath(data_dir) + '_volume_cache')
+        self.cache_dir = cache_dir
+        found, unlabeled = [], []
+        for root, dirs, files in os.walk(data_dir):
+            dirs.sort()
+            for name in sorted(files):
+                suffix = volume_suffix(name)
+                if suffix is None or self._is_label(root, name, suffix) or name[:-len(suffix)].endswith('_4d'):
+                    continue
+                label = self._find_label(root, name, suffix)
+                if label is None:
+                    unlabeled.append(join(root, name))
+                found.append((root, name[:-len(suffix)], join(root, name), label))
+        if unlabeled:
+            raise ValueError('no label volume (<name>_gt, <name>.seg.nrrd or ../labelsTr/<name>) for %d images '
+                             'under %s, e.g. %s' % (len(unlabeled), data_dir, unlabeled[:3]))
+        stems = [folder_name(stem) for _, stem, _, _ in found]
+        counts = Counter(stems)
+        self.volumes = {}
+        for (root, stem, path, label), key in zip(found, stems):
+            if counts[key] > 1:
+                rel = os.path.relpath(root, data_dir)
+                key = folder_name(stem) if rel == '.' else '_'.join(rel.split(os.sep) + [folder_name(stem)])
+            if key in self.volumes:
+                raise ValueError('%s and %s both map to the volume key %s' % (self.volumes[key][0], path, key))
+            self.volumes[key] = (path, label)
+        self._arrays = {}
+
+    @staticmethod
+    def _is_label(root, name, suffix):
+        stem = name[:-len(suffix)]
+        return suffix == '.seg.nrrd' or stem.endswith(LABEL_MARKERS) or os.path.basename(root) == 'labelsTr'
+
+    @staticmethod
+    def _find_label(root, name, suffix):
+        stem = name[:-len(suffix)]
+        candidates = [join(root, stem + '_gt' + suffix), join(root, stem + '.seg.nrrd'),
+                      join(os.path.dirname(root), 'labelsTr', stem + suffix)]
+        if stem.endswith('_0000'):
+            candidates.append(join(os.path.dirname(root), 'labelsTr', stem[:-5] + suffix))
+        for candidate in candidates:
+            if os.path.isfile(candidate):
+                return candidate
+        return None
+
+    def folders(self):
+        return list(self.volumes.keys())
+
+    def files(self):
+        return [p for pair in self.volumes.values() for p in pair]
+
+    def slice_names(self, folder):
+        return ['%s_%03d' % (folder, i) for i in range(self._open(folder)[0].shape[-1])]
+
+    def _cached(self, path, ext):
+        # x.nii.gz -> x.nii, x.nrrd -> x.npy, x.seg.nrrd -> x.seg.npy
+        cached = join(self.cache_dir, os.path.relpath(path, self.data_dir))
+        cached = cached[:-len('.gz')] if ext == '.nii' else cached[:-len('.nrrd')] + ext
+        if not os.path.isfile(cached) or os.path.getmtime(cached) < os.path.getmtime(path):
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            tmp = cached + '.%d.tmp' % os.getpid()
+            if ext == '.npy':
+                np.save(tmp, nrrd.read(path)[0])
+                os.replace(tmp + '.npy', cached)
+            else:
+                with gzip.open(path, 'rb') as src, open(tmp, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1 << 24)
+                os.replace(tmp, cached)
+        return cached
+
+    def _array(self, path):
+        if path.endswith('.nrrd'):
+            return np.load(self._cached(path, '.npy'), mmap_mode='r')
+        if path.endswith('.gz'):
+            path = self._cached(path, '.nii')
+        # unscaled data is a memmap; the slope/intercept would not change the per-slice min-max normalization
+        return nib.load(path, mmap=True).dataobj.get_unscaled()
+
+    def prepare(self, folders=None):
+        """Decompress the given volumes (all by default) into the cache up front, in the main process."""
+        for folder in self.folders() if folders is None else folders:
+            for path in self.volumes[folder]:
+                if path.endswith('.gz') or path.endswith('.nrrd'):
+                    self._cached(path, '.npy' if path.endswith('.nrrd') else '.nii')
+
+    def _open(self, folder):
+        if folder not in self._arrays:
+            img_path, label_path = self.volumes[folder]
+            img = self._array(img_path)
+            label = self._array(label_path)
+            for path, arr in ((img_path, img), (label_path, label)):
+                if arr.ndim != 3:
+                    raise ValueError('%s has shape %s, expected a 3D volume' % (path, arr.shape))
+            self._arrays[folder] = (img, label)
+        return self._arrays[folder]
+
+    def read_slice(self, folder, i):
+        """Image and label of the i-th slice of a volume, read from the memory-mapped arrays."""
+        img, label = self._open(folder)
+        return np.asarray(img[..., i]).T, np.asarray(label[..., i]).T
+
+    def __getstate__(self):
+        # memmaps are reopened in every worker instead of being pickled
+        state = self.__dict__.copy()
+        state['_arrays'] = {}
+        return state
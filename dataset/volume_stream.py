@@ -0,0 +1,71 @@
+import numpy as np
+
+import torch
+
+
+class VolumeStream(object):
+    """
+    One persistent DataLoader over the slices of all test volumes, in volume order.
+
+    The slices of consecutive volumes are packed into full batches, so a volume may start or end
+    in the middle of a batch. Next to every batch the stream yields its patient boundaries as
+    segments (key, start, end, complete): rows start:end of the batch belong to patient key, and
+    complete is True if row end - 1 is the last slice of that patient. slice_keys [N] gives the
+    patient key of every dataset item; the items of one patient must be contiguous. A batch_sampler
+    must keep that order (e.g. ShapeBatchSampler without shuffle); its batches may be shorter.
+    loader_class is DataLoader or dataset/thread_loader.py::ThreadDataLoader.
+    """
+    def __init__(self, dataset, slice_keys, args, collate_fn=None, batch_sampler=None,
+                 loader_class=torch.utils.data.DataLoader):
+        self.slice_keys = np.asarray(slice_keys, dtype=str)
+        assert len(self.slice_keys) == len(dataset)
+        self.dataset = dataset
+        if batch_sampler is not None:
+            batching = dict(batch_sampler=batch_sampler)
+        else:
+            batching = dict(batch_size=args.batch_size, shuffle=False, drop_last=False)
+        self.loader = loader_class(
+            dataset, num_workers=args.workers, pin_memory=True,
+            persistent_workers=args.workers > 0, collate_fn=collate_fn, **batching)
+        # first slice of every patient, and the end of the last one
+        self.starts = np.concatenate([[0], np.nonzero(self.slice_keys[1:] != self.slice_keys[:-1])[0] + 1,
+                                      [len(self.slice_keys)]])
+
+    def __len__(self):
+        return len(self.loader)
+
+    def keys(self):
+        return [str(self.slice_keys[s]) for s in self.starts[:-1]]
+
+    def segments(self, pos, b):
+        """Patient segments of the batch covering stream slices pos:pos + b."""
+        cuts = self.starts[(self.starts > pos) & (self.starts < pos + b)]
+        bounds = np.concatenate([[pos], cuts, [pos + b]])
+        return [(str(self.slice_keys[s]), int(s - pos), int(e - pos), bool(e in self.starts))
+                for s, e in zip(bounds[:-1], bounds[1:])]
+
+    def __iter__(self):
+        pos = 0
+        for tup in self.loader:
+            b = len(tup[0])
+            yield tup[0], tup[1], self.segments(pos, b)
+            pos += b
+
+
+class VolumeAssembler(object):
+    """
+    Reassembles per-slice outputs of a VolumeStream: add() takes the segments of a batch and any
+    number of arrays with one row per slice, and returns (key, *volumes) for every patient whose
+    last slice was in the batch, each volume the concatenation of that patient's rows.
+    """
+    def __init__(self):
+        self.parts = {}
+
+    def add(self, segments, *arrays):
+        done = []
+        for key, start, end, complete in segments:
+            self.parts.setdefault(key, []).append([a[start:end] for a in arrays])
+            if complete:
+                parts = self.parts.pop(key)
+                done.append((key,) + tuple(np.concatenate(p, axis=0) for p in zip(*parts)))
+        return done
@@ -6,6 +6,11 @@ import torch.nn.functional as F
 from segment_anything.modeling.prompt_encoder import PositionEmbeddingRandom
 
 
+def to_encoder_input(x):
+    """Single-channel slices [B, 1, H, W] broadcast to the RGB input of the image encoder, without a copy."""
+    return x.expand(-1, 3, -1, -1) if x.shape[1] == 1 else x
+
+
 class AutoSamSeg(nn.Module):
     def __init__(
         self,
@@ -18,30 +23,79 @@ class AutoSamSeg(nn.Module):
         self.image_encoder = image_encoder
         self.mask_decoder = seg_decoder
         self.pe_layer = PositionEmbeddingRandom(128)
+        # with partial encoder fine-tuning, embeddings (is_embedding=True) are the input of this
+        # encoder block instead of the encoder output, see dataset/embedding_cache.py
+        self.embedding_block = None
+        # dense position encoding per embedding grid, see image_pe
+        self.cache_pe = True
+        self._pe_cache = {}
 
     def forward(self,
-                x):
-        original_size = x.shape[-1]
-        x = F.interpolate(
-            x,
-            (self.image_encoder.img_size, self.image_encoder.img_size),
-            mode="bilinear",
-            align_corners=False,
-        )
-        image_embedding = self.image_encoder(x) #[B, 256, 64, 64]
-        img_pe = self.pe_layer([64, 64]).unsqueeze(0)
+                x,
+                output_size=None,
+                is_embedding=False):
+        """
+        x is either an image batch [B, C, H, W] or, with is_embedding=True, the
+        output of the frozen image encoder [B, 256, img_size / 16, img_size / 16] (see dataset/embedding_cache.py),
+        or the input of encoder block embedding_block if that is set.
+        The mask is resized to output_size, an int or (h, w), which defaults to the input image size.
+        """
+        if is_embedding and self.embedding_block is not None:
+            image_embedding = self.image_encoder.forward_from(x, self.embedding_block)
+        elif is_embedding:
+            image_embedding = x
+        else:
+            if output_size is None:
+                output_size = tuple(x.shape[-2:])
+            image_embedding = self.encode(x)
+        return self.decode(image_embedding, output_size)
+
+    def encode(self, x, until_block=None):
+        if x.shape[-1] != self.image_encoder.img_size or x.shape[-2] != self.image_encoder.img_size:
+            # skipped for batches that dataset/transport.py::DevicePreprocess already resized
+            x = F.interpolate(
+                x,
+                (self.image_encoder.img_size, self.image_encoder.img_size),
+                mode="bilinear",
+                align_corners=False,
+            )
+        x = to_encoder_input(x)
+        if until_block is not None:
+            return self.image_encoder.forward_until(x, until_block)
+        return self.image_encoder(x)  # [B, 256, 64, 64] at img_size 1024
+
+    def decode(self, image_embedding, output_size=None):
+        img_pe = self.image_pe(tuple(image_embedding.shape[-2:]))
         mask, iou_pred = self.mask_decoder(image_embeddings=image_embedding.unsqueeze(1),
                                            image_pe=img_pe, )
 
-        if mask.shape[-1] != original_size:
+        if isinstance(output_size, int):
+            output_size = (output_size, output_size)
+        if output_size is not None and tuple(mask.shape[-2:]) != tuple(output_size):
             mask = F.interpolate(
                 mask,
-                (original_size, original_size),
+                tuple(output_size),
                 mode="bilinear",
                 align_corners=False,
             )
         return mask, iou_pred
 
+    def image_pe(self, size):
+        """
+        pe_layer(size) as [1, 256, h, w], computed once per grid size and again only when the random
+        frequency buffer changes (load_state_dict, .to()).
+        """
+        if not self.cache_pe:
+            return self.pe_layer(list(size)).unsqueeze(0)
+        gaussian = self.pe_layer.positional_encoding_gaussian_matrix
+        version = (gaussian._version, gaussian.data_ptr())
+        cached = self._pe_cache.get(size)
+        if cached is None or cached[0] != version:
+            with torch.no_grad():
+                cached = (version, self.pe_layer(list(size)).unsqueeze(0))
+            self._pe_cache[size] = cached
+        return cached[1]
+
     def get_embedding(self, x):
         original_size = x.shape[-1]
         x = F.interpolate(
@@ -50,6 +104,7 @@ class AutoSamSeg(nn.Module):
             mode="bilinear",
             align_corners=False,
         )
+        x = to_encoder_input(x)
         image_embedding = self.image_encoder(x)
         out = nn.functional.adaptive_avg_pool2d(image_embedding, 1).squeeze()
         return out
@@ -7,6 +7,8 @@ from typing import List, Tuple, Type
 from segment_anything.modeling import ImageEncoderViT
 from segment_anything.modeling.common import LayerNorm2d
 
+from .AutoSamSeg import to_encoder_input
+
 
 class SamFeatSeg(nn.Module):
     def __init__(
@@ -21,21 +23,27 @@ class SamFeatSeg(nn.Module):
         self.mask_decoder = seg_decoder
 
     def forward(self,
-                x):
-        original_size = x.shape[-1]
-        x = F.interpolate(
-            x,
-            (self.image_encoder.img_size, self.image_encoder.img_size),
-            mode="bilinear",
-            align_corners=False,
-        )
+                x,
+                output_size=None):
+        # output_size is an int or (h, w), e.g. the native size of the labels with resize_once
+        original_size = tuple(x.shape[-2:]) if output_size is None else output_size
+        if isinstance(original_size, int):
+            original_size = (original_size, original_size)
+        if x.shape[-1] != self.image_encoder.img_size or x.shape[-2] != self.image_encoder.img_size:
+            x = F.interpolate(
+                x,
+                (self.image_encoder.img_size, self.image_encoder.img_size),
+                mode="bilinear",
+                align_corners=False,
+            )
+        x = to_encoder_input(x)
         image_embedding = self.image_encoder(x) #[B, 256, 64, 64]
         out = self.mask_decoder(image_embedding)
 
-        if out.shape[-1] != original_size:
+        if tuple(out.shape[-2:]) != tuple(original_size):
             out = F.interpolate(
                 out,
-                (original_size, original_size),
+                tuple(original_size),
                 mode="bilinear",
                 align_corners=False,
             )
@@ -49,6 +57,7 @@ class SamFeatSeg(nn.Module):
             mode="bilinear",
             align_corners=False,
         )
+        x = to_encoder_input(x)
         image_embedding = self.image_encoder(x)
         out = nn.functional.adaptive_avg_pool2d(image_embedding, 1).squeeze()
         return out
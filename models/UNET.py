@@ -159,6 +159,7 @@ class NestedUNet(nn.Module):
 
         nb_filter = [32, 64, 128, 256, 512]
 
+        self.input_channels = input_channels
         self.deep_supervision = deep_supervision
 
         self.pool = nn.MaxPool2d(2, 2)
@@ -193,6 +194,9 @@ class NestedUNet(nn.Module):
             self.final = nn.Conv2d(nb_filter[0], num_classes, kernel_size=1)
 
     def forward(self, input):
+        if input.shape[1] == 1 and self.input_channels != 1:
+            # single-channel slices, broadcast without a copy
+            input = input.expand(-1, self.input_channels, -1, -1)
         x0_0 = self.conv0_0(input)
         x1_0 = self.conv1_0(self.pool(x0_0))
         x0_1 = self.conv0_1(torch.cat([x0_0, self.up(x1_0)], 1))
@@ -5,6 +5,8 @@ from functools import partial
 from .SamFeatSeg import SamFeatSeg, SegDecoderCNN
 from .AutoSamSeg import AutoSamSeg
 from .sam_decoder import MaskDecoder
+from .pos_embed import adapt_sam_state_dict
+from segment_anything.modeling.attention_backends import set_attention_backend
 from segment_anything.modeling import ImageEncoderViT, TwoWayTransformer
 
 
@@ -15,9 +17,15 @@ def _build_sam_seg_model(
     encoder_global_attn_indexes,
     num_classes,
     checkpoint=None,
+    class_batched=False,
+    img_size=1024,
+    attention='naive',
+    attention_chunk=1024,
+    token_skip=None,
 ):
+    # img_size below the 1024 of the checkpoints shrinks the token grid, e.g. 512 -> 32x32 tokens
     prompt_embed_dim = 256
-    image_size = 1024
+    image_size = img_size
     vit_patch_size = 16
     sam_seg = AutoSamSeg(
         image_encoder=ImageEncoderViT(
@@ -33,6 +41,7 @@ def _build_sam_seg_model(
             global_attn_indexes=encoder_global_attn_indexes,
             window_size=14,
             out_chans=prompt_embed_dim,
+            token_skip_threshold=token_skip,
         ),
         seg_decoder=MaskDecoder(
             num_multimask_outputs=1,
@@ -46,12 +55,15 @@ def _build_sam_seg_model(
             iou_head_depth=3,
             iou_head_hidden_dim=256,
             num_classes=num_classes,
+            class_batched=class_batched,
         ),
+        img_size=image_size,
     )
 
     if checkpoint is not None:
         with open(checkpoint, "rb") as f:
             state_dict = torch.load(f)
+        state_dict = adapt_sam_state_dict(state_dict, sam_seg)
 
         loaded_keys = {}
         for k in state_dict.keys():
@@ -60,10 +72,12 @@ def _build_sam_seg_model(
         sam_seg.load_state_dict(loaded_keys, strict=False)
         print("loaded keys:", loaded_keys.keys())
 
+    # naive / sdpa / chunked, see segment_anything/modeling/attention_backends.py
+    set_attention_backend(sam_seg, attention, chunk_size=attention_chunk)
     return sam_seg
 
 
-def build_sam_vit_h_seg_cnn(num_classes=14, checkpoint=None):
+def build_sam_vit_h_seg_cnn(num_classes=14, checkpoint=None, **kwargs):
     return _build_sam_seg_model(
         encoder_embed_dim=1280,
         encoder_depth=32,
@@ -71,13 +85,14 @@ def build_sam_vit_h_seg_cnn(num_classes=14, checkpoint=None):
         encoder_global_attn_indexes=[7, 15, 23, 31],
         num_classes=num_classes,
         checkpoint=checkpoint,
+        **kwargs,
     )
 
 
 build_sam_seg = build_sam_vit_h_seg_cnn
 
 
-def build_sam_vit_l_seg_cnn(num_classes=14, checkpoint=None):
+def build_sam_vit_l_seg_cnn(num_classes=14, checkpoint=None, **kwargs):
     return _build_sam_seg_model(
         encoder_embed_dim=1024,
         encoder_depth=24,
@@ -85,10 +100,11 @@ def build_sam_vit_l_seg_cnn(num_classes=14, checkpoint=None):
         encoder_global_attn_indexes=[5, 11, 17, 23],
         num_classes=num_classes,
         checkpoint=checkpoint,
+        **kwargs,
     )
 
 
-def build_sam_vit_b_seg_cnn(num_classes=14, checkpoint=None):
+def build_sam_vit_b_seg_cnn(num_classes=14, checkpoint=None, **kwargs):
     return _build_sam_seg_model(
         encoder_embed_dim=768,
         encoder_depth=12,
@@ -96,6 +112,7 @@ def build_sam_vit_b_seg_cnn(num_classes=14, checkpoint=None):
         encoder_global_attn_indexes=[2, 5, 8, 11],
         num_classes=num_classes,
         checkpoint=checkpoint,
+        **kwargs,
     )
 
 
@@ -0,0 +1,87 @@
+import math
+
+CHECKPOINT_POLICIES = ['none', 'all', 'every', 'global', 'budget']
+
+
+def _bytes_per_value(encoder):
+    return next(encoder.parameters()).element_size()
+
+
+def block_activation_bytes(encoder, batch_size=1):
+    """
+    Estimated activation memory autograd keeps for each block of an ImageEncoderViT, in bytes:
+    about 16 token-sized tensors (norms, qkv, attention output, residuals, the 4x MLP hidden layer
+    before and after the activation) plus, per head, the softmax of the naive attention backend
+    (logits and rel-pos bias are transient). Global blocks attend over all T = (img_size / 16)^2
+    tokens; windowed blocks over padded 14x14 windows. The fused sdpa kernels store less.
+    """
+    grid = encoder.img_size // encoder.patch_size
+    tokens = grid * grid
+    sizes = []
+    for blk in encoder.blocks:
+        dim = blk.norm1.normalized_shape[0]
+        if blk.window_size > 0:
+            attention = math.ceil(grid / blk.window_size) ** 2 * blk.window_size ** 4
+        else:
+            attention = tokens * tokens
+        values = 16 * tokens * dim + blk.attn.num_heads * attention
+        sizes.append(values * batch_size * _bytes_per_value(encoder))
+    return sizes
+
+
+def estimated_activation_bytes(encoder, checkpointed, batch_size=1):
+    """
+    Estimated peak activation memory of the encoder blocks with the checkpointed blocks keeping only
+    their input, plus the recomputation of the largest checkpointed block in the backward pass.
+    """
+    sizes = block_activation_bytes(encoder, batch_size)
+    grid = encoder.img_size // encoder.patch_size
+    total = 0
+    for i, (blk, size) in enumerate(zip(encoder.blocks, sizes)):
+        if i in checkpointed:
+            total += grid * grid * blk.norm1.normalized_shape[0] * batch_size * _bytes_per_value(encoder)
+        else:
+            total += size
+    return total + max([sizes[i] for i in checkpointed] or [0])
+
+
+def checkpoint_policy(encoder, policy='none', every=2, budget_gb=None, batch_size=1):
+    """
+    Indices of the encoder blocks to run under activation checkpointing:
+        none     no block
+        all      every block
+        every    every k-th block (0, k, 2k, ...)
+        global   the global attention blocks, which hold the [T, T] attention maps
+        budget   the fewest blocks, largest first, that bring estimated_activation_bytes under
+                 budget_gb (all blocks if the budget cannot be met)
+    """
+    depth = len(encoder.blocks)
+    if policy == 'none':
+        return set()
+    if policy == 'all':
+        return set(range(depth))
+    if policy == 'every':
+        return set(range(0, depth, every))
+    if policy == 'global':
+        return {i for i, blk in enumerate(encoder.blocks) if blk.window_size == 0}
+    if policy == 'budget':
+        if budget_gb is None:
+            raise ValueError("the budget policy needs --memory_budget")
+        sizes = block_activation_bytes(encoder, batch_size)
+        chosen = set()
+        for i in sorted(range(depth), key=lambda i: -sizes[i]):
+            if estimated_activation_bytes(encoder, chosen, batch_size) <= budget_gb * 2 ** 30:
+                break
+            chosen.add(i)
+        return chosen
+    raise ValueError("unknown checkpoint policy %s, choose from %s" % (policy, CHECKPOINT_POLICIES))
+
+
+def set_encoder_checkpointing(encoder, policy='none', every=2, budget_gb=None, batch_size=1):
+    """Apply checkpoint_policy to encoder (ImageEncoderViT.checkpoint_blocks) and report the estimate."""
+    encoder.checkpoint_blocks = checkpoint_policy(encoder, policy, every, budget_gb, batch_size)
+    if policy != 'none':
+        print('activation checkpointing (%s): blocks %s, estimated activations %.2f GB at batch %d'
+              % (policy, sorted(encoder.checkpoint_blocks),
+                 estimated_activation_bytes(encoder, encoder.checkpoint_blocks, batch_size) / 2 ** 30, batch_size))
+    return encoder.checkpoint_blocks
@@ -13,6 +13,8 @@ import logging
 from torch import Tensor
 from torch import nn
 
+from segment_anything.modeling.attention_backends import get_attention_backend
+
 
 logger = logging.getLogger("dinov2")
 
@@ -45,18 +47,18 @@ class Attention(nn.Module):
         self.attn_drop = nn.Dropout(attn_drop)
         self.proj = nn.Linear(dim, dim, bias=proj_bias)
         self.proj_drop = nn.Dropout(proj_drop)
+        # see segment_anything/modeling/attention_backends.py; switched with set_attention_backend
+        self.attention_backend = get_attention_backend("naive")
 
     def forward(self, x: Tensor) -> Tensor:
         B, N, C = x.shape
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
 
-        q, k, v = qkv[0] * self.scale, qkv[1], qkv[2]
-        attn = q @ k.transpose(-2, -1)
-
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+        dropout_p = self.attn_drop.p if self.training else 0.0
+        x = self.attention_backend(q, k, v, None, self.scale, dropout_p)
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -65,6 +67,7 @@ class Attention(nn.Module):
 class MemEffAttention(Attention):
     def forward(self, x: Tensor, attn_bias=None) -> Tensor:
         if not XFORMERS_AVAILABLE:
+            # the attention backend of the layer (naive unless set_attention_backend chose another)
             assert attn_bias is None, "xFormers is required for nested tensors usage"
             return super().forward(x)
 
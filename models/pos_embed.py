@@ -0,0 +1,38 @@
+import torch.nn.functional as F
+
+
+def resize_pos_embed(pos_embed, size):
+    """Bicubic resampling of an absolute position embedding [1, H, W, C] to [1, size[0], size[1], C]."""
+    if tuple(pos_embed.shape[1:3]) == tuple(size):
+        return pos_embed
+    resized = F.interpolate(pos_embed.permute(0, 3, 1, 2).float(), size=tuple(size),
+                            mode='bicubic', align_corners=False)
+    return resized.permute(0, 2, 3, 1).to(pos_embed.dtype)
+
+
+def resize_rel_pos(rel_pos, length):
+    """Linear resampling of a relative position table [L, C] to [length, C], as get_rel_pos does per call."""
+    if rel_pos.shape[0] == length:
+        return rel_pos
+    resized = F.interpolate(rel_pos.t()[None].float(), size=length, mode='linear', align_corners=False)
+    return resized[0].t().to(rel_pos.dtype)
+
+
+def adapt_sam_state_dict(state_dict, model):
+    """
+    Resample the position tables of a SAM checkpoint to the grid of model, whose image encoder may
+    be built for an img_size other than the 1024 of the checkpoint: image_encoder.pos_embed (bicubic)
+    and the rel_pos_h / rel_pos_w tables of the global attention blocks (linear; the windowed blocks
+    keep their 14x14 tables). Done once at load time, instead of interpolating in every forward pass.
+    Returns a new dict; other entries are passed through.
+    """
+    target = model.state_dict()
+    state_dict = dict(state_dict)
+    for k, v in state_dict.items():
+        if k not in target or target[k].shape == v.shape:
+            continue
+        if k.endswith('pos_embed') and v.dim() == 4:
+            state_dict[k] = resize_pos_embed(v, target[k].shape[1:3])
+        elif k.endswith(('rel_pos_h', 'rel_pos_w')) and v.dim() == 2:
+            state_dict[k] = resize_rel_pos(v, target[k].shape[0])
+    return state_dict
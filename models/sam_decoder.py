@@ -24,6 +24,7 @@ class MaskDecoder(nn.Module):
         iou_head_depth: int = 3,
         iou_head_hidden_dim: int = 256,
         num_classes: int = 4,
+        class_batched: bool = False,
     ) -> None:
         """
         Predicts masks given an image and prompt embeddings, using a
@@ -40,6 +41,15 @@ class MaskDecoder(nn.Module):
             mask quality
           iou_head_hidden_dim (int): the hidden dimension of the MLP
             used to predict mask quality
+          num_classes (int): the number of classes, each owning an iou token
+            and num_multimask_outputs + 1 mask tokens
+          class_batched (bool): If True, the token groups of all classes are
+            decoded in one transformer pass against a single copy of the image
+            embedding instead of one copy per class (see predict_masks_shared).
+            Both modes load the same weights but predict different masks from
+            them, so a decoder should be evaluated in the mode it was trained in
+            (main_autosam_seg.py warns on --resume if the checkpoint's
+            'class_batched' entry differs).
         """
         super().__init__()
         self.transformer_dim = transformer_dim
@@ -47,6 +57,7 @@ class MaskDecoder(nn.Module):
 
         self.num_multimask_outputs = num_multimask_outputs
         self.num_classes = num_classes
+        self.class_batched = class_batched
 
         self.iou_token = nn.Embedding(num_classes, transformer_dim)
         #self.iou_token = nn.Embedding(1, transformer_dim)
@@ -93,10 +104,16 @@ class MaskDecoder(nn.Module):
           torch.Tensor: batched predicted masks
           torch.Tensor: batched predictions of mask quality
         """
-        masks, iou_pred = self.predict_masks_1(
-            image_embeddings=image_embeddings,
-            image_pe=image_pe,
-        )
+        if self.class_batched:
+            masks, iou_pred = self.predict_masks_shared(
+                image_embeddings=image_embeddings,
+                image_pe=image_pe,
+            )
+        else:
+            masks, iou_pred = self.predict_masks_1(
+                image_embeddings=image_embeddings,
+                image_pe=image_pe,
+            )
 
         # Select the correct mask or masks for outptu
         if multimask_output:
@@ -184,6 +201,56 @@ class MaskDecoder(nn.Module):
 
         return masks, iou_pred
 
+    def predict_masks_shared(
+        self,
+        image_embeddings: torch.Tensor,
+        image_pe: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Outputs of the same shape as predict_masks_1 ([B*num_classes, num_mask_tokens, H, W] masks),
+        but the token groups of all classes go through the transformer together, so the 64x64 image
+        embedding is attended and upscaled once per image instead of once per class. A block
+        diagonal mask keeps the token self attention within each class group, but the image
+        embedding is updated by attending to the tokens of all classes, so the masks differ from
+        those of predict_masks_1 with the same weights (they agree only for a single class). A
+        decoder has to be evaluated in the mode it was trained in.
+        """
+        group_size = 1 + self.num_mask_tokens
+        mask_tokens = self.mask_tokens.weight.view(-1, self.num_mask_tokens, self.transformer_dim)
+        output_tokens = torch.cat([self.iou_token.weight.unsqueeze(1), mask_tokens], dim=1)
+        tokens = output_tokens.flatten(0, 1).unsqueeze(0).repeat(image_embeddings.size(0), 1, 1)
+
+        group = torch.arange(self.num_classes, device=tokens.device).repeat_interleave(group_size)
+        query_mask = torch.zeros(group.shape[0], group.shape[0], device=tokens.device, dtype=tokens.dtype)
+        query_mask.masked_fill_(group[:, None] != group[None, :], float("-inf"))
+
+        src = image_embeddings.squeeze(1)
+        pos_src = torch.repeat_interleave(image_pe, src.shape[0], dim=0)
+
+        b, c, h, w = src.shape
+
+        # Run the transformer
+        hs, src = self.transformer(src, pos_src, tokens, query_mask=query_mask)
+        hs = hs.view(b, self.num_classes, group_size, c)
+        iou_token_out = hs[:, :, 0, :]
+        mask_tokens_out = hs[:, :, 1:, :]
+
+        # Upscale mask embeddings once per image and predict the masks of all classes from it
+        src = src.transpose(1, 2).view(b, c, h, w)
+        upscaled_embedding = self.output_upscaling(src)
+        hyper_in_list: List[torch.Tensor] = []
+        for i in range(self.num_mask_tokens):
+            hyper_in_list.append(self.output_hypernetworks_mlps[i](mask_tokens_out[:, :, i, :]))
+        hyper_in = torch.stack(hyper_in_list, dim=2)
+        b, c, h, w = upscaled_embedding.shape
+        masks = (hyper_in.flatten(1, 2) @ upscaled_embedding.view(b, c, h * w))
+        masks = masks.view(b * self.num_classes, self.num_mask_tokens, h, w)
+
+        # Generate mask quality predictions
+        iou_pred = self.iou_prediction_head(iou_token_out).flatten(0, 1)
+
+        return masks, iou_pred
+
 # Lightly adapted from
 # https://github.com/facebookresearch/MaskFormer/blob/main/mask_former/modeling/transformer/transformer_predictor.py # noqa
 class MLP(nn.Module):
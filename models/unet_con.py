@@ -8,6 +8,7 @@ class SupConUnet(nn.Module):
                  kernel_size=3, do_instancenorm=True, mode="cls"):
         super(SupConUnet, self).__init__()
 
+        self.in_channels = in_channels
         self.encoder = UNet(num_classes, in_channels, initial_filter_size, kernel_size, do_instancenorm)
         if mode == 'mlp':
             self.head = nn.Sequential(nn.Conv2d(initial_filter_size, 256, kernel_size=1),
@@ -18,6 +19,9 @@ class SupConUnet(nn.Module):
             raise NotImplemented("This mode is not supported yet")
 
     def forward(self, x):
+        if x.shape[1] == 1 and self.in_channels != 1:
+            # single-channel slices, broadcast without a copy
+            x = x.expand(-1, self.in_channels, -1, -1)
         y = self.encoder(x)
         output = self.head(y)
         # output = F.normalize(self.head(y), dim=1)
@@ -0,0 +1,61 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+import time
+
+import torch
+
+from segment_anything.modeling.image_encoder import Attention
+from segment_anything.modeling.attention_backends import ATTENTION_BACKENDS, get_attention_backend
+
+
+parser = argparse.ArgumentParser(description='Attention backends on the global attention blocks of the SAM image encoder')
+parser.add_argument('--model_types', type=str, default='vit_b,vit_l,vit_h')
+parser.add_argument('--grid', default=64, type=int, help='token grid side, 64 (4096 tokens) for 1024 inputs')
+parser.add_argument('--backends', type=str, default=','.join(ATTENTION_BACKENDS))
+parser.add_argument('--chunk_size', default=1024, type=int)
+parser.add_argument('--iters', default=3, type=int)
+parser.add_argument('--threads', default=None, type=int)
+
+# embed_dim, num_heads of the image encoders
+ENCODERS = {'vit_b': (768, 12), 'vit_l': (1024, 16), 'vit_h': (1280, 16)}
+
+
+def time_block(attn, x, iters):
+    with torch.no_grad():
+        out = attn(x)
+        start = time.time()
+        for _ in range(iters):
+            attn(x)
+    return out, (time.time() - start) / iters
+
+
+def main():
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    print('%d tokens, %d threads, %d iterations' % (args.grid ** 2, torch.get_num_threads(), args.iters))
+    print('%-6s | %-8s | %10s | %8s | %12s' % ('model', 'backend', 'ms', 'speedup', 'max |diff|'))
+    for model_type in args.model_types.split(','):
+        dim, heads = ENCODERS[model_type]
+        attn = Attention(dim, num_heads=heads, use_rel_pos=True, input_size=(args.grid, args.grid)).eval()
+        # the checkpoint tables are not zero; random ones exercise the rel-pos bias of every backend
+        torch.nn.init.normal_(attn.rel_pos_h, std=0.02)
+        torch.nn.init.normal_(attn.rel_pos_w, std=0.02)
+        x = torch.randn(1, args.grid, args.grid, dim)
+
+        reference, base = None, None
+        for backend in args.backends.split(','):
+            options = {'chunk_size': args.chunk_size} if backend == 'chunked' else {}
+            attn.attention_backend = get_attention_backend(backend, **options)
+            out, seconds = time_block(attn, x, args.iters)
+            if reference is None:
+                reference, base = out, seconds
+            print('%-6s | %-8s | %10.1f | %7.2fx | %12.2e' % (model_type, backend, seconds * 1e3, base / seconds,
+                                                              (out - reference).abs().max().item()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+import time
+
+import numpy as np
+import torch
+from torch.utils.data._utils.collate import default_collate
+
+from dataset.transforms import get_train_transform, get_val_transform
+from dataset.batch_augment import BatchAugmentation
+from dataset.elastic_bank import ElasticFieldBank
+
+
+parser = argparse.ArgumentParser(description='Per-sample batchgenerators Compose vs batched augmentation, CPU throughput')
+parser.add_argument('-b', '--batch-size', default=8, type=int)
+parser.add_argument('--img_size', default=224, type=int)
+parser.add_argument('--src_size', default=256, type=int, help='size of the synthetic slices before resizing')
+parser.add_argument('--num_classes', default=4, type=int)
+parser.add_argument('--iters', default=5, type=int)
+parser.add_argument('--threads', default=1, type=int,
+                    help='torch threads, 1 matches a DataLoader worker')
+parser.add_argument('--elastic_bank', default=128, type=int,
+                    help='also time both paths with a bank of this many elastic fields (0: skip)')
+
+
+def synthetic_batch(args):
+    imgs = np.random.rand(args.batch_size, 3, args.src_size, args.src_size).astype(np.float32)
+    labels = np.random.randint(0, args.num_classes, (args.batch_size, args.src_size, args.src_size)).astype(np.uint8)
+    return imgs, labels
+
+
+def rebuilt_compose(imgs, labels, patch_size):
+    # the old __getitem__: a new Compose per sample, applied to a batch of one
+    batch = []
+    for img, label in zip(imgs, labels):
+        data_dict = get_train_transform(patch_size)(data=img[None], seg=label[None, None])
+        batch.append((data_dict['data'][0], data_dict['seg'][0]))
+    return default_collate(batch)
+
+
+def shared_compose(imgs, labels, patch_size, aug):
+    batch = []
+    for img, label in zip(imgs, labels):
+        data_dict = aug(data=img[None], seg=label[None, None])
+        batch.append((data_dict['data'][0], data_dict['seg'][0]))
+    return default_collate(batch)
+
+
+def batched(imgs, labels, resize, aug):
+    # what BatchAugmentCollate does: per-sample resize only, then one augmentation call per batch
+    return aug(*shared_compose(imgs, labels, None, resize))
+
+
+def time_fn(fn, args):
+    fn()
+    start = time.time()
+    for _ in range(args.iters):
+        fn()
+    return (time.time() - start) / args.iters
+
+
+def main():
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+    patch_size = (args.img_size, args.img_size)
+    imgs, labels = synthetic_batch(args)
+
+    train_transform = get_train_transform(patch_size)
+    resize = get_val_transform(patch_size)
+    batch_aug = BatchAugmentation(patch_size)
+
+    results = [
+        ('per-sample Compose, rebuilt per call', time_fn(lambda: rebuilt_compose(imgs, labels, patch_size), args)),
+        ('per-sample Compose, built once', time_fn(lambda: shared_compose(imgs, labels, None, train_transform), args)),
+        ('batched torch augmentation', time_fn(lambda: batched(imgs, labels, resize, batch_aug), args)),
+    ]
+    if args.elastic_bank:
+        start = time.time()
+        bank = ElasticFieldBank(patch_size, args.elastic_bank)
+        print('built a bank of %d elastic fields in %.2fs' % (args.elastic_bank, time.time() - start))
+        bank_transform = get_train_transform(patch_size, bank)
+        bank_aug = BatchAugmentation(patch_size, field_bank=bank)
+        results += [
+            ('per-sample Compose, field bank', time_fn(lambda: shared_compose(imgs, labels, None, bank_transform), args)),
+            ('batched torch augmentation, field bank', time_fn(lambda: batched(imgs, labels, resize, bank_aug), args)),
+        ]
+    print('batch %d, %dx%d -> %dx%d, %d thread(s)' % (args.batch_size, args.src_size, args.src_size,
+                                                     args.img_size, args.img_size, args.threads))
+    print('%-42s | %10s | %10s' % ('path', 'ms/batch', 'samples/s'))
+    for name, t in results:
+        print('%-42s | %10.1f | %10.1f' % (name, t * 1000, args.batch_size / t))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+import multiprocessing as mp
+import threading
+import time
+
+import torch
+import torch.nn.functional as F
+
+from models import sam_feat_seg_model_registry
+from models.checkpointing import checkpoint_policy, estimated_activation_bytes
+
+
+parser = argparse.ArgumentParser(description='Peak memory against step time of encoder fine-tuning per activation checkpointing policy')
+parser.add_argument('--model_type', type=str, default='vit_b')
+parser.add_argument('--encoder_size', type=int, default=1024)
+parser.add_argument('--batch_sizes', type=str, default='1,2')
+parser.add_argument('--policies', type=str, default='none,global,every,all')
+parser.add_argument('--checkpoint_every', type=int, default=2)
+parser.add_argument('--memory_budget', type=float, default=None, help='GB, for the budget policy')
+parser.add_argument('--attention', type=str, default='naive')
+parser.add_argument('--iters', default=2, type=int, help='timed training steps, after one warm-up step')
+parser.add_argument('--gpu', default=None, type=int)
+
+
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class PeakRSS(object):
+    """Samples the resident memory of this process in a thread (CPU runs)."""
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = rss()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stop.is_set():
+            self.peak = max(self.peak, rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+
+
+def measure(args, policy, batch_size, results):
+    """One training configuration; run in a fresh process so that the CPU peaks do not carry over."""
+    device = torch.device('cuda', args.gpu) if args.gpu is not None else torch.device('cpu')
+    model = sam_feat_seg_model_registry[args.model_type](num_classes=4, img_size=args.encoder_size,
+                                                         attention=args.attention).to(device).train()
+    encoder = model.image_encoder
+    encoder.checkpoint_blocks = checkpoint_policy(encoder, policy, args.checkpoint_every, args.memory_budget, batch_size)
+    x = torch.randn(batch_size, 3, args.encoder_size, args.encoder_size, device=device)
+    label = torch.randint(0, 4, (batch_size, 224, 224), device=device)
+
+    def step():
+        model.zero_grad(set_to_none=False)
+        F.cross_entropy(model(x, output_size=224), label).backward()
+
+    step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        base = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    else:
+        base = rss()
+    with PeakRSS() as monitor:
+        start = time.time()
+        for _ in range(args.iters):
+            step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        seconds = (time.time() - start) / args.iters
+    peak = torch.cuda.max_memory_allocated(device) if device.type == 'cuda' else monitor.peak
+    results.put((policy, batch_size, sorted(encoder.checkpoint_blocks),
+                 estimated_activation_bytes(encoder, encoder.checkpoint_blocks, batch_size), peak - base, seconds))
+
+
+def main():
+    args = parser.parse_args()
+    ctx = mp.get_context('spawn')
+    rows = []
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        for policy in args.policies.split(','):
+            results = ctx.Queue()
+            proc = ctx.Process(target=measure, args=(args, policy, batch_size, results))
+            proc.start()
+            proc.join()
+            if proc.exitcode != 0:
+                # e.g. out of memory: the configuration does not fit
+                rows.append((policy, batch_size, None, None, None, None))
+                continue
+            rows.append(results.get())
+
+    print('%s at %d, %s, %s attention, %d steps' % (args.model_type, args.encoder_size,
+                                                   'cuda:%d' % args.gpu if args.gpu is not None else 'cpu',
+                                                   args.attention, args.iters))
+    print('%-8s | %5s | %-24s | %10s | %10s | %8s' % ('policy', 'batch', 'checkpointed blocks', 'est. GB', 'peak GB', 'step s'))
+    for policy, batch_size, blocks, estimate, peak, seconds in rows:
+        if blocks is None:
+            print('%-8s | %5d | %-24s | %10s | %10s | %8s' % (policy, batch_size, 'failed', '-', '-', '-'))
+            continue
+        blocks = ','.join(map(str, blocks)) if len(blocks) < 8 else '%d blocks' % len(blocks)
+        print('%-8s | %5d | %-24s | %10.2f | %10.2f | %8.2f' % (policy, batch_size, blocks or '-', estimate / 2 ** 30,
+                                                             peak / 2 ** 30, seconds))
+
+
+if __name__ == '__main__':
+    main()
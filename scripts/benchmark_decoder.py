@@ -0,0 +1,71 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+import time
+
+import torch
+
+from models.sam_decoder import MaskDecoder
+from segment_anything.modeling import TwoWayTransformer
+from segment_anything.modeling.prompt_encoder import PositionEmbeddingRandom
+
+
+parser = argparse.ArgumentParser(description='Per-class vs class-batched MaskDecoder benchmark')
+parser.add_argument('-b', '--batch-size', default=4, type=int)
+parser.add_argument('--classes', default=[1, 2, 4, 8, 14], nargs='*', type=int)
+parser.add_argument('--iters', default=5, type=int)
+parser.add_argument('--gpu', default=None, type=int)
+
+
+def build_decoder(num_classes, class_batched):
+    # same configuration as models/build_autosam_seg_model.py
+    return MaskDecoder(
+        num_multimask_outputs=1,
+        transformer=TwoWayTransformer(depth=2, embedding_dim=256, mlp_dim=2048, num_heads=8),
+        transformer_dim=256,
+        iou_head_depth=3,
+        iou_head_hidden_dim=256,
+        num_classes=num_classes,
+        class_batched=class_batched,
+    )
+
+
+def time_decoder(decoder, emb, pe, args):
+    device = emb.device
+    with torch.no_grad():
+        decoder(image_embeddings=emb, image_pe=pe)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+        start = time.time()
+        for _ in range(args.iters):
+            decoder(image_embeddings=emb, image_pe=pe)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+    elapsed = (time.time() - start) / args.iters
+    peak = torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == 'cuda' else float('nan')
+    return elapsed, peak
+
+
+def main():
+    args = parser.parse_args()
+    device = torch.device('cpu' if args.gpu is None else 'cuda:%d' % args.gpu)
+    emb = torch.randn(args.batch_size, 1, 256, 64, 64, device=device)
+    pe = PositionEmbeddingRandom(128).to(device)([64, 64]).unsqueeze(0)
+
+    print('classes | per-class ms | per-class ms/class | batched ms | batched ms/class | '
+          'per-class MB | batched MB')
+    for num_classes in args.classes:
+        decoder = build_decoder(num_classes, class_batched=False).to(device).eval()
+        t_rep, m_rep = time_decoder(decoder, emb, pe, args)
+        # same weights, shared single pass
+        decoder.class_batched = True
+        t_shared, m_shared = time_decoder(decoder, emb, pe, args)
+        print('%7d | %12.1f | %18.2f | %10.1f | %16.2f | %12.1f | %10.1f' % (
+            num_classes, t_rep * 1000, t_rep * 1000 / num_classes,
+            t_shared * 1000, t_shared * 1000 / num_classes, m_rep, m_shared))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+import time
+
+import torch
+
+from models import sam_seg_model_registry
+
+
+parser = argparse.ArgumentParser(description='Latency of the SAM image encoder per model type and input size (--encoder_size)')
+parser.add_argument('--model_types', type=str, default='vit_b,vit_l,vit_h')
+parser.add_argument('--sizes', type=str, default='256,512,640,1024')
+parser.add_argument('-b', '--batch-size', default=1, type=int)
+parser.add_argument('--iters', default=10, type=int, help='timed forward passes, after two warm-up passes')
+parser.add_argument('--gpu', default=None, type=int)
+parser.add_argument('--checkpoint', type=str, default=None,
+                    help='load this SAM checkpoint (of a single model type) to check the position table resampling')
+
+
+def time_encoder(encoder, size, args, device):
+    x = torch.randn(args.batch_size, 3, size, size, device=device)
+    with torch.no_grad():
+        for _ in range(2):
+            encoder(x)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.time()
+        for _ in range(args.iters):
+            encoder(x)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+    return (time.time() - start) / args.iters / args.batch_size
+
+
+def main():
+    args = parser.parse_args()
+    device = torch.device('cuda', args.gpu) if args.gpu is not None else torch.device('cpu')
+    sizes = [int(s) for s in args.sizes.split(',')]
+    results = []
+    for model_type in args.model_types.split(','):
+        for size in sizes:
+            model = sam_seg_model_registry[model_type](num_classes=2, checkpoint=args.checkpoint, img_size=size)
+            encoder = model.image_encoder.to(device).eval()
+            results.append((model_type, size, (size // 16) ** 2, time_encoder(encoder, size, args, device)))
+            del model, encoder
+            if device.type == 'cuda':
+                torch.cuda.empty_cache()
+
+    print('%s, batch %d, %d iterations' % (device, args.batch_size, args.iters))
+    print('%-6s | %6s | %6s | %12s | %8s' % ('model', 'size', 'tokens', 'ms / image', 'speedup'))
+    for model_type, size, tokens, seconds in results:
+        # speedup relative to the largest size measured for the model, 1024 by default
+        ref = max((r for r in results if r[0] == model_type), key=lambda r: r[1])[3]
+        print('%-6s | %6d | %6d | %12.1f | %7.1fx' % (model_type, size, tokens, seconds * 1e3, ref / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+import threading
+import time
+
+import torch
+
+from dataset.utils import build_datasets, generate_loaders
+
+
+parser = argparse.ArgumentParser(description='Worker processes vs in-process threads: startup, throughput and memory of a loader')
+parser.add_argument('--data_dir', type=str, default='dataset/ACDC/imgs/')
+parser.add_argument('--src_dir', type=str, default='dataset/ACDC/')
+parser.add_argument('--dataset', type=str, default='ACDC')
+parser.add_argument('--fold', type=int, default=0)
+parser.add_argument('--tr_size', type=int, default=1000)
+parser.add_argument('--img_size', type=int, default=224)
+parser.add_argument('-b', '--batch-size', default=4, type=int)
+parser.add_argument('-j', '--workers', default=8, type=int)
+parser.add_argument('--split', type=str, default='train', choices=['train', 'val', 'test'])
+parser.add_argument('--batches', default=50, type=int, help='batches timed per backend, after the first')
+parser.add_argument('--backends', type=str, default='process,thread')
+parser.add_argument('--batch_aug', default=False, action='store_true')
+parser.add_argument('--slice_threshold', type=float, default=0.05)
+
+
+def process_memory(pid):
+    """PSS of a process in bytes (shared pages split between the processes using them), RSS if unavailable."""
+    try:
+        with open('/proc/%d/smaps_rollup' % pid) as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        with open('/proc/%d/statm' % pid) as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return 0
+
+
+def children(pid):
+    pids = []
+    try:
+        for tid in os.listdir('/proc/%d/task' % pid):
+            with open('/proc/%d/task/%s/children' % (pid, tid)) as f:
+                pids += [int(p) for p in f.read().split()]
+    except OSError:
+        pass
+    return pids + [c for p in pids for c in children(p)]
+
+
+class MemoryMonitor(object):
+    """Samples the memory of this process and of its child processes (loader workers) in a thread."""
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self.peak_children = 0
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stop.is_set():
+            kids = children(os.getpid())
+            main, workers = process_memory(os.getpid()), sum(process_memory(p) for p in kids)
+            self.peak = max(self.peak, main + workers)
+            self.peak_children = max(self.peak_children, len(kids))
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+
+
+def run(args, backend):
+    args.loader = backend
+    train_ds, val_ds, test_ds = build_datasets(args)
+    train_loader, _, val_loader, _, test_loader, _ = generate_loaders(train_ds, val_ds, test_ds, args)
+    loader = {'train': train_loader, 'val': val_loader, 'test': test_loader}[args.split]
+
+    base = process_memory(os.getpid())
+    with MemoryMonitor() as memory:
+        start = time.time()
+        it = iter(loader)
+        next(it)
+        first = time.time() - start
+        start = time.time()
+        samples = 0
+        for i, batch in enumerate(it):
+            samples += len(batch[0])
+            if i + 1 == args.batches:
+                break
+        elapsed = time.time() - start
+        del it
+    return first, samples / max(elapsed, 1e-9), memory.peak - base, memory.peak_children
+
+
+def main():
+    args = parser.parse_args()
+    args.distributed = False
+    results = []
+    for backend in args.backends.split(','):
+        results.append((backend,) + run(args, backend))
+    print('%s split, batch %d, %d workers, %d batches' % (args.split, args.batch_size, args.workers, args.batches))
+    print('%-8s | %14s | %10s | %16s | %9s' % ('loader', 'first batch s', 'samples/s', 'peak extra MB', 'processes'))
+    for backend, first, rate, memory, procs in results:
+        print('%-8s | %14.2f | %10.1f | %16.1f | %9d' % (backend, first, rate, memory / 2 ** 20, procs))
+
+
+if __name__ == '__main__':
+    torch.set_num_threads(1)
+    main()
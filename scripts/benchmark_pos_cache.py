@@ -0,0 +1,67 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+import time
+
+import torch
+
+from models import sam_seg_model_registry
+from segment_anything.modeling.image_encoder import Attention
+
+
+parser = argparse.ArgumentParser(description='Forward time of the SAM seg model with and without the cached position tables')
+parser.add_argument('--model_type', type=str, default='vit_b')
+parser.add_argument('--encoder_size', type=int, default=1024)
+parser.add_argument('-b', '--batch-size', default=1, type=int)
+parser.add_argument('--iters', default=5, type=int, help='timed passes, after one warm-up pass')
+parser.add_argument('--gpu', default=None, type=int)
+
+
+def set_cache(model, enabled):
+    model.cache_pe = enabled
+    for module in model.modules():
+        if isinstance(module, Attention):
+            module.cache_rel_pos = enabled
+
+
+def timed(fn, iters, device):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.time()
+    for _ in range(iters):
+        out = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return out, (time.time() - start) / iters
+
+
+def main():
+    args = parser.parse_args()
+    device = torch.device('cuda', args.gpu) if args.gpu is not None else torch.device('cpu')
+    model = sam_seg_model_registry[args.model_type](num_classes=2, img_size=args.encoder_size).to(device).eval()
+    attns = [m for m in model.modules() if isinstance(m, Attention)]
+    grid = args.encoder_size // 16
+    x = torch.randn(args.batch_size, 3, args.encoder_size, args.encoder_size, device=device)
+
+    results = {}
+    with torch.no_grad():
+        for enabled in (False, True):
+            set_cache(model, enabled)
+            # the tables alone: both axes of every encoder block, and the decoder's dense position encoding
+            tables = lambda: [a.rel_pos_tables(*(((grid, grid),) * 2 if a.rel_pos_h.shape[0] == 2 * grid - 1
+                                                 else ((14, 14),) * 2)) for a in attns] + [model.image_pe((grid, grid))]
+            _, table_time = timed(tables, args.iters, device)
+            out, forward_time = timed(lambda: model(x)[0], args.iters, device)
+            results[enabled] = (out, table_time, forward_time)
+
+    print('%s at %d, %s, batch %d, %d iterations' % (args.model_type, args.encoder_size, device, args.batch_size, args.iters))
+    print('%-9s | %12s | %12s' % ('tables', 'tables ms', 'forward ms'))
+    for enabled, name in ((False, 'rebuilt'), (True, 'cached')):
+        print('%-9s | %12.2f | %12.1f' % (name, results[enabled][1] * 1e3, results[enabled][2] * 1e3))
+    print('max |diff| of the masks: %.2e' % (results[True][0] - results[False][0]).abs().max().item())
+
+
+if __name__ == '__main__':
+    main()
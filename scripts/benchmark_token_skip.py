@@ -0,0 +1,77 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from models import sam_seg_model_registry
+from dataset.utils import build_datasets
+
+
+parser = argparse.ArgumentParser(description='Skipped token fraction and encoder speedup of --token_skip on dataset slices')
+parser.add_argument('--data_dir', type=str, default='dataset/ACDC/imgs/')
+parser.add_argument('--src_dir', type=str, default='dataset/ACDC/')
+parser.add_argument('--dataset', type=str, default='ACDC')
+parser.add_argument('--fold', type=int, default=0)
+parser.add_argument('--tr_size', type=int, default=1)
+parser.add_argument('--img_size', type=int, default=224)
+parser.add_argument('--split', type=str, default='val', choices=['val', 'test'])
+parser.add_argument('--slices', default=20, type=int, help='number of slices, spread over the split')
+parser.add_argument('--model_type', type=str, default='vit_b')
+parser.add_argument('--checkpoint', type=str, default=None)
+parser.add_argument('--encoder_size', type=int, default=1024)
+parser.add_argument('--token_skip', type=float, default=1e-3)
+parser.add_argument('--slice_threshold', type=float, default=0.05)
+parser.add_argument('--gpu', default=None, type=int)
+
+
+def timed_encode(model, img, device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.time()
+    emb = model.encode(img)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return emb, time.time() - start
+
+
+def main():
+    args = parser.parse_args()
+    args.distributed = False
+    device = torch.device('cuda', args.gpu) if args.gpu is not None else torch.device('cpu')
+    _, val_ds, test_ds = build_datasets(args)
+    ds = val_ds if args.split == 'val' else test_ds
+    model = sam_seg_model_registry[args.model_type](num_classes=2, checkpoint=args.checkpoint,
+                                                    img_size=args.encoder_size, token_skip=args.token_skip)
+    model = model.to(device).eval()
+    encoder = model.image_encoder
+
+    print('%s at %d, %s, threshold %g' % (args.model_type, args.encoder_size, device, args.token_skip))
+    print('%6s | %8s | %10s | %10s | %8s | %8s' % ('slice', 'skipped', 'dense ms', 'sparse ms', 'speedup', 'cosine'))
+    dense_total, sparse_total, skipped = 0., 0., []
+    with torch.no_grad():
+        for n, i in enumerate(np.linspace(0, len(ds) - 1, args.slices).astype(int)):
+            img = torch.as_tensor(np.asarray(ds[i][0]))[None].float().to(device)
+            if n == 0:
+                model.encode(img)   # warm-up
+            encoder.token_skip_threshold = None
+            dense, dense_time = timed_encode(model, img, device)
+            encoder.token_skip_threshold = args.token_skip
+            sparse, sparse_time = timed_encode(model, img, device)
+            fraction = encoder.last_skip_fraction.item()
+            # agreement of the embeddings; the skipped positions hold the (untrained) fill token
+            cosine = F.cosine_similarity(dense.flatten(), sparse.flatten(), dim=0).item()
+            dense_total += dense_time
+            sparse_total += sparse_time
+            skipped.append(fraction)
+            print('%6d | %7.1f%% | %10.1f | %10.1f | %7.2fx | %8.3f' % (i, 100 * fraction, dense_time * 1e3,
+                                                                     sparse_time * 1e3, dense_time / sparse_time, cosine))
+    print('mean skipped %.1f%%, end-to-end encoder speedup %.2fx' % (100 * np.mean(skipped), dense_total / sparse_total))
+
+
+if __name__ == '__main__':
+    main()
@@ -25,7 +25,9 @@ from segment_anything import sam_model_registry, SamPredictor
 
 from models import sam_seg_model_registry
 from segment_anything.utils.transforms import ResizeLongestSide
-from dataset import SynapseDataset, CustomDataset, AcdcDataset, generate_test_loader
+from dataset import SynapseDataset, CustomDataset, AcdcDataset, generate_volume_test_loader
+from dataset.volume_stream import VolumeAssembler
+from dataset.thread_loader import get_loader_class
 
 
 parser = argparse.ArgumentParser(description='PyTorch ImageNet Training')
@@ -33,6 +35,8 @@ parser = argparse.ArgumentParser(description='PyTorch ImageNet Training')
 
 parser.add_argument('-j', '--workers', default=16, type=int, metavar='N',
                     help='number of data loading workers (default: 32)')
+parser.add_argument("--loader", type=str, default='process', choices=['process', 'thread'],
+                    help='load batches in worker processes or in threads of this process')
 parser.add_argument('--epochs', default=120, type=int, metavar='N',
                     help='number of total epochs to run')
 parser.add_argument('--start-epoch', default=0, type=int, metavar='N',
@@ -113,7 +117,7 @@ def main():
     tr_keys = splits[args.fold]['train'][0:args.tr_size]
     dataset = AcdcDataset(keys=tr_keys, mode='val', args=args)
     # dataset = CustomDataset(args=args)
-    data_loader = torch.utils.data.DataLoader(
+    data_loader = get_loader_class(args, test=True)(
         dataset, batch_size=args.batch_size, shuffle=False,
         num_workers=args.workers, pin_memory=True, drop_last=False)
 
@@ -160,48 +164,31 @@ def test_sam(model, args):
     if not os.path.exists(join(args.save_dir, "img")):
         os.mkdir(join(args.save_dir, "img"))
 
-    split_dir = os.path.join(args.src_dir, "splits.pkl")
-    with open(split_dir, "rb") as f:
-        splits = pickle.load(f)
-    test_keys = splits[args.fold]['test']
-
-    for key in test_keys:
-        preds = []
-        labels = []
-        imgs = []
-        data_loader = generate_test_loader(key, args)
-        with torch.no_grad():
-            for i, tup in enumerate(data_loader):
-                if args.gpu is not None:
-                    img = tup[0].float().cuda(args.gpu, non_blocking=True)
-                    label = tup[1].long().cuda(args.gpu, non_blocking=True)
-                else:
-                    img = tup[0]
-                    label = tup[1]
-
-                mask = torch.zeros(label.shape)
-                for k in range(mask.shape[0]):
-                    out = get_mask(img[k], label[k], args.num_classes, model)
-                    mask = torch.argmax(out, dim=0)
-
-                preds.append(mask.unsqueeze(0).numpy())
-                labels.append(label.cpu().numpy())
-                imgs.append(img.cpu().numpy())
-
-            imgs = np.concatenate(imgs, axis=0).squeeze()
-            preds = np.concatenate(preds, axis=0).squeeze()
-            labels = np.concatenate(labels, axis=0).squeeze()
-
-            print(preds.shape, labels.shape)
-            if "." in key:
-                key = key.split(".")[0]
-            ni_img = nib.Nifti1Image(imgs, affine=np.eye(4))
-            ni_pred = nib.Nifti1Image(preds.astype(np.int8), affine=np.eye(4))
-            ni_lb = nib.Nifti1Image(labels.astype(np.int8), affine=np.eye(4))
-            nib.save(ni_img, join(args.save_dir, 'img', key + '.nii'))
-            nib.save(ni_pred, join(args.save_dir, 'infer', key + '.nii'))
-            nib.save(ni_lb, join(args.save_dir, 'label', key + '.nii'))
-        print("finish saving file:", key)
+    # one loader over all test patients; volumes are reassembled from the batches as they complete
+    data_loader = generate_volume_test_loader(args)
+    volumes = VolumeAssembler()
+    with torch.no_grad():
+        for i, (img, label, segments) in enumerate(data_loader):
+            if args.gpu is not None:
+                img = img.float().cuda(args.gpu, non_blocking=True)
+                label = label.long().cuda(args.gpu, non_blocking=True)
+
+            mask = torch.stack([torch.argmax(get_mask(img[k], label[k], args.num_classes, model), dim=0)
+                                for k in range(img.shape[0])])
+
+            for key, imgs, preds, labels in volumes.add(segments, img.cpu().numpy(), mask.numpy(),
+                                                         label.cpu().numpy()):
+                imgs, preds, labels = imgs.squeeze(), preds.squeeze(), labels.squeeze()
+                print(preds.shape, labels.shape)
+                if "." in key:
+                    key = key.split(".")[0]
+                ni_img = nib.Nifti1Image(imgs, affine=np.eye(4))
+                ni_pred = nib.Nifti1Image(preds.astype(np.int8), affine=np.eye(4))
+                ni_lb = nib.Nifti1Image(labels.astype(np.int8), affine=np.eye(4))
+                nib.save(ni_img, join(args.save_dir, 'img', key + '.nii'))
+                nib.save(ni_pred, join(args.save_dir, 'infer', key + '.nii'))
+                nib.save(ni_lb, join(args.save_dir, 'label', key + '.nii'))
+                print("finish saving file:", key)
 
 
 def get_mask(img, label, num_classes, model):
@@ -214,6 +201,8 @@ def get_mask(img, label, num_classes, model):
             mode="bilinear",
             align_corners=False,
         )
+    if img.shape[1] == 1:
+        img = img.expand(-1, 3, -1, -1)
     mask = torch.zeros((num_classes, label.shape[1], label.shape[2]))
 
     boxes = []
@@ -36,7 +36,13 @@ from loss_functions.dice_loss import SoftDiceLoss
 from loss_functions.metrics import dice_pytorch, SegmentationMetric
 
 from models import sam_seg_model_registry
-from dataset import generate_dataset, generate_test_loader
+from dataset import generate_dataset, generate_volume_test_loader
+from dataset.transport import get_device_preprocess
+from dataset.embedding_augment import get_embedding_augmentation, mixup_loss
+from dataset.prefetch import DevicePrefetcher
+from dataset.volume_stream import VolumeAssembler
+from dataset.telemetry import telemetry_path
+from dataset import generate_embedding_dataset, generate_embedding_volume_loader
 from evaluate import test_synapse, test_acdc, test_brats, test_LP_CTA
 
 
@@ -86,12 +92,26 @@ parser.add_argument('--multiprocessing-distributed', action='store_true',
                          'multi node data parallel training')
 
 parser.add_argument('--model_type', type=str, default="vit_l", help='path to splits file')
+parser.add_argument('--encoder_size', type=int, default=1024,
+                    help='input size of the SAM image encoder (multiple of 16); the position tables of the checkpoint are resampled to it')
+parser.add_argument('--attention', type=str, default='naive', choices=['naive', 'sdpa', 'chunked'],
+                    help='attention backend of the encoder and decoder transformers')
+parser.add_argument('--attention_chunk', type=int, default=1024, help='queries per chunk of the chunked attention backend')
+parser.add_argument('--token_skip', type=float, default=None,
+                    help='skip flat background patches (variance below this) in the image encoder (off by default)')
 parser.add_argument('--src_dir', type=str, default=None, help='path to splits file')
 parser.add_argument('--data_dir', type=str, default=None, help='path to datafolder')
 parser.add_argument("--img_size", type=int, default=256)
 parser.add_argument("--classes", type=int, default=8,help='似乎没用到')
 parser.add_argument("--do_contrast", default=False, action='store_true')
-parser.add_argument("--slice_threshold", type=float, default=0.05)
+parser.add_argument("--slice_threshold", type=float, default=0.05,
+                    help='foreground fraction below which --slice_sampling drops or down-weights a train slice')
+parser.add_argument("--slice_sampling", type=str, default='all', choices=['all', 'drop', 'weight'],
+                    help='train on all slices, drop those below --slice_threshold, or down-weight them')
+parser.add_argument("--low_fg_weight", type=float, default=0.1,
+                    help='sampling weight of slices below --slice_threshold with --slice_sampling weight')
+parser.add_argument("--rare_class_ratio", type=float, default=1.,
+                    help='oversample slices of rare classes by up to this ratio (1: off)')
 parser.add_argument("--num_classes", type=int, default=14)
 parser.add_argument("--fold", type=int, default=0)
 parser.add_argument("--tr_size", type=int, default=1, help='number of training images')  # TODO: 只用一个人的训练样本
@@ -101,6 +121,52 @@ parser.add_argument("--load_saved_model", action='store_true',
 parser.add_argument("--saved_model_path", type=str, default=None)
 parser.add_argument("--load_pseudo_label", default=False, action='store_true')
 parser.add_argument("--dataset", type=str, default="synapse")
+parser.add_argument("--embedding_cache", type=str, default=None,
+                    help='train the mask decoder from image embeddings cached in this folder')
+parser.add_argument("--cache_views", type=int, default=8,
+                    help='number of augmented views per training slice in the embedding cache')
+parser.add_argument("--unfreeze_blocks", type=int, default=0,
+                    help='fine-tune the last N image encoder blocks and the neck; with --embedding_cache the '
+                         'input of the first of them is cached instead of the encoder output')
+parser.add_argument("--encoder_checkpoint", default=False, action='store_true',
+                    help='activation checkpointing in the fine-tuned encoder blocks')
+parser.add_argument("--cache_in_memory", default=False, action='store_true',
+                    help='read the embedding cache into RAM instead of memory-mapping it')
+parser.add_argument("--embedding_aug", default=False, action='store_true',
+                    help='flip, rotate, warp and drop channels of the cached embeddings (dataset/embedding_augment.py)')
+parser.add_argument("--feature_dropout", type=float, default=0.1,
+                    help='probability of zeroing an embedding channel with --embedding_aug')
+parser.add_argument("--mixup_alpha", type=float, default=0.,
+                    help='mix cached embeddings with Beta(alpha, alpha) weights with --embedding_aug (0: off)')
+parser.add_argument("--class_batched_decoder", default=False, action='store_true',
+                    help='decode all classes in one transformer pass instead of one pass per class')
+parser.add_argument("--batch_aug", default=False, action='store_true',
+                    help='run the train augmentations on whole batches in the collate step')
+parser.add_argument("--elastic_bank", type=int, default=0,
+                    help='draw elastic deformations from a bank of this many precomputed fields (0: off)')
+parser.add_argument("--elastic_bank_seed", type=int, default=0)
+parser.add_argument("--slice_cache_mb", type=int, default=0,
+                    help='share decoded slices between loader workers, up to this many MB (0: off)')
+parser.add_argument("--volume_cache", type=str, default=None,
+                    help='local folder for decompressed volumes with --dataset volume (default: next to data_dir)')
+parser.add_argument("--shard_dir", type=str, default=None,
+                    help='stream the train slices from the tar shards of dataset/prepare_dataset/write_shards.py')
+parser.add_argument("--shuffle_buffer", type=int, default=1000,
+                    help='records mixed in memory when streaming from --shard_dir')
+parser.add_argument("--loader", type=str, default='process', choices=['process', 'thread'],
+                    help='load batches in worker processes or in threads of this process')
+parser.add_argument("--test_loader", type=str, default=None, choices=['process', 'thread'],
+                    help='backend of the test loaders (default: --loader)')
+parser.add_argument("--telemetry", default=False, action='store_true',
+                    help='time the loader stages per worker and flag data-starved steps (TensorBoard + telemetry_*.json)')
+parser.add_argument("--starve_ratio", type=float, default=0.2,
+                    help='with --telemetry, a step is data-starved if waiting for its batch took more than this share of it')
+parser.add_argument("--uint8_transport", default=False, action='store_true',
+                    help='ship batches as uint8 (int16 for 16-bit slices) and normalize / augment / resize them on the GPU')
+parser.add_argument("--resize_once", default=False, action='store_true',
+                    help='resize images once, straight to the encoder input size, and predict at the native label size')
+parser.add_argument("--resized_cache", type=str, default=None,
+                    help='with --resize_once, keep the images resized to the encoder size in this folder')
 
 
 def main():
@@ -169,7 +235,19 @@ def main_worker(gpu, ngpus_per_node, args):
     elif args.model_type == 'vit_b':
         model_checkpoint = 'sam_vit_b_01ec64.pth'
 
-    model = sam_seg_model_registry[args.model_type](num_classes=args.num_classes, checkpoint=model_checkpoint)
+    args.checkpoint = model_checkpoint
+    model = sam_seg_model_registry[args.model_type](num_classes=args.num_classes, checkpoint=model_checkpoint,
+                                                    class_batched=args.class_batched_decoder,
+                                                    img_size=args.encoder_size, attention=args.attention,
+                                                    attention_chunk=args.attention_chunk,
+                                                    token_skip=args.token_skip)
+    # partial fine-tuning: blocks [depth - N, depth) of the encoder and the neck are trained
+    depth = len(model.image_encoder.blocks)
+    trained_blocks = range(depth - args.unfreeze_blocks, depth)
+    if args.unfreeze_blocks and args.embedding_cache:
+        model.embedding_block = trained_blocks.start
+    if args.encoder_checkpoint:
+        model.image_encoder.checkpoint_blocks = set(trained_blocks)
 
     if args.distributed:
         # For multiprocessing distributed, DistributedDataParallel constructor
@@ -200,8 +278,13 @@ def main_worker(gpu, ngpus_per_node, args):
         raise NotImplementedError("Only DistributedDataParallel is supported.")
 
     # freeze weights in the image_encoder
+    trained = ['image_encoder.blocks.%d.' % i for i in trained_blocks]
+    if args.unfreeze_blocks:
+        trained.append('image_encoder.neck.')
     for name, param in model.named_parameters():
-        if param.requires_grad and "image_encoder" in name or "iou" in name:
+        # the learned fill of skipped tokens (--token_skip) is trained with the decoder
+        trained_encoder = "skip_token" in name or any(t in name for t in trained)
+        if param.requires_grad and "image_encoder" in name and not trained_encoder or "iou" in name:
             param.requires_grad = False
         else:
             param.requires_grad = True
@@ -223,6 +306,11 @@ def main_worker(gpu, ngpus_per_node, args):
             args.start_epoch = checkpoint['epoch']
             model.load_state_dict(checkpoint['state_dict'])
             optimizer.load_state_dict(checkpoint['optimizer'])
+            # same weights in both decoder modes, but not the same masks (models/sam_decoder.py)
+            trained = checkpoint.get('class_batched')
+            if trained is not None and trained != args.class_batched_decoder:
+                warnings.warn('the checkpoint was trained with class_batched_decoder=%s, running with %s predicts '
+                              'different masks' % (trained, args.class_batched_decoder))
             print("=> loaded checkpoint '{}' (epoch {})"
                   .format(args.resume, checkpoint['epoch']))
         else:
@@ -231,8 +319,15 @@ def main_worker(gpu, ngpus_per_node, args):
     cudnn.benchmark = True
 
     # Data loading code
+    # with --resize_once the loaders resize images straight to the encoder input size
+    args.encoder_size = getattr(model, 'module', model).image_encoder.img_size
 
-    train_loader, train_sampler, val_loader, val_sampler, test_loader, test_sampler = generate_dataset(args)
+    if args.embedding_cache:
+        # the (frozen part of the) image encoder only has to be computed once per slice
+        train_loader, train_sampler, val_loader, val_sampler, test_loader, test_sampler = \
+            generate_embedding_dataset(model, args)
+    else:
+        train_loader, train_sampler, val_loader, val_sampler, test_loader, test_sampler = generate_dataset(args)
 
     now = datetime.now()
     # args.save_dir = "output_experiment/Sam_h_seg_distributed_tr" + str(args.tr_size) # + str(now)[:-7]
@@ -266,8 +361,14 @@ def main_worker(gpu, ngpus_per_node, args):
         #         'epoch': epoch + 1,
         #         'state_dict': model.module.mask_decoder.state_dict(),
         #         'optimizer' : optimizer.state_dict(),
+        #         'class_batched': args.class_batched_decoder,
         #     }, is_best=is_best, filename=filename)
     test(model, args)
+    if args.distributed:
+        # every rank wrote the volumes of its share of the test patients; the metrics run once
+        dist.barrier()
+        if args.rank != 0:
+            return
     if args.dataset == 'synapse':
         test_synapse(args)
     elif args.dataset == 'ACDC' or args.dataset == 'acdc':
@@ -288,28 +389,31 @@ def train(train_loader, model, optimizer, scheduler, epoch, args, writer):
     # switch to train mode
     model.train()
 
+    # loader stage timings and data-starved steps (--telemetry, dataset/telemetry.py)
+    telemetry = getattr(train_loader.dataset, 'telemetry', None)
     end = time.time()
-    for i, tup in enumerate(train_loader):
+    # the next batch is copied, cast and preprocessed in the background while this one runs
+    preprocess = get_device_preprocess(train_loader.dataset, getattr(model, 'module', model).image_encoder.img_size)
+    embedding_aug = get_embedding_augmentation(train_loader.dataset, args)
+    for i, (img, label) in enumerate(DevicePrefetcher(train_loader, args.gpu, preprocess)):
         # measure data loading time
         data_time.update(time.time() - end)
+        mix = None
+        if embedding_aug is not None:
+            img, label, mix = embedding_aug(img, label)
 
-        if args.gpu is not None:
-            img = tup[0].float().cuda(args.gpu, non_blocking=True)
-            label = tup[1].long().cuda(args.gpu, non_blocking=True)
-        else:
-            img = tup[0].float()
-            label = tup[1].long()
-        b, c, h, w = img.shape
+        b = img.shape[0]
+        h, w = label.shape[-2:]
 
         # compute output
         # mask size: [batch*num_classes, num_multi_class, H, W], iou_pred: [batch*num_classes, 1]
-        mask, iou_pred = model(img)
+        mask, iou_pred = model(img, output_size=(h, w), is_embedding=bool(args.embedding_cache))
         mask = mask.view(b, -1, h, w)
         iou_pred = iou_pred.squeeze().view(b, -1)
 
         pred_softmax = F.softmax(mask, dim=1)
-        loss = ce_loss(mask, label.squeeze(1)) + dice_loss(pred_softmax, label.squeeze(1))
-               # + dice_loss(pred_softmax, label.squeeze(1))
+        loss = mixup_loss(lambda target: ce_loss(mask, target.squeeze(1)) + dice_loss(pred_softmax, target.squeeze(1)),
+                          label, mix)
 
         # acc1/acc5 are (K+1)-way contrast classifier accuracy
         # measure accuracy and record loss
@@ -321,37 +425,38 @@ def train(train_loader, model, optimizer, scheduler, epoch, args, writer):
 
         # measure elapsed time
         batch_time.update(time.time() - end)
+        if telemetry is not None:
+            telemetry.step(data_time.val, batch_time.val, writer, i + epoch * len(train_loader))
         end = time.time()
         writer.add_scalar('train_loss', loss, global_step=i + epoch * len(train_loader))
 
         if i % args.print_freq == 0:
             print('Train: [{0}][{1}/{2}]\t'
-                  'loss {loss:.4f}'.format(epoch, i, len(train_loader), loss=loss.item()))
+                  'loss {loss:.4f}\t{data_time}\t{batch_time}'.format(epoch, i, len(train_loader), loss=loss.item(),
+                                                                    data_time=data_time, batch_time=batch_time))
 
+    if telemetry is not None:
+        telemetry.export(writer, epoch, telemetry_path(args, 'train'))
     if epoch >= 10:
         scheduler.step(loss)
 
 
 def validate(val_loader, model, epoch, args, writer):
     loss_list = []
+    skip_list = []
+    encoder = getattr(model, 'module', model).image_encoder
     dice_list = []
     dice_loss = SoftDiceLoss(batch_dice=True, do_bg=False)
     model.eval()
 
     with torch.no_grad():
-        for i, tup in enumerate(val_loader):
-            # measure data loading time
-
-            if args.gpu is not None:
-                img = tup[0].float().cuda(args.gpu, non_blocking=True)
-                label = tup[1].long().cuda(args.gpu, non_blocking=True)
-            else:
-                img = tup[0]
-                label = tup[1]
-            b, c, h, w = img.shape
+        preprocess = get_device_preprocess(val_loader.dataset, getattr(model, 'module', model).image_encoder.img_size)
+        for i, (img, label) in enumerate(DevicePrefetcher(val_loader, args.gpu, preprocess)):
+            b = img.shape[0]
+            h, w = label.shape[-2:]
 
             # compute output
-            mask, iou_pred = model(img)
+            mask, iou_pred = model(img, output_size=(h, w), is_embedding=bool(args.embedding_cache))
             mask = mask.view(b, -1, h, w)
             iou_pred = iou_pred.squeeze().view(b, -1)
             iou_pred = torch.mean(iou_pred)
@@ -359,60 +464,57 @@ def validate(val_loader, model, epoch, args, writer):
             pred_softmax = F.softmax(mask, dim=1)
             loss = dice_loss(pred_softmax, label.squeeze(1))  # self.ce_loss(pred, target.squeeze())
             loss_list.append(loss.item())
+            if encoder.last_skip_fraction is not None and not args.embedding_cache:
+                skip_list.append(encoder.last_skip_fraction.mean().item())
 
     print('Validating: Epoch: %2d Loss: %.4f IoU_pred: %.4f' % (epoch, np.mean(loss_list), iou_pred.item()))
     writer.add_scalar("val_loss", np.mean(loss_list), epoch)
+    if skip_list:
+        print('Validating: %.1f%% of the encoder tokens skipped' % (100 * np.mean(skip_list)))
+        writer.add_scalar("val_token_skip", np.mean(skip_list), epoch)
+    if getattr(val_loader.dataset, 'telemetry', None) is not None:
+        val_loader.dataset.telemetry.export(writer, epoch, telemetry_path(args, 'val'))
     return np.mean(loss_list)
 
 
 def test(model, args):
     print('Test')
     join = os.path.join
-    if not os.path.exists(join(args.save_dir, "infer")):
-        os.mkdir(join(args.save_dir, "infer"))
-    if not os.path.exists(join(args.save_dir, "label")):
-        os.mkdir(join(args.save_dir, "label"))
-
-    split_dir = os.path.join(args.src_dir, "splits.pkl")
-    with open(split_dir, "rb") as f:
-        splits = pickle.load(f)
-    test_keys = splits[args.fold]['test']
+    os.makedirs(join(args.save_dir, "infer"), exist_ok=True)
+    os.makedirs(join(args.save_dir, "label"), exist_ok=True)
 
+    # ranks stream different patients and numbers of batches, so the DDP wrapper (which syncs buffers
+    # in every forward) is bypassed
+    model = getattr(model, 'module', model)
     model.eval()
 
-    for key in test_keys:
-        preds = []
-        labels = []
-        data_loader = generate_test_loader(key, args)
-        with torch.no_grad():
-            for i, tup in enumerate(data_loader):
-                if args.gpu is not None:
-                    img = tup[0].float().cuda(args.gpu, non_blocking=True)
-                    label = tup[1].long().cuda(args.gpu, non_blocking=True)
-                else:
-                    img = tup[0]
-                    label = tup[1]
-
-                b, c, h, w = img.shape
-
-                mask, iou_pred = model(img)
-                mask = mask.view(b, -1, h, w)
-                mask_softmax = F.softmax(mask, dim=1)
-                mask = torch.argmax(mask_softmax, dim=1)
-
-                preds.append(mask.cpu().numpy())
-                labels.append(label.cpu().numpy())
-
-            preds = np.concatenate(preds, axis=0)
-            labels = np.concatenate(labels, axis=0).squeeze()
-            print(preds.shape, labels.shape)
-            if "." in key:
-                key = key.split(".")[0]
-            ni_pred = nib.Nifti1Image(preds.astype(np.int8), affine=np.eye(4))
-            ni_lb = nib.Nifti1Image(labels.astype(np.int8), affine=np.eye(4))
-            nib.save(ni_pred, join(args.save_dir, 'infer', key + '.nii'))
-            nib.save(ni_lb, join(args.save_dir, 'label', key + '.nii'))
-        print("finish saving file:", key)
+    # one loader over all test patients; volumes are reassembled from the batches as they complete
+    if args.embedding_cache:
+        data_loader = generate_embedding_volume_loader(args)
+    else:
+        data_loader = generate_volume_test_loader(args)
+    volumes = VolumeAssembler()
+    with torch.no_grad():
+        preprocess = get_device_preprocess(data_loader.dataset, getattr(model, 'module', model).image_encoder.img_size)
+        for i, (img, label, segments) in enumerate(DevicePrefetcher(data_loader, args.gpu, preprocess)):
+            b = img.shape[0]
+            h, w = label.shape[-2:]
+
+            mask, iou_pred = model(img, output_size=(h, w), is_embedding=bool(args.embedding_cache))
+            mask = mask.view(b, -1, h, w)
+            mask_softmax = F.softmax(mask, dim=1)
+            mask = torch.argmax(mask_softmax, dim=1)
+
+            for key, preds, labels in volumes.add(segments, mask.cpu().numpy(), label.cpu().numpy()):
+                labels = labels.squeeze()
+                print(preds.shape, labels.shape)
+                if "." in key:
+                    key = key.split(".")[0]
+                ni_pred = nib.Nifti1Image(preds.astype(np.int8), affine=np.eye(4))
+                ni_lb = nib.Nifti1Image(labels.astype(np.int8), affine=np.eye(4))
+                nib.save(ni_pred, join(args.save_dir, 'infer', key + '.nii'))
+                nib.save(ni_lb, join(args.save_dir, 'label', key + '.nii'))
+                print("finish saving file:", key)
 
 def test_2(data_loader, model, args):
     print('Test')
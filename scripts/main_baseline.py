@@ -33,7 +33,10 @@ from loss_functions.dice_loss import SoftDiceLoss
 from loss_functions.metrics import dice_pytorch, SegmentationMetric
 
 from models import SupConUnet, NestedUNet
-from dataset import generate_dataset, generate_test_loader
+from dataset import generate_dataset, generate_volume_test_loader
+from dataset.prefetch import DevicePrefetcher
+from dataset.volume_stream import VolumeAssembler
+from dataset.telemetry import telemetry_path
 from evaluate import test_synapse, test_acdc, test_brats
 
 
@@ -88,7 +91,14 @@ parser.add_argument('--data_dir', type=str, default=None, help='path to datafold
 parser.add_argument("--img_size", type=int, default=256)
 parser.add_argument("--classes", type=int, default=8)
 parser.add_argument("--do_contrast", default=False, action='store_true')
-parser.add_argument("--slice_threshold", type=float, default=0.05)
+parser.add_argument("--slice_threshold", type=float, default=0.05,
+                    help='foreground fraction below which --slice_sampling drops or down-weights a train slice')
+parser.add_argument("--slice_sampling", type=str, default='all', choices=['all', 'drop', 'weight'],
+                    help='train on all slices, drop those below --slice_threshold, or down-weight them')
+parser.add_argument("--low_fg_weight", type=float, default=0.1,
+                    help='sampling weight of slices below --slice_threshold with --slice_sampling weight')
+parser.add_argument("--rare_class_ratio", type=float, default=1.,
+                    help='oversample slices of rare classes by up to this ratio (1: off)')
 parser.add_argument("--num_classes", type=int, default=14)
 parser.add_argument("--fold", type=int, default=0)
 parser.add_argument("--tr_size", type=int, default=1)
@@ -96,6 +106,27 @@ parser.add_argument("--save_dir", type=str, default=None)
 parser.add_argument("--saved_model_path", type=str, default=None)
 parser.add_argument("--load_pseudo_label", default=False, action='store_true')
 parser.add_argument("--dataset", type=str, default="synapse")
+parser.add_argument("--batch_aug", default=False, action='store_true',
+                    help='run the train augmentations on whole batches in the collate step')
+parser.add_argument("--elastic_bank", type=int, default=0,
+                    help='draw elastic deformations from a bank of this many precomputed fields (0: off)')
+parser.add_argument("--elastic_bank_seed", type=int, default=0)
+parser.add_argument("--slice_cache_mb", type=int, default=0,
+                    help='share decoded slices between loader workers, up to this many MB (0: off)')
+parser.add_argument("--volume_cache", type=str, default=None,
+                    help='local folder for decompressed volumes with --dataset volume (default: next to data_dir)')
+parser.add_argument("--shard_dir", type=str, default=None,
+                    help='stream the train slices from the tar shards of dataset/prepare_dataset/write_shards.py')
+parser.add_argument("--shuffle_buffer", type=int, default=1000,
+                    help='records mixed in memory when streaming from --shard_dir')
+parser.add_argument("--loader", type=str, default='process', choices=['process', 'thread'],
+                    help='load batches in worker processes or in threads of this process')
+parser.add_argument("--test_loader", type=str, default=None, choices=['process', 'thread'],
+                    help='backend of the test loaders (default: --loader)')
+parser.add_argument("--telemetry", default=False, action='store_true',
+                    help='time the loader stages per worker and flag data-starved steps (TensorBoard + telemetry_*.json)')
+parser.add_argument("--starve_ratio", type=float, default=0.2,
+                    help='with --telemetry, a step is data-starved if waiting for its batch took more than this share of it')
 
 def main():
     args = parser.parse_args()
@@ -252,6 +283,11 @@ def main_worker(gpu, ngpus_per_node, args):
         #         'optimizer' : optimizer.state_dict(),
         #     }, is_best=is_best, filename=filename)
     test(model, args)
+    if args.distributed:
+        # every rank wrote the volumes of its share of the test patients; the metrics run once
+        dist.barrier()
+        if args.rank != 0:
+            return
     if args.dataset == 'synapse':
         test_synapse(args)
     elif args.dataset == 'ACDC' or args.dataset == 'acdc':
@@ -269,17 +305,14 @@ def train(train_loader, model, optimizer, scheduler, epoch, args, writer):
     # switch to train mode
     model.train()
 
+    # loader stage timings and data-starved steps (--telemetry, dataset/telemetry.py)
+    telemetry = getattr(train_loader.dataset, 'telemetry', None)
     end = time.time()
-    for i, tup in enumerate(train_loader):
+    # the next batch is copied and cast in the background while this one runs
+    for i, (img, label) in enumerate(DevicePrefetcher(train_loader, args.gpu)):
         # measure data loading time
         data_time.update(time.time() - end)
 
-        if args.gpu is not None:
-            img = tup[0].float().cuda(args.gpu, non_blocking=True)
-            label = tup[1].long().cuda(args.gpu, non_blocking=True)
-        else:
-            img = tup[0].float()
-            label = tup[1].long()
         # compute output
         pred = model(img)
         pred_softmax = F.softmax(pred, dim=1)
@@ -296,13 +329,18 @@ def train(train_loader, model, optimizer, scheduler, epoch, args, writer):
 
         # measure elapsed time
         batch_time.update(time.time() - end)
+        if telemetry is not None:
+            telemetry.step(data_time.val, batch_time.val, writer, i + epoch * len(train_loader))
         end = time.time()
         writer.add_scalar('train_loss', loss, global_step=i + epoch * len(train_loader))
 
         if i % args.print_freq == 0:
             print('Train: [{0}][{1}/{2}]\t'
-                  'loss {loss:.4f}'.format(epoch, i, len(train_loader), loss=loss.item()))
+                  'loss {loss:.4f}\t{data_time}\t{batch_time}'.format(epoch, i, len(train_loader), loss=loss.item(),
+                                                                    data_time=data_time, batch_time=batch_time))
 
+    if telemetry is not None:
+        telemetry.export(writer, epoch, telemetry_path(args, 'train'))
     if epoch >= 10:
         scheduler.step(loss)
 
@@ -315,16 +353,7 @@ def validate(val_loader, model, epoch, args, writer):
     model.eval()
 
     with torch.no_grad():
-        for i, tup in enumerate(val_loader):
-            # measure data loading time
-
-            if args.gpu is not None:
-                img = tup[0].float().cuda(args.gpu, non_blocking=True)
-                label = tup[1].long().cuda(args.gpu, non_blocking=True)
-            else:
-                img = tup[0]
-                label = tup[1]
-
+        for i, (img, label) in enumerate(DevicePrefetcher(val_loader, args.gpu)):
             # compute output
             pred = model(img)
             pred_softmax = F.softmax(pred, dim=1)
@@ -334,54 +363,41 @@ def validate(val_loader, model, epoch, args, writer):
 
     print('Epoch: %2d Loss: %.4f' % (epoch, np.mean(loss_list)))
     writer.add_scalar("val_loss", np.mean(loss_list), epoch)
+    if getattr(val_loader.dataset, 'telemetry', None) is not None:
+        val_loader.dataset.telemetry.export(writer, epoch, telemetry_path(args, 'val'))
     return np.mean(loss_list)
 
 
 def test(model, args):
     print('Test')
     join = os.path.join
-    if not os.path.exists(join(args.save_dir, "infer")):
-        os.mkdir(join(args.save_dir, "infer"))
-    if not os.path.exists(join(args.save_dir, "label")):
-        os.mkdir(join(args.save_dir, "label"))
-
-    split_dir = os.path.join(args.src_dir, "splits.pkl")
-    with open(split_dir, "rb") as f:
-        splits = pickle.load(f)
-    test_keys = splits[args.fold]['test']
+    os.makedirs(join(args.save_dir, "infer"), exist_ok=True)
+    os.makedirs(join(args.save_dir, "label"), exist_ok=True)
 
+    # ranks stream different patients and numbers of batches, so the DDP wrapper (which syncs buffers
+    # in every forward) is bypassed
+    model = getattr(model, 'module', model)
     model.eval()
 
-    for key in test_keys:
-        preds = []
-        labels = []
-        data_loader = generate_test_loader(key, args)
-        with torch.no_grad():
-            for i, tup in enumerate(data_loader):
-                if args.gpu is not None:
-                    img = tup[0].float().cuda(args.gpu, non_blocking=True)
-                    label = tup[1].long().cuda(args.gpu, non_blocking=True)
-                else:
-                    img = tup[0]
-                    label = tup[1]
-
-                mask = model(img)
-                mask_softmax = F.softmax(mask, dim=1)
-                mask = torch.argmax(mask_softmax, dim=1)
-
-                preds.append(mask.cpu().numpy())
-                labels.append(label.cpu().numpy())
-
-            preds = np.concatenate(preds, axis=0)
-            labels = np.concatenate(labels, axis=0).squeeze()
-            print(preds.shape, labels.shape)
-            if "." in key:
-                key = key.split(".")[0]
-            ni_pred = nib.Nifti1Image(preds.astype(np.int8), affine=np.eye(4))
-            ni_lb = nib.Nifti1Image(labels.astype(np.int8), affine=np.eye(4))
-            nib.save(ni_pred, join(args.save_dir, 'infer', key + '.nii'))
-            nib.save(ni_lb, join(args.save_dir, 'label', key + '.nii'))
-        print("finish saving file:", key)
+    # one loader over all test patients; volumes are reassembled from the batches as they complete
+    data_loader = generate_volume_test_loader(args)
+    volumes = VolumeAssembler()
+    with torch.no_grad():
+        for i, (img, label, segments) in enumerate(DevicePrefetcher(data_loader, args.gpu)):
+            mask = model(img)
+            mask_softmax = F.softmax(mask, dim=1)
+            mask = torch.argmax(mask_softmax, dim=1)
+
+            for key, preds, labels in volumes.add(segments, mask.cpu().numpy(), label.cpu().numpy()):
+                labels = labels.squeeze()
+                print(preds.shape, labels.shape)
+                if "." in key:
+                    key = key.split(".")[0]
+                ni_pred = nib.Nifti1Image(preds.astype(np.int8), affine=np.eye(4))
+                ni_lb = nib.Nifti1Image(labels.astype(np.int8), affine=np.eye(4))
+                nib.save(ni_pred, join(args.save_dir, 'infer', key + '.nii'))
+                nib.save(ni_lb, join(args.save_dir, 'label', key + '.nii'))
+                print("finish saving file:", key)
 
 
 def test_2(data_loader, model, args):
@@ -32,6 +32,7 @@ from loss_functions.metrics import dice_pytorch, SegmentationMetric
 
 from segment_anything import sam_model_registry, SamAutomaticMaskGenerator, SamPredictor
 from dataset import SynapseDataset, AcdcDataset
+from dataset.thread_loader import get_loader_class
 
 
 parser = argparse.ArgumentParser(description='PyTorch ImageNet Training')
@@ -39,6 +40,8 @@ parser = argparse.ArgumentParser(description='PyTorch ImageNet Training')
 
 parser.add_argument('-j', '--workers', default=32, type=int, metavar='N',
                     help='number of data loading workers (default: 32)')
+parser.add_argument("--loader", type=str, default='process', choices=['process', 'thread'],
+                    help='load batches in worker processes or in threads of this process')
 parser.add_argument('-b', '--batch-size', default=4, type=int,
                     metavar='N',
                     help='mini-batch size (default: 256), this is the total '
@@ -89,7 +92,7 @@ def main():
     tr_keys = splits[args.fold]['train'][0:args.tr_size]
     dataset = AcdcDataset(keys=tr_keys, mode='val', args=args)
     # dataset = CustomDataset(args=args)
-    data_loader = torch.utils.data.DataLoader(
+    data_loader = get_loader_class(args, test=True)(
         dataset, batch_size=args.batch_size, shuffle=False,
         num_workers=args.workers, pin_memory=True, drop_last=False)
 
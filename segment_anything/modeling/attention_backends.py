@@ -0,0 +1,107 @@
+from functools import partial
+from typing import Callable, Dict, Optional, Union
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from torch import Tensor
+
+# A bias is added to the attention logits: a Tensor broadcastable to [..., N_q, N_k], or a callable
+# bias(start, end) returning the rows start:end of it, so a backend only materializes what it needs.
+Bias = Union[Tensor, Callable[[int, int], Tensor], None]
+
+ATTENTION_BACKENDS: Dict[str, Callable] = {}
+
+
+def register_attention_backend(name: str) -> Callable:
+    def register(fn: Callable) -> Callable:
+        ATTENTION_BACKENDS[name] = fn
+        return fn
+    return register
+
+
+def _bias_rows(bias: Bias, start: int, end: int, n_q: int) -> Optional[Tensor]:
+    if bias is None:
+        return None
+    if callable(bias):
+        return bias(start, end)
+    if bias.dim() >= 2 and bias.shape[-2] == n_q and (start, end) != (0, n_q):
+        return bias[..., start:end, :]
+    return bias
+
+
+@register_attention_backend("naive")
+def naive_attention(
+    q: Tensor, k: Tensor, v: Tensor, bias: Bias = None, scale: Optional[float] = None, dropout_p: float = 0.0
+) -> Tensor:
+    """softmax((q * scale) @ k^T + bias) @ v with the full [..., N_q, N_k] attention matrix, as in SAM / DINOv2."""
+    scale = q.shape[-1] ** -0.5 if scale is None else scale
+    attn = (q * scale) @ k.transpose(-2, -1)
+    bias = _bias_rows(bias, 0, q.shape[-2], q.shape[-2])
+    if bias is not None:
+        attn = attn + bias
+    attn = attn.softmax(dim=-1)
+    if dropout_p > 0:
+        attn = F.dropout(attn, dropout_p)
+    return attn @ v
+
+
+@register_attention_backend("sdpa")
+def sdpa_attention(
+    q: Tensor, k: Tensor, v: Tensor, bias: Bias = None, scale: Optional[float] = None, dropout_p: float = 0.0
+) -> Tensor:
+    """
+    torch.nn.functional.scaled_dot_product_attention. Without a bias it can use the fused flash /
+    memory-efficient kernels; a bias (e.g. the decomposed rel-pos terms) is passed as an additive mask.
+    """
+    bias = _bias_rows(bias, 0, q.shape[-2], q.shape[-2])
+    if bias is not None:
+        bias = bias.to(q.dtype)
+    return F.scaled_dot_product_attention(q, k, v, attn_mask=bias, dropout_p=dropout_p, scale=scale)
+
+
+@register_attention_backend("chunked")
+def chunked_attention(
+    q: Tensor,
+    k: Tensor,
+    v: Tensor,
+    bias: Bias = None,
+    scale: Optional[float] = None,
+    dropout_p: float = 0.0,
+    chunk_size: int = 1024,
+) -> Tensor:
+    """
+    The naive computation over chunk_size queries at a time: the peak attention memory is
+    [..., chunk_size, N_k] instead of [..., N_q, N_k], and a callable bias is built chunk by chunk too.
+    """
+    n_q = q.shape[-2]
+    if n_q <= chunk_size:
+        return naive_attention(q, k, v, bias, scale, dropout_p)
+    out = []
+    for start in range(0, n_q, chunk_size):
+        end = min(start + chunk_size, n_q)
+        out.append(naive_attention(q[..., start:end, :], k, v, _bias_rows(bias, start, end, n_q), scale, dropout_p))
+    return torch.cat(out, dim=-2)
+
+
+def get_attention_backend(name: str = "naive", **options) -> Callable:
+    """The backend function registered as name, with options (e.g. chunk_size) bound."""
+    if name not in ATTENTION_BACKENDS:
+        raise ValueError("unknown attention backend %s, choose from %s" % (name, list(ATTENTION_BACKENDS)))
+    fn = ATTENTION_BACKENDS[name]
+    return partial(fn, **options) if options else fn
+
+
+def set_attention_backend(model: nn.Module, name: str = "naive", **options) -> nn.Module:
+    """
+    Switch every attention layer of model (SAM image encoder and TwoWayTransformer, DINOv2 layers)
+    to the backend name. The layers keep their weights; returns model.
+    """
+    if name != "chunked":
+        options.pop("chunk_size", None)
+    backend = get_attention_backend(name, **options)
+    for module in model.modules():
+        if hasattr(module, "attention_backend"):
+            module.attention_backend = backend
+    return model
@@ -7,9 +7,12 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 
-from typing import Optional, Tuple, Type
+from functools import lru_cache
+from typing import Dict, Optional, Set, Tuple, Type
 
+from .attention_backends import get_attention_backend
 from .common import LayerNorm2d, MLPBlock
 
 
@@ -33,6 +36,7 @@ class ImageEncoderViT(nn.Module):
         rel_pos_zero_init: bool = True,
         window_size: int = 0,
         global_attn_indexes: Tuple[int, ...] = (),
+        token_skip_threshold: Optional[float] = None,
     ) -> None:
         """
         Args:
@@ -51,9 +55,23 @@ class ImageEncoderViT(nn.Module):
             rel_pos_zero_init (bool): If True, zero initialize relative positional parameters.
             window_size (int): Window size for window attention blocks.
             global_attn_indexes (list): Indexes for blocks using global attention.
+            token_skip_threshold (float or None): If set, skip background patches, see token_mask.
         """
         super().__init__()
         self.img_size = img_size
+        self.patch_size = patch_size
+
+        # token sparsity for mostly empty (medical) slices, see token_mask; off with None
+        self.token_skip_threshold = token_skip_threshold
+        self.token_skip_margin = 0.05
+        self.token_skip_dilation = 1
+        self.skip_token: Optional[nn.Parameter] = None
+        if token_skip_threshold is not None:
+            # learned fill of the skipped tokens before the neck; zero until trained
+            self.skip_token = nn.Parameter(torch.zeros(embed_dim))
+        self.last_skip_fraction: Optional[torch.Tensor] = None
+        # indices of the blocks run under activation checkpointing while autograd is recording
+        self.checkpoint_blocks: Set[int] = set()
 
         self.patch_embed = PatchEmbed(
             kernel_size=(patch_size, patch_size),
@@ -103,18 +121,71 @@ class ImageEncoderViT(nn.Module):
             LayerNorm2d(out_chans),
         )
 
+    def token_mask(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        [B, H / patch, W / patch] mask of the patches to process. A patch is skipped when it is flat
+        (intensity variance over its pixels and channels below token_skip_threshold) and at the
+        background level of its slice (mean within token_skip_margin of the slice's intensity range
+        above its minimum), so uniform structures such as a blood pool are kept. The mask is then
+        dilated by token_skip_dilation patches to keep the context of the foreground.
+        """
+        p = self.patch_size
+        mean = F.avg_pool2d(x, p)
+        var = (F.avg_pool2d(x * x, p) - mean * mean).mean(1)
+        low = x.amin(dim=(1, 2, 3)).view(-1, 1, 1)
+        high = x.amax(dim=(1, 2, 3)).view(-1, 1, 1)
+        background = mean.mean(1) <= low + self.token_skip_margin * (high - low)
+        keep = (var > self.token_skip_threshold) | ~background
+        if self.token_skip_dilation > 0:
+            d = self.token_skip_dilation
+            keep = F.max_pool2d(keep[:, None].float(), 2 * d + 1, stride=1, padding=d)[:, 0] > 0
+        return keep
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
+        keep = None
+        if self.token_skip_threshold is not None:
+            keep = self.token_mask(x)
+            self.last_skip_fraction = 1 - keep.float().mean(dim=(1, 2))
+
         x = self.patch_embed(x)
         if self.pos_embed is not None:
             x = x + self.pos_embed
 
-        for blk in self.blocks:
-            x = blk(x)
+        for i in range(len(self.blocks)):
+            x = self._block(i, x, keep)
+
+        if keep is not None:
+            fill = self.skip_token if self.skip_token is not None else x.new_zeros(x.shape[-1])
+            x = torch.where(keep[..., None], x, fill.to(x.dtype))
 
         x = self.neck(x.permute(0, 3, 1, 2))
 
         return x
 
+    def _block(self, i: int, x: torch.Tensor, keep: Optional[torch.Tensor] = None) -> torch.Tensor:
+        if i in self.checkpoint_blocks and torch.is_grad_enabled():
+            # activations inside the block are recomputed in the backward pass
+            return torch.utils.checkpoint.checkpoint(self.blocks[i], x, keep, use_reentrant=False)
+        return self.blocks[i](x, keep)
+
+    def forward_until(self, x: torch.Tensor, end: int) -> torch.Tensor:
+        """Patch embedding and blocks[:end]: the input of block end, as [B, C, H, W]."""
+        if self.token_skip_threshold is not None:
+            raise NotImplementedError("token skipping needs the image; run the whole encoder")
+        x = self.patch_embed(x)
+        if self.pos_embed is not None:
+            x = x + self.pos_embed
+        for i in range(end):
+            x = self._block(i, x)
+        return x.permute(0, 3, 1, 2)
+
+    def forward_from(self, x: torch.Tensor, start: int) -> torch.Tensor:
+        """blocks[start:] and the neck on the [B, C, H, W] output of forward_until(..., start)."""
+        x = x.permute(0, 2, 3, 1)
+        for i in range(start, len(self.blocks)):
+            x = self._block(i, x)
+        return self.neck(x.permute(0, 3, 1, 2))
+
     def forward_feature(self, x: torch.Tensor) -> torch.Tensor:
         out = []
 
@@ -178,7 +249,13 @@ class Block(nn.Module):
 
         self.window_size = window_size
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def forward(self, x: torch.Tensor, keep: Optional[torch.Tensor] = None) -> torch.Tensor:
+        if keep is not None and not bool(keep.all()):
+            # token skipping (ImageEncoderViT.token_mask): skipped tokens pass through unchanged
+            if self.window_size > 0:
+                return self._forward_active_windows(x, keep)
+            return self._forward_kept_tokens(x, keep)
+
         shortcut = x
         x = self.norm1(x)
         # Window partition
@@ -196,6 +273,38 @@ class Block(nn.Module):
 
         return x
 
+    def _forward_active_windows(self, x: torch.Tensor, keep: torch.Tensor) -> torch.Tensor:
+        """Windowed block that runs only the windows holding at least one kept token."""
+        H, W = x.shape[1], x.shape[2]
+        shortcut, pad_hw = window_partition(x, self.window_size)
+        # normalize before padding, as forward does
+        normed, _ = window_partition(self.norm1(x), self.window_size)
+        kept, _ = window_partition(keep[..., None].to(x.dtype), self.window_size)
+        active = kept.flatten(1).amax(1) > 0
+
+        out = shortcut.clone()
+        y = shortcut[active] + self.attn(normed[active])
+        out[active] = y + self.mlp(self.norm2(y))
+        return window_unpartition(out, self.window_size, pad_hw, (H, W))
+
+    def _forward_kept_tokens(self, x: torch.Tensor, keep: torch.Tensor) -> torch.Tensor:
+        """Global block over the kept tokens only, padded to the largest count of the batch."""
+        B, H, W, C = x.shape
+        flat = x.reshape(B, H * W, C)
+        keep = keep.reshape(B, H * W)
+        n = int(keep.sum(1).max())
+        if n == 0:
+            return x
+        # kept tokens first, in grid order; the padding indices are skipped tokens
+        index = torch.argsort((~keep).to(torch.uint8), dim=1, stable=True)[:, :n]
+        valid = torch.gather(keep, 1, index)
+        tokens = torch.gather(flat, 1, index[..., None].expand(-1, -1, C))
+
+        y = tokens + self.attn.forward_tokens(self.norm1(tokens), index, valid, (H, W))
+        y = y + self.mlp(self.norm2(y))
+        y = torch.where(valid[..., None], y, tokens)
+        return flat.scatter(1, index[..., None].expand(-1, -1, C), y).view(B, H, W, C)
+
 
 class Attention(nn.Module):
     """Multi-head Attention block with relative position embeddings."""
@@ -236,6 +345,40 @@ class Attention(nn.Module):
             self.rel_pos_h = nn.Parameter(torch.zeros(2 * input_size[0] - 1, head_dim))
             self.rel_pos_w = nn.Parameter(torch.zeros(2 * input_size[1] - 1, head_dim))
 
+        # see attention_backends.py; switched with set_attention_backend
+        self.attention_backend = get_attention_backend("naive")
+        # rel-pos tables per (q_size, k_size), see rel_pos_tables
+        self.cache_rel_pos = True
+        self._rel_pos_cache: Dict[Tuple, Tuple] = {}
+
+    def rel_pos_tables(
+        self, q_size: Tuple[int, int], k_size: Tuple[int, int]
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        get_rel_pos of both axes. Unless they take part in autograd (fine-tuning), the tables are
+        cached per input resolution and rebuilt when rel_pos_h / rel_pos_w change: optimizer steps and
+        load_state_dict bump the tensor version, .to() replaces the storage.
+        """
+        if not self.cache_rel_pos or (
+            torch.is_grad_enabled() and (self.rel_pos_h.requires_grad or self.rel_pos_w.requires_grad)
+        ):
+            return (
+                get_rel_pos(q_size[0], k_size[0], self.rel_pos_h),
+                get_rel_pos(q_size[1], k_size[1], self.rel_pos_w),
+            )
+        key = (q_size, k_size)
+        version = tuple((t._version, t.data_ptr(), t.dtype) for t in (self.rel_pos_h, self.rel_pos_w))
+        cached = self._rel_pos_cache.get(key)
+        if cached is None or cached[0] != version:
+            with torch.no_grad():
+                cached = (
+                    version,
+                    get_rel_pos(q_size[0], k_size[0], self.rel_pos_h),
+                    get_rel_pos(q_size[1], k_size[1], self.rel_pos_w),
+                )
+            self._rel_pos_cache[key] = cached
+        return cached[1], cached[2]
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         B, H, W, _ = x.shape
         # qkv with shape (3, B, nHead, H * W, C)
@@ -243,13 +386,33 @@ class Attention(nn.Module):
         # q, k, v with shape (B * nHead, H * W, C)
         q, k, v = qkv.reshape(3, B * self.num_heads, H * W, -1).unbind(0)
 
-        attn = (q * self.scale) @ k.transpose(-2, -1)
-
+        bias = None
         if self.use_rel_pos:
-            attn = add_decomposed_rel_pos(attn, q, self.rel_pos_h, self.rel_pos_w, (H, W), (H, W))
+            Rh, Rw = self.rel_pos_tables((H, W), (H, W))
+            bias = decomposed_rel_pos_bias(q, Rh, Rw, (H, W), (H, W))
+
+        x = self.attention_backend(q, k, v, bias, self.scale)
+        x = x.view(B, self.num_heads, H, W, -1).permute(0, 2, 3, 1, 4).reshape(B, H, W, -1)
+        x = self.proj(x)
+
+        return x
+
+    def forward_tokens(
+        self, x: torch.Tensor, index: torch.Tensor, valid: torch.Tensor, size: Tuple[int, int]
+    ) -> torch.Tensor:
+        """
+        Attention among a subset of the tokens of a size grid: x [B, N, C] are the tokens at the flat
+        grid positions index [B, N]; keys where valid is False (padding) are masked out.
+        """
+        B, N, _ = x.shape
+        qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv.reshape(3, B * self.num_heads, N, -1).unbind(0)
 
-        attn = attn.softmax(dim=-1)
-        x = (attn @ v).view(B, self.num_heads, H, W, -1).permute(0, 2, 3, 1, 4).reshape(B, H, W, -1)
+        Rh, Rw = self.rel_pos_tables(size, size) if self.use_rel_pos else (None, None)
+        bias = sparse_rel_pos_bias(q, Rh, Rw, index, valid, size, self.num_heads)
+
+        x = self.attention_backend(q, k, v, bias, self.scale)
+        x = x.view(B, self.num_heads, N, -1).transpose(1, 2).reshape(B, N, -1)
         x = self.proj(x)
 
         return x
@@ -329,12 +492,18 @@ def get_rel_pos(q_size: int, k_size: int, rel_pos: torch.Tensor) -> torch.Tensor
     else:
         rel_pos_resized = rel_pos
 
+    return rel_pos_resized[rel_pos_index(q_size, k_size, rel_pos_resized.device)]
+
+
+@lru_cache(maxsize=64)
+def rel_pos_index(q_size: int, k_size: int, device: torch.device) -> torch.Tensor:
+    """[q_size, k_size] indices of the relative positions into a (2 * max(q_size, k_size) - 1) table."""
     # Scale the coords with short length if shapes for q and k are different.
     q_coords = torch.arange(q_size)[:, None] * max(k_size / q_size, 1.0)
     k_coords = torch.arange(k_size)[None, :] * max(q_size / k_size, 1.0)
     relative_coords = (q_coords - k_coords) + (k_size - 1) * max(q_size / k_size, 1.0)
 
-    return rel_pos_resized[relative_coords.long()]
+    return relative_coords.long().to(device)
 
 
 def add_decomposed_rel_pos(
@@ -376,6 +545,74 @@ def add_decomposed_rel_pos(
     return attn
 
 
+def decomposed_rel_pos_bias(
+    q: torch.Tensor,
+    Rh: torch.Tensor,
+    Rw: torch.Tensor,
+    q_size: Tuple[int, int],
+    k_size: Tuple[int, int],
+):
+    """
+    The terms add_decomposed_rel_pos adds to the attention map, as a callable bias(start, end)
+    returning the rows start:end of the [B, q_h * q_w, k_h * k_w] bias (see attention_backends.py).
+    Rh / Rw are the get_rel_pos tables of the two axes (Attention.rel_pos_tables).
+    Only the [B, q_h * q_w, k_h + k_w] factors are computed up front.
+    """
+    q_h, q_w = q_size
+    k_h, k_w = k_size
+
+    B, _, dim = q.shape
+    r_q = q.reshape(B, q_h, q_w, dim)
+    rel_h = torch.einsum("bhwc,hkc->bhwk", r_q, Rh).reshape(B, q_h * q_w, k_h)
+    rel_w = torch.einsum("bhwc,wkc->bhwk", r_q, Rw).reshape(B, q_h * q_w, k_w)
+
+    def bias(start: int, end: int) -> torch.Tensor:
+        rows = rel_h[:, start:end, :, None] + rel_w[:, start:end, None, :]
+        return rows.reshape(B, end - start, k_h * k_w)
+
+    return bias
+
+
+def sparse_rel_pos_bias(
+    q: torch.Tensor,
+    Rh: Optional[torch.Tensor],
+    Rw: Optional[torch.Tensor],
+    index: torch.Tensor,
+    valid: torch.Tensor,
+    size: Tuple[int, int],
+    num_heads: int,
+):
+    """
+    decomposed_rel_pos_bias for the tokens at the flat positions index [B, N] of a size grid, plus
+    a large negative bias on the keys that are not valid. Returns a callable bias(start, end) of rows
+    of the [B * num_heads, N, N] bias. For a square grid Rh[i, j] = table[i - j + H - 1], so q is
+    projected on the 2H - 1 table rows once and the bias gathered by the row / column distances.
+    """
+    H, W = size
+    BH, N, dim = q.shape
+    B = BH // num_heads
+    ys, xs = index // W, index % W
+    pad = (~valid).to(q.dtype) * (torch.finfo(q.dtype).min / 2)
+    pad = pad[:, None, None, :]
+    if Rh is None:
+        return lambda start, end: pad.expand(B, num_heads, end - start, N).reshape(BH, end - start, N)
+
+    table_h = torch.cat([Rh[0].flip(0), Rh[1:, 0]])
+    table_w = torch.cat([Rw[0].flip(0), Rw[1:, 0]])
+    r_q = q.view(B, num_heads, N, dim)
+    proj_h = r_q @ table_h.t()
+    proj_w = r_q @ table_w.t()
+
+    def bias(start: int, end: int) -> torch.Tensor:
+        shape = (B, num_heads, end - start, N)
+        dy = (ys[:, start:end, None] - ys[:, None, :] + H - 1)[:, None].expand(shape)
+        dx = (xs[:, start:end, None] - xs[:, None, :] + W - 1)[:, None].expand(shape)
+        rows = proj_h[:, :, start:end].gather(3, dy) + proj_w[:, :, start:end].gather(3, dx) + pad
+        return rows.reshape(BH, end - start, N)
+
+    return bias
+
+
 class PatchEmbed(nn.Module):
     """
     Image to Patch Embedding.